@@ -1,4 +1,5 @@
 from pathlib import Path
+import json
 import os
 from dotenv import load_dotenv
 
@@ -17,10 +18,64 @@ AZURE_OPENAI_CHAT_TEMPERATURE = float(os.getenv("AZURE_OPENAI_CHAT_TEMPERATURE",
 AZURE_OPENAI_CHAT_MAX_TOKENS = int(os.getenv("AZURE_OPENAI_CHAT_MAX_TOKENS", 4000))
 AZURE_OPENAI_CHAT_SUMMARY_MAX_TOKEN = int(os.getenv("AZURE_OPENAI_CHAT_SUMMARY_MAX_TOKEN", 10))
 AZURE_OPENAI_CONVERSATION_BUFFER_WINDOW_SIZE = int(os.getenv("AZURE_OPENAI_CONVERSATION_BUFFER_WINDOW_SIZE", 5))
+# Conversation history token budget per coaching step, e.g. "OPTIONS=300,WILL=800"; other steps use AZURE_OPENAI_CHAT_MAX_TRIM_TOKENS
+CHAT_HISTORY_STEP_MAX_TOKENS = {
+    step: int(tokens)
+    for step, tokens in (item.split('=') for item in os.getenv("CHAT_HISTORY_STEP_MAX_TOKENS", '').split(',') if item)
+}
 AZURE_OPENAI_API_KEY = os.getenv("AZURE_OPENAI_API_KEY")
 AZURE_OPENAI_API_VERSION = os.getenv("AZURE_OPENAI_API_VERSION")
 AZURE_OPENAI_ENDPOINT = os.getenv("AZURE_OPENAI_ENDPOINT")
 
+# Chat model backend: "azure", "fake" (offline, for load tests and CI), "router" (LLM_DEPLOYMENTS)
+# or the dotted path of a factory
+LLM_BACKEND = os.getenv("LLM_BACKEND") or 'azure'
+# Deployments of the router backend as a JSON list. Each has a name, a backend (default "azure") and
+# CHAT_API keys overriding the defaults, e.g. [{"name": "eastus", "MODEL_DEPLOYMENT": "gpt-4o",
+# "OPENAI_ENDPOINT": "https://...", "API_KEY_ENV": "AZURE_OPENAI_API_KEY_EASTUS"},
+# {"name": "stub", "backend": "fake", "FAKE_LLM_LATENCY": "fixed:1"}]. Names must be unique. A deployment
+# with its own quota also sets RATE_LIMIT_RPM, RATE_LIMIT_TPM and/or MAX_CONCURRENCY.
+LLM_DEPLOYMENTS = json.loads(os.getenv("LLM_DEPLOYMENTS") or '[]')
+# A routed call is sent to a second deployment once the first is slower than this percentile of its
+# recent calls (0 = no hedging), or LLM_ROUTER_HEDGE_DELAY seconds until it has LLM_ROUTER_MIN_SAMPLES calls
+LLM_ROUTER_HEDGE_PERCENTILE = float(os.getenv("LLM_ROUTER_HEDGE_PERCENTILE", 0.95))
+LLM_ROUTER_HEDGE_DELAY = float(os.getenv("LLM_ROUTER_HEDGE_DELAY", 2))
+LLM_ROUTER_MIN_SAMPLES = int(os.getenv("LLM_ROUTER_MIN_SAMPLES", 10))
+# One keep-alive HTTP connection pool per process for the LLM API
+LLM_REQUEST_TIMEOUT = float(os.getenv("LLM_REQUEST_TIMEOUT", 60))  # Seconds
+LLM_HTTP_MAX_CONNECTIONS = int(os.getenv("LLM_HTTP_MAX_CONNECTIONS", 100))
+LLM_HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("LLM_HTTP_MAX_KEEPALIVE_CONNECTIONS", 20))
+LLM_HTTP_KEEPALIVE_EXPIRY = float(os.getenv("LLM_HTTP_KEEPALIVE_EXPIRY", 60))  # Seconds an idle connection is kept
+# Quota of the deployment, shared by all web and Celery processes through Redis (aiCoach/rate_limit.py).
+# 0 turns a limit off. Calls wait up to LLM_RATE_LIMIT_MAX_WAIT seconds for quota, then fail with a 503.
+LLM_RATE_LIMIT_RPM = int(os.getenv("LLM_RATE_LIMIT_RPM", 0))
+LLM_RATE_LIMIT_TPM = int(os.getenv("LLM_RATE_LIMIT_TPM", 0))
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", 0))
+LLM_RATE_LIMIT_MAX_WAIT = float(os.getenv("LLM_RATE_LIMIT_MAX_WAIT", 10))
+LLM_RATE_LIMIT_RETRY = float(os.getenv("LLM_RATE_LIMIT_RETRY", 0.05))  # Seconds between tries while all slots are busy
+# Share of each limit background work and router hedges leave to interactive coach calls,
+# e.g. "summary=0.2,label=0.4,hedge=0.2"
+LLM_PRIORITY_RESERVES = {
+    priority: float(share)
+    for priority, share in (item.split('=') for item in os.getenv("LLM_PRIORITY_RESERVES", 'summary=0.2,label=0.4,hedge=0.2').split(',') if item)
+}
+# Background LLM work is deferred while the moving average of coach call latency is above this (seconds, 0 = never)
+LLM_INTERACTIVE_LATENCY_TARGET = float(os.getenv("LLM_INTERACTIVE_LATENCY_TARGET", 0))
+LLM_INTERACTIVE_LATENCY_SMOOTHING = float(os.getenv("LLM_INTERACTIVE_LATENCY_SMOOTHING", 0.2))  # Weight of the newest call
+LLM_INTERACTIVE_LATENCY_WINDOW = float(os.getenv("LLM_INTERACTIVE_LATENCY_WINDOW", 60))  # Seconds the average is kept without calls
+# Ask the model for replies in the JSON schema of the output parsers (response_format json_schema,
+# Azure OpenAI API version 2024-08-01-preview or later). Off: the schema is described in the prompt.
+LLM_STRUCTURED_OUTPUT = os.getenv("LLM_STRUCTURED_OUTPUT", 'true').lower() in ('1', 'true', 'yes')
+LLM_STRUCTURED_OUTPUT_RETRIES = int(os.getenv("LLM_STRUCTURED_OUTPUT_RETRIES", 1))  # Extra calls after a reply that does not match
+# Fake backend: latency before the first token ("fixed:0.8", "uniform:0.3,1.5", "normal:1,0.25",
+# "lognormal:-0.2,0.5"), seconds per streamed token, share of failed calls and their error
+FAKE_LLM_LATENCY = os.getenv("FAKE_LLM_LATENCY") or 'fixed:0'
+FAKE_LLM_TOKEN_DELAY = float(os.getenv("FAKE_LLM_TOKEN_DELAY", 0))
+FAKE_LLM_ERROR_RATE = float(os.getenv("FAKE_LLM_ERROR_RATE", 0))
+FAKE_LLM_ERROR = os.getenv("FAKE_LLM_ERROR") or 'rate_limit'  # rate_limit, timeout or server
+FAKE_LLM_STEP_COMPLETION_RATE = float(os.getenv("FAKE_LLM_STEP_COMPLETION_RATE", 0.3))
+FAKE_LLM_SEED = int(os.getenv("FAKE_LLM_SEED")) if os.getenv("FAKE_LLM_SEED") else None
+
 
 # Celery Configuration Options
 CELERY_BROKER_URL = 'redis://localhost:6379/0'  # Example using Redis
@@ -30,6 +85,35 @@ CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = 'UTC'
 
+# Chat labels are generated in batches on their own low-priority queue, so they never
+# delay conversation saves. Run a separate worker for it: `celery -A aiChatService worker -Q chat-labels`
+CHAT_LABEL_QUEUE = os.getenv("CHAT_LABEL_QUEUE", 'chat-labels')
+CHAT_LABEL_BATCH_SIZE = int(os.getenv("CHAT_LABEL_BATCH_SIZE", 20))  # Chats labelled per LLM call
+CHAT_LABEL_BATCH_DELAY = int(os.getenv("CHAT_LABEL_BATCH_DELAY", 30))  # Seconds new chats are collected before a batch runs
+CHAT_LABEL_MESSAGES = int(os.getenv("CHAT_LABEL_MESSAGES", 6))  # Opening messages of a chat sent for labelling
+CELERY_TASK_ROUTES = {
+    'aiCoach.tasks.generate_chat_labels': {'queue': CHAT_LABEL_QUEUE},
+}
+
+# Shared cache used by all web and Celery workers (coaching prompt cache, ...)
+CACHE_REDIS_URL = os.getenv("CACHE_REDIS_URL", 'redis://localhost:6379/1')
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': CACHE_REDIS_URL,
+    }
+}
+# Redis holding the LLM quota buckets (aiCoach/rate_limit.py)
+LLM_RATE_LIMIT_REDIS_URL = os.getenv("LLM_RATE_LIMIT_REDIS_URL", CACHE_REDIS_URL)
+
+# Seconds an idle chat's hot state stays in the cache (see aiCoach/chat_session.py)
+CHAT_SESSION_TIMEOUT = int(os.getenv("CHAT_SESSION_TIMEOUT", 30 * 60))
+
+# Cached LLM replies for opening turns of these coaching steps (comma separated, empty to disable)
+LLM_RESPONSE_CACHE_STEPS = [step for step in os.getenv("LLM_RESPONSE_CACHE_STEPS", 'GOAL').split(',') if step]
+LLM_RESPONSE_CACHE_TIMEOUT = int(os.getenv("LLM_RESPONSE_CACHE_TIMEOUT", 60 * 60))  # Seconds
+LLM_RESPONSE_CACHE_SIZE = int(os.getenv("LLM_RESPONSE_CACHE_SIZE", 256))  # Replies kept per process
+
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/5.0/howto/deployment/checklist/
 
@@ -57,6 +141,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'aiCoach.middleware.ServerTimingMiddleware',  # First, so its total covers the other middleware
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -66,6 +151,49 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
+REST_FRAMEWORK = {
+    'DEFAULT_RENDERER_CLASSES': [
+        'aiCoach.timing.TimedJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+}
+# Rows per page of the list endpoints (aiCoach/pagination.py); clients may ask for up to API_MAX_PAGE_SIZE
+API_PAGE_SIZE = int(os.getenv("API_PAGE_SIZE", 50))
+API_MAX_PAGE_SIZE = int(os.getenv("API_MAX_PAGE_SIZE", 200))
+# Seconds clients may reuse a reference data response (categories, levels, prompts) before revalidating its ETag
+REFERENCE_DATA_MAX_AGE = int(os.getenv("REFERENCE_DATA_MAX_AGE", 60))
+
+# App logs go through a queue to a background writer thread (aiCoach/log.py), so
+# requests do not block on log I/O. Set LOG_LEVEL=DEBUG for payload dumps
+# (conversations, LLM replies), which are logged for LOG_PAYLOAD_SAMPLE_RATE of
+# the calls. aiCoach.requests writes one JSON line per request (aiCoach/middleware.py).
+LOG_LEVEL = os.getenv("LOG_LEVEL", 'INFO')
+LOG_PAYLOAD_SAMPLE_RATE = float(os.getenv("LOG_PAYLOAD_SAMPLE_RATE", 0.1))
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'default': {'format': '%(asctime)s %(levelname)s %(name)s %(message)s'},
+    },
+    'handlers': {
+        'queue': {
+            'class': 'aiCoach.log.QueueLogHandler',
+            'formatter': 'default',
+            'maxsize': int(os.getenv("LOG_QUEUE_SIZE", 10000)),
+        },
+    },
+    'loggers': {
+        'aiCoach': {
+            'handlers': ['queue'],
+            'level': LOG_LEVEL,
+            'propagate': False,
+        },
+        'aiCoach.requests': {
+            'level': os.getenv("REQUEST_LOG_LEVEL", 'INFO'),
+        },
+    },
+}
+
 ROOT_URLCONF = 'aiChatService.urls'
 
 TEMPLATES = [
@@ -98,9 +226,30 @@ DATABASES = {
         'PASSWORD': os.environ.get('DB_PASSWORD'),
         'HOST': os.environ.get('DB_HOST'),
         'PORT': os.environ.get('DB_PORT'),
+        # Persistent connections, reused across requests by each worker (0 closes them after every request)
+        'CONN_MAX_AGE': int(os.environ.get('DB_CONN_MAX_AGE', 60)),
+        'CONN_HEALTH_CHECKS': True,
     }
 }
 
+# Optional read replica for the read-only views (aiCoach/db_router.py). Unset DB_REPLICA_* values
+# fall back to the primary's, so a second database on the same server only needs DB_REPLICA_NAME.
+if os.environ.get('DB_REPLICA_HOST') or os.environ.get('DB_REPLICA_NAME'):
+    DATABASES['replica'] = {
+        **DATABASES['default'],
+        'NAME': os.environ.get('DB_REPLICA_NAME') or DATABASES['default']['NAME'],
+        'USER': os.environ.get('DB_REPLICA_USER') or DATABASES['default']['USER'],
+        'PASSWORD': os.environ.get('DB_REPLICA_PASSWORD') or DATABASES['default']['PASSWORD'],
+        'HOST': os.environ.get('DB_REPLICA_HOST') or DATABASES['default']['HOST'],
+        'PORT': os.environ.get('DB_REPLICA_PORT') or DATABASES['default']['PORT'],
+        # Tests read the replica through the test database
+        'TEST': {'MIRROR': 'default'},
+    }
+
+DATABASE_ROUTERS = ['aiCoach.db_router.ReplicaRouter']
+# Seconds a user's reads stay on the primary after they wrote, while the replica catches up
+DATABASE_REPLICA_STICKY_SECONDS = int(os.environ.get('DATABASE_REPLICA_STICKY_SECONDS', 10))
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
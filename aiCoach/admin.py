@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Category, CategoryLevel, CategoryLevelExample, CoachingPrompt, User, UserCallStatementsWithLevel, UserGoal, UserPerformanceData, UserConversationHistory
+from .models import Category, CategoryLevel, CategoryLevelExample, CoachingPrompt, ConversationMessage, User, UserCallStatementsWithLevel, UserGoal, UserPerformanceData, UserConversationHistory
 
 # Custom admin for user model
 class UserAdmin(admin.ModelAdmin):
@@ -48,9 +48,17 @@ class UserPerformanceDataAdmin(admin.ModelAdmin):
     list_filter = ('category', 'date', 'is_active')
     ordering = ('user__id', 'date', 'category')
 
+# Messages of a conversation, shown inline on the conversation
+class ConversationMessageInline(admin.TabularInline):
+    model = ConversationMessage
+    fields = ('sequence', 'role', 'text', 'created_at')
+    readonly_fields = ('created_at',)
+    extra = 0
+
 # Custom admin for UserConversationHistory model
 class UserConversationHistoryAdmin(admin.ModelAdmin):
-    list_display = ('chat_id', 'user', 'messages', 'is_active', )
+    list_display = ('chat_id', 'user', 'chat_label', 'is_active', )
+    inlines = [ConversationMessageInline]
     search_fields = ('user__id', 'user__first_name', 'user__last_name',"chat_id", )
     list_filter = ('chat_id', 'isGoalStepCompleted', 'isRealityStepCompleted', 'isOptionStepCompleted', 'isWillStepCompleted', 'is_active')
     ordering = ('user__id', 'created_at')
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class AicoachConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'aiCoach'
+
+    def ready(self):
+        # Register the cache invalidation signal handlers
+        from aiCoach import signals  # noqa: F401
@@ -0,0 +1,86 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache import cache
+
+
+class LocalLRUCache:
+    """
+    A small thread-safe, process-local LRU cache.
+    """
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.entries:
+                return default
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class VersionedCache:
+    """
+    Two-tier cache for read-mostly data: a process-local LRU in front of the
+    shared Django cache (Redis). Every entry is keyed by a namespace version
+    that lives in the shared cache, so `bump_version()` from any web or Celery
+    process invalidates all entries everywhere; the next read in each process
+    sees the new version and reloads.
+    """
+
+    def __init__(self, namespace, maxsize=128, timeout=None):
+        self.namespace = namespace
+        self.timeout = timeout  # Shared-tier timeout; None keeps entries until they are evicted
+        self.local = LocalLRUCache(maxsize)
+        self.version_key = f"aicoach:{namespace}:version"
+
+    def get_version(self):
+        version = cache.get(self.version_key)
+        if version is None:
+            # Start from the current time so a flushed cache never reuses a version
+            # that is still held in some process-local LRU.
+            cache.add(self.version_key, time.time_ns(), timeout=None)
+            version = cache.get(self.version_key)
+        return version
+
+    def bump_version(self):
+        try:
+            return cache.incr(self.version_key)
+        except ValueError:
+            cache.add(self.version_key, time.time_ns(), timeout=None)
+            return cache.incr(self.version_key)
+
+    def get_or_set(self, key, load):
+        """
+        Returns the cached value for `key` at the current version, calling
+        `load()` and filling both tiers on a miss.
+        """
+        version = self.get_version()
+        shared_key = f"aicoach:{self.namespace}:{key}:v{version}"
+
+        value = self.local.get(shared_key)
+        if value is not None:
+            return value
+
+        value = cache.get(shared_key)
+        if value is None:
+            value = load()
+            cache.set(shared_key, value, timeout=self.timeout)
+
+        self.local.set(shared_key, value)
+        return value
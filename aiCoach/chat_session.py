@@ -0,0 +1,76 @@
+from django.conf import settings
+from django.core.cache import cache
+
+# Hot state of active chats, written through on every turn so the next turn
+# reads its own writes without waiting for the Celery save. Postgres stays the
+# system of record; an expired or evicted session is rebuilt from it.
+#
+# Keys per chat (all with the same timeout, refreshed on every turn):
+#   aicoach:chat-session:{user_id}:{chat_id}            recent window and step flags
+#   aicoach:chat-session:{user_id}:{chat_id}:sequence   last allocated message sequence
+#   aicoach:chat-session:{user_id}:{chat_id}:saved      summary and label from the last save
+
+
+def chat_session_key(user_id, chat_id):
+    return f"aicoach:chat-session:{user_id}:{chat_id}"
+
+
+def get_chat_session(user_id, chat_id):
+    """
+    Returns the cached state of a chat ({"conversation": ..., "recent_messages": ...}),
+    or None if the chat is not active in the cache.
+    """
+    key = chat_session_key(user_id, chat_id)
+    return merge_chat_session(cache.get_many([key, f"{key}:saved"]), key)
+
+
+async def aget_chat_session(user_id, chat_id):
+    """
+    Async variant of `get_chat_session`.
+    """
+    key = chat_session_key(user_id, chat_id)
+    return merge_chat_session(await cache.aget_many([key, f"{key}:saved"]), key)
+
+
+def merge_chat_session(values, key):
+    session = values.get(key)
+    if session is None:
+        return None
+    session["conversation"].update(values.get(f"{key}:saved", {}))
+    return session
+
+
+def set_chat_session(user_id, chat_id, conversation, recent_messages):
+    """
+    Stores the chat's step flags and recent window ([{"sequence", "role", "text"}, ...]).
+    """
+    key = chat_session_key(user_id, chat_id)
+    cache.set(key, {"conversation": conversation, "recent_messages": recent_messages},
+              timeout=settings.CHAT_SESSION_TIMEOUT)
+
+
+def allocate_message_sequences(user_id, chat_id, count, last_stored_sequence):
+    """
+    Reserves `count` message sequences for a turn and returns the first one.
+    `last_stored_sequence` seeds the counter when the chat is not cached yet.
+    The increment is atomic, so concurrent turns never get the same sequence.
+    """
+    key = f"{chat_session_key(user_id, chat_id)}:sequence"
+    cache.add(key, last_stored_sequence, timeout=settings.CHAT_SESSION_TIMEOUT)
+    try:
+        last = cache.incr(key, count)
+    except ValueError:
+        # The key expired or was evicted between the add and the incr
+        cache.add(key, last_stored_sequence, timeout=settings.CHAT_SESSION_TIMEOUT)
+        last = cache.incr(key, count)
+    cache.touch(key, timeout=settings.CHAT_SESSION_TIMEOUT)
+    return last - count + 1
+
+
+def set_saved_chat_state(user_id, chat_id, summary, chat_label):
+    """
+    Publishes the summary and label computed by the Celery save to the session.
+    Kept under its own key so it never overwrites a newer window from the web process.
+    """
+    key = f"{chat_session_key(user_id, chat_id)}:saved"
+    cache.set(key, {"summary": summary, "chat_label": chat_label}, timeout=settings.CHAT_SESSION_TIMEOUT)
@@ -0,0 +1,221 @@
+import logging
+from dataclasses import dataclass
+from typing import List, Optional
+
+from django.contrib.postgres.expressions import ArraySubquery
+from django.db.models import OuterRef, Subquery
+from django.db.models.functions import JSONObject
+from django.http import Http404
+
+from aiCoach.chat_session import aget_chat_session, get_chat_session
+from aiCoach.log import log_payload
+from aiCoach.metrics import observe_phase
+from aiCoach.models import (
+    ConversationMessage,
+    User,
+    UserCallStatementsWithLevel,
+    UserConversationHistory,
+    UserGoal,
+    UserPerformanceData,
+)
+from aiCoach.serializers import (
+    ConversationStateSerializer,
+    UserCallStatementsWithLevelSerializer,
+    UserGoalSerializer,
+    UserPerformanceDataSerializer,
+)
+from aiCoach.utils import CHAT_API, format_dict
+
+logger = logging.getLogger(__name__)
+
+# GROW steps in order, with the conversation flag that marks each one as completed
+COACHING_STEPS = [
+    ('GOAL', 'isGoalStepCompleted'),
+    ('REALITY', 'isRealityStepCompleted'),
+    ('OPTIONS', 'isOptionStepCompleted'),
+    ('OPTION_IMPROVEMENT', 'isOptionImprovementStepCompleted'),
+    ('WILL', 'isWillStepCompleted'),
+]
+
+# Steps whose prompt includes the level definitions of the goal's category
+CATEGORY_LEVEL_STEPS = ["OPTIONS", "OPTION_IMPROVEMENT"]
+
+# Number of most recent messages loaded for the coaching prompt (a turn is a user and a
+# coach message); the prompt keeps as many of them as fit its token budget
+RECENT_MESSAGES_WINDOW = 2 * CHAT_API["CONVERSATION_BUFFER_WINDOW_SIZE"]
+
+# Conversation state used when a chat has no stored history yet
+NEW_CONVERSATION = {
+    "summary": {},
+    "chat_label": "",
+    "isGoalStepCompleted": False,
+    "isRealityStepCompleted": False,
+    "isOptionStepCompleted": False,
+    "isOptionImprovementStepCompleted": False,
+    "isWillStepCompleted": False,
+}
+
+
+@dataclass
+class CoachingContext:
+    """
+    Everything a coaching turn needs, loaded in a single round trip by
+    `load_coaching_context`. Prompt templates and the category level
+    definitions come from the prompt caches.
+    """
+    user: User
+    chat_id: str
+    conversation: dict  # Serialized conversation state (NEW_CONVERSATION for a new chat)
+    recent_messages: List[ConversationMessage]  # Last RECENT_MESSAGES_WINDOW messages, oldest first
+    chat_history: List[str]  # Recent "User: ..." / "Coach: ..." lines for the prompt
+    goal: str  # Goal formatted for the prompt
+    goal_category: Optional[str]
+    performance_data: dict  # {"skills": ..., "last_call": ...}
+
+    @property
+    def user_name(self):
+        return f"{self.user.first_name} {self.user.last_name}"
+
+    @property
+    def pending_step(self):
+        """
+        The first GROW step that is not completed yet, or None when the coaching
+        session is over.
+        """
+        for step_type, step_key in COACHING_STEPS:
+            if not self.conversation[step_key]:
+                return step_type
+        return None
+
+
+def load_coaching_context(user_id, chat_id):
+    """
+    Loads the coaching context for a chat turn with one SQL statement: the user
+    row with the active goal, call statements, performance data and the chat's
+    conversation attached as JSON subqueries. Raises Http404 if the user does not exist.
+
+    For a chat in the session cache the conversation and recent messages come
+    from the cache instead, so they include turns the Celery save has not
+    persisted yet.
+    """
+    with observe_phase("context"):
+        session = get_chat_session(user_id, chat_id)
+        user = coaching_context_queryset(user_id, chat_id, include_chat=session is None).first()
+    if user is None:
+        raise Http404("No User matches the given query.")
+    return build_coaching_context(user, chat_id, session)
+
+
+async def aload_coaching_context(user_id, chat_id):
+    """
+    Async variant of `load_coaching_context`.
+    """
+    with observe_phase("context"):
+        session = await aget_chat_session(user_id, chat_id)
+        user = await coaching_context_queryset(user_id, chat_id, include_chat=session is None).afirst()
+    if user is None:
+        raise Http404("No User matches the given query.")
+    return build_coaching_context(user, chat_id, session)
+
+
+def coaching_context_queryset(user_id, chat_id, include_chat=True):
+    active_goal = UserGoal.objects.filter(user=OuterRef('pk'), is_active=True).order_by('id')
+
+    annotations = dict(
+        goal_row=Subquery(active_goal.values(row=json_row(UserGoal))[:1]),
+        call_statement_rows=ArraySubquery(
+            UserCallStatementsWithLevel.objects.filter(user=OuterRef('pk'), is_active=True)
+            .order_by('id').values(row=json_row(UserCallStatementsWithLevel))
+        ),
+        performance_data_rows=ArraySubquery(
+            UserPerformanceData.objects.filter(user=OuterRef('pk'), is_active=True)
+            .order_by('id').values(row=json_row(UserPerformanceData))
+        ),
+    )
+    if include_chat:
+        annotations.update(
+            conversation_row=Subquery(
+                UserConversationHistory.objects.filter(user=OuterRef('pk'), chat_id=chat_id, is_active=True)
+                .values(row=json_row(UserConversationHistory))[:1]
+            ),
+            # Backward range scan on the (chat, sequence) index
+            recent_message_rows=ArraySubquery(
+                ConversationMessage.objects.filter(chat__user=OuterRef('pk'), chat__chat_id=chat_id, chat__is_active=True)
+                .order_by('-sequence').values(row=json_row(ConversationMessage))[:RECENT_MESSAGES_WINDOW]
+            ),
+        )
+
+    return User.objects.filter(id=user_id).annotate(**annotations)
+
+
+def json_row(model):
+    """
+    A JSON object expression with all concrete fields of a model row.
+    """
+    return JSONObject(**{model_field.attname: model_field.attname for model_field in model._meta.concrete_fields})
+
+
+def instance_from_row(model, row):
+    """
+    Rebuilds a model instance from a `json_row` object, converting the JSON
+    values (ISO datetimes, UUID strings, ...) back to their Python types.
+    """
+    if row is None:
+        return None
+    return model(**values_from_row(model, row))
+
+
+def values_from_row(model, row):
+    return {
+        model_field.attname: model_field.to_python(row[model_field.attname])
+        for model_field in model._meta.concrete_fields
+    }
+
+
+def build_coaching_context(user, chat_id, session=None):
+    """
+    Builds the CoachingContext from a row of `coaching_context_queryset` and
+    the cached chat session, if any (no DB access).
+    """
+    goal = instance_from_row(UserGoal, user.goal_row)
+    call_statements = [instance_from_row(UserCallStatementsWithLevel, row) for row in user.call_statement_rows]
+    performance_data = [instance_from_row(UserPerformanceData, row) for row in user.performance_data_rows]
+
+    if session is not None:
+        conversation = session["conversation"]
+        recent_messages = [ConversationMessage(**message) for message in session["recent_messages"]]
+    else:
+        conversation_history = instance_from_row(UserConversationHistory, user.conversation_row)
+        recent_messages = [instance_from_row(ConversationMessage, row) for row in reversed(user.recent_message_rows)]
+
+        # Check if conversation history is empty
+        if conversation_history is None:
+            logger.debug("No conversation history found, starting new session for chat_id: %s", chat_id)
+            conversation = dict(NEW_CONVERSATION)
+        else:
+            conversation = ConversationStateSerializer(conversation_history).data
+
+    # Format the recent messages for the prompt
+    chat_history = [f"{message.get_role_display()}: {message.text}" for message in recent_messages]
+    log_payload(logger, "Chat %s conversation: %s, history: %s", chat_id, conversation, chat_history)
+
+    # Format call statements, user goal, and performance data
+    call_statements = UserCallStatementsWithLevelSerializer(call_statements, many=True).data
+    user_goal = format_dict(UserGoalSerializer(goal).data)
+    user_performance_data = format_dict(UserPerformanceDataSerializer(performance_data, many=True).data)
+
+    log_payload(logger, "User goal: %s performance data: %s", user_goal, user_performance_data)
+
+    return CoachingContext(
+        user=user,
+        chat_id=chat_id,
+        conversation=conversation,
+        recent_messages=recent_messages,
+        chat_history=chat_history,
+        goal=user_goal,
+        goal_category=goal.category if goal else None,
+        performance_data={
+            "skills": user_performance_data,
+            "last_call": call_statements,
+        },
+    )
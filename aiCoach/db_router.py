@@ -0,0 +1,106 @@
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+
+REPLICA_DB_ALIAS = 'replica'
+
+# Alias that reads in the current block go to; None means the default database
+READ_DB_ALIAS = ContextVar('read_db_alias', default=None)
+
+# Sticky scope of reference data (categories, levels, examples, coaching prompts)
+REFERENCE_DATA = 'reference'
+
+
+class ReplicaRouter:
+    """
+    Sends reads to the read replica only inside `replica_reads` blocks (the
+    read-only views), so everything else, e.g. the Celery saves that read and
+    write in one transaction, keeps using the primary. Writes and migrations
+    always go to the primary.
+    """
+
+    def db_for_read(self, model, **hints):
+        return READ_DB_ALIAS.get()
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replica holds the same data as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == DEFAULT_DB_ALIAS
+
+
+def replica_configured():
+    return REPLICA_DB_ALIAS in settings.DATABASES
+
+
+def sticky_key(scope):
+    return f"aicoach:db-primary:{scope}"
+
+
+def mark_primary(*scopes):
+    """
+    Keeps reads of the given scopes (e.g. "user:5", "chat:<uuid>") on the primary
+    for DATABASE_REPLICA_STICKY_SECONDS, so a user reads their own writes while
+    the replica catches up.
+    """
+    if not replica_configured():
+        return
+    cache.set_many({sticky_key(scope): True for scope in scopes}, timeout=settings.DATABASE_REPLICA_STICKY_SECONDS)
+
+
+@contextmanager
+def replica_reads(*scopes):
+    """
+    Routes the reads of the block to the replica, unless one of the scopes
+    was written within the sticky window (see `mark_primary`).
+    """
+    alias = None
+    if replica_configured():
+        sticky = scopes and cache.get_many([sticky_key(scope) for scope in scopes])
+        alias = DEFAULT_DB_ALIAS if sticky else REPLICA_DB_ALIAS
+    token = READ_DB_ALIAS.set(alias)
+    try:
+        yield
+    finally:
+        READ_DB_ALIAS.reset(token)
+
+
+def scope_id(value):
+    """
+    The id of a scope in the form the save signals use for it (`str(pk)`,
+    `str(chat_id)`), so e.g. an upper-case chat UUID in a URL matches.
+    """
+    value = str(value)
+    try:
+        return str(uuid.UUID(value))
+    except ValueError:
+        return str(int(value)) if value.isdigit() else value
+
+
+def read_from_replica(*scopes, **request_scopes):
+    """
+    View decorator running the view in `replica_reads`. Scopes are given as
+    they are, or as scope=name of a view kwarg or query parameter, e.g.
+    `read_from_replica(user='user_id')` for the scope "user:<user_id of the URL>".
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            view_scopes = scopes
+            for scope, name in request_scopes.items():
+                value = kwargs.get(name, request.GET.get(name))
+                if value is not None:
+                    view_scopes += (f"{scope}:{scope_id(value)}",)
+            with replica_reads(*view_scopes):
+                return view(request, *args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,184 @@
+import asyncio
+import hashlib
+import random
+import re
+import threading
+import time
+from typing import Any, AsyncIterator, Iterator, List, Optional
+
+import httpx
+import openai
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+from aiCoach.outputParser import ChatLabelParser, ChatLabelsParser, ChatParser
+
+# Characters per streamed chunk (about one token)
+CHUNK_SIZE = 4
+
+STEP_FLAGS = [name for name in ChatParser.model_fields if name.endswith('StepCompleted')]
+
+FAKE_REPLIES = [
+    "Thanks for sharing that. What would you like to focus on in your next call?",
+    "That sounds like a good start. What made the opening of that call work well?",
+    "Let's look at the options you have. Which one feels most natural to you?",
+    "How could you adapt that question so the customer talks more?",
+    "Great plan. When will you try it, and how will you know it worked?",
+]
+
+CHAT_ID_LINE = re.compile(r"Chat ID: (\S+)")
+
+
+class LatencyDistribution:
+    """
+    Response latency in seconds, parsed from a spec such as "fixed:0.8",
+    "uniform:0.3,1.5", "normal:1.0,0.25" or "lognormal:-0.2,0.5" (mu and sigma
+    of the underlying normal). Negative samples are clamped to zero.
+    """
+
+    def __init__(self, spec):
+        kind, _, args = spec.partition(':')
+        values = [float(value) for value in args.split(',') if value] or [0.0]
+        if kind not in ('fixed', 'uniform', 'normal', 'lognormal'):
+            raise ValueError(f"Unknown latency distribution: {spec}")
+        self.kind = kind
+        self.values = values
+
+    def sample(self, rng):
+        if self.kind == 'fixed':
+            return self.values[0]
+        if self.kind == 'uniform':
+            return rng.uniform(*self.values)
+        if self.kind == 'normal':
+            return max(0.0, rng.gauss(*self.values))
+        return rng.lognormvariate(*self.values)
+
+
+class FakeChatModel(BaseChatModel):
+    """
+    Offline chat model for load tests and CI. Replies are schema-valid JSON for
+    the coaching (ChatParser) and label (ChatLabelsParser) prompts, recognised
+    by their `response_format` or the format instructions in the prompt, and
+    plain text for anything else (e.g. summaries). The content depends only on the
+    prompt, so the same prompt always gets the same reply. Latency is sampled
+    from `latency` before the first token, then every streamed chunk takes
+    `token_delay`; `error_rate` of the calls raise an OpenAI-style `error`.
+    """
+    latency: str = "fixed:0"
+    token_delay: float = 0.0
+    error_rate: float = 0.0
+    error: str = "rate_limit"  # "rate_limit", "timeout" or "server"
+    step_completion_rate: float = 0.3  # Share of coaching replies that complete a GROW step
+    seed: Optional[int] = None
+
+    def model_post_init(self, __context: Any) -> None:
+        self._latency = LatencyDistribution(self.latency)
+        self._rng = random.Random(self.seed)  # Latency and error draws
+        self._lock = threading.Lock()
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat"
+
+    def get_num_tokens(self, text: str) -> int:
+        # Same estimate as used for the fake usage metadata, no tokenizer download needed
+        return -(-len(text) // CHUNK_SIZE)
+
+    def get_num_tokens_from_messages(self, messages: List[BaseMessage], tools=None) -> int:
+        return sum(self.get_num_tokens(message.content) for message in messages)
+
+    def reply(self, prompt, response_format=None):
+        """
+        The reply content for a prompt.
+        """
+        rng = random.Random(hashlib.sha256(prompt.encode()).digest())
+        schema = (response_format or {}).get("json_schema", {}).get("name")
+
+        if schema == ChatLabelsParser.__name__ or '"chatLabel"' in prompt:
+            labels = [
+                ChatLabelParser(chatId=chat_id, chatLabel=f"Coaching session {index + 1}")
+                for index, chat_id in enumerate(CHAT_ID_LINE.findall(prompt))
+            ]
+            return ChatLabelsParser(labels=labels).model_dump_json()
+
+        if schema == ChatParser.__name__ or '"message"' in prompt:
+            flags = {}
+            if rng.random() < self.step_completion_rate:
+                flags[rng.choice(STEP_FLAGS)] = True
+            return ChatParser(message=rng.choice(FAKE_REPLIES), **flags).model_dump_json()
+
+        return "The user and the coach discussed the user's goal and the next steps. " + rng.choice(FAKE_REPLIES)
+
+    def draw(self):
+        """
+        Samples the latency of a call and raises the injected error, if any.
+        """
+        with self._lock:
+            latency = self._latency.sample(self._rng)
+            failed = self._rng.random() < self.error_rate
+        return latency, failed
+
+    def make_error(self):
+        request = httpx.Request("POST", "https://fake-llm.local/chat/completions")
+        if self.error == "timeout":
+            return openai.APITimeoutError(request=request)
+        status_code = 429 if self.error == "rate_limit" else 500
+        response = httpx.Response(status_code, request=request)
+        error_class = openai.RateLimitError if status_code == 429 else openai.InternalServerError
+        return error_class(f"Injected fake LLM error ({self.error})", response=response, body=None)
+
+    def result(self, prompt, content):
+        input_tokens, output_tokens = self.get_num_tokens(prompt), self.get_num_tokens(content)
+        message = AIMessage(content=content, usage_metadata={
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "total_tokens": input_tokens + output_tokens,
+        })
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        prompt = "\n".join(message.content for message in messages)
+        content = self.reply(prompt, kwargs.get("response_format"))
+        latency, failed = self.draw()
+        time.sleep(latency + self.token_delay * self.get_num_tokens(content))
+        if failed:
+            raise self.make_error()
+        return self.result(prompt, content)
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        prompt = "\n".join(message.content for message in messages)
+        content = self.reply(prompt, kwargs.get("response_format"))
+        latency, failed = self.draw()
+        await asyncio.sleep(latency + self.token_delay * self.get_num_tokens(content))
+        if failed:
+            raise self.make_error()
+        return self.result(prompt, content)
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs) -> Iterator[ChatGenerationChunk]:
+        prompt = "\n".join(message.content for message in messages)
+        content = self.reply(prompt, kwargs.get("response_format"))
+        latency, failed = self.draw()
+        time.sleep(latency)
+        if failed:
+            raise self.make_error()
+        for start in range(0, len(content), CHUNK_SIZE):
+            time.sleep(self.token_delay)
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=content[start:start + CHUNK_SIZE]))
+            if run_manager:
+                run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs) -> AsyncIterator[ChatGenerationChunk]:
+        prompt = "\n".join(message.content for message in messages)
+        content = self.reply(prompt, kwargs.get("response_format"))
+        latency, failed = self.draw()
+        await asyncio.sleep(latency)
+        if failed:
+            raise self.make_error()
+        for start in range(0, len(content), CHUNK_SIZE):
+            await asyncio.sleep(self.token_delay)
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=content[start:start + CHUNK_SIZE]))
+            if run_manager:
+                await run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
@@ -0,0 +1,92 @@
+import logging
+from functools import lru_cache
+
+import tiktoken
+from django.conf import settings
+
+from aiCoach.utils import CHAT_API
+
+logger = logging.getLogger(__name__)
+
+# Rough tokens-per-character ratio, used only if the tiktoken encoding cannot be loaded
+FALLBACK_CHARS_PER_TOKEN = 4
+
+TRUNCATION_MARKER = " ..."
+
+
+@lru_cache(maxsize=None)
+def get_encoding():
+    """
+    The tiktoken encoding of the configured model, loaded once per process.
+    Returns None if it cannot be loaded (tiktoken downloads it on first use).
+    """
+    try:
+        try:
+            return tiktoken.encoding_for_model(CHAT_API["MODEL_NAME"])
+        except KeyError:
+            # Model name unknown to tiktoken (e.g. a custom deployment name)
+            return tiktoken.get_encoding("o200k_base")
+    except Exception as error:
+        logger.warning("tiktoken encoding unavailable, estimating tokens: %s", error)
+        return None
+
+
+def count_tokens(text):
+    encoding = get_encoding()
+    if encoding is None:
+        return -(-len(text) // FALLBACK_CHARS_PER_TOKEN)
+    return len(encoding.encode(text))
+
+
+def truncate_to_tokens(text, max_tokens):
+    """
+    Cuts `text` down to at most `max_tokens` tokens, marking the cut.
+    """
+    if count_tokens(text) <= max_tokens:
+        return text
+    budget = max_tokens - count_tokens(TRUNCATION_MARKER)
+    if budget <= 0:
+        return ""
+    encoding = get_encoding()
+    if encoding is None:
+        return text[:budget * FALLBACK_CHARS_PER_TOKEN] + TRUNCATION_MARKER
+    return encoding.decode(encoding.encode(text)[:budget]) + TRUNCATION_MARKER
+
+
+def history_token_budget(step_type):
+    """
+    Token budget of the conversation history in the prompt of a coaching step.
+    """
+    return settings.CHAT_HISTORY_STEP_MAX_TOKENS.get(step_type, CHAT_API["TRIM_MAX_TOKENS"])
+
+
+def build_conversation_history(chat_history, summary, max_tokens, has_earlier_messages=False):
+    """
+    Assembles the conversation history for a prompt within `max_tokens`.
+    Recent lines ("User: ...", "Coach: ...") are added from newest to oldest
+    until the budget is used; if any are left out (or `has_earlier_messages`
+    says older ones were never loaded), the stored rolling summary of the
+    earlier conversation takes their place. A newest line that alone exceeds
+    the budget is truncated, so the bound holds for pasted walls of text.
+    """
+    lines = []
+    used = 0
+    for line in reversed(chat_history):
+        tokens = count_tokens(line) + 1  # Plus the newline separator
+        if used + tokens > max_tokens:
+            if not lines:
+                lines.append(truncate_to_tokens(line, max_tokens - 1))
+                used = max_tokens
+            break
+        lines.append(line)
+        used += tokens
+    lines.reverse()
+
+    summary_text = (summary or {}).get("moving_summary_buffer", "")
+    if (has_earlier_messages or len(lines) < len(chat_history)) and summary_text:
+        # Whatever budget the recent lines left is available for the summary
+        summary_text = truncate_to_tokens(f"Summary of the earlier conversation: {summary_text}", max_tokens - used - 1)
+        if summary_text:
+            lines.insert(0, summary_text)
+
+    return "\n".join(lines)
@@ -0,0 +1,112 @@
+import hashlib
+import json
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from langchain_core.messages import AIMessage
+
+from aiCoach.cache import LocalLRUCache
+from aiCoach.metrics import LLM_RESPONSE_CACHE_TOTAL
+from aiCoach.utils import CHAT_API
+
+
+class LLMResponseCache:
+    """
+    Caches LLM replies by a hash of the fully rendered prompt and the model
+    settings, in a process-local LRU in front of the shared cache (Redis), both
+    with a TTL. Only used for prompts that are opted in by the caller, such as
+    the opening turn of a chat, whose prompt depends only on the user's data
+    and the prompt version.
+    """
+
+    def __init__(self, namespace, maxsize=256, timeout=3600):
+        self.namespace = namespace
+        self.timeout = timeout
+        self.local = LocalLRUCache(maxsize)  # key -> (expires_at, content)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, prompt):
+        model_settings = {
+            name: CHAT_API[name] for name in ("MODEL_DEPLOYMENT", "MODEL_NAME", "TEMPERATURE", "MAX_TOKENS")
+        }
+        payload = json.dumps({"model": model_settings, "prompt": prompt}, sort_keys=True, default=str)
+        return f"aicoach:{self.namespace}:{hashlib.sha256(payload.encode()).hexdigest()}"
+
+    def get(self, prompt):
+        """
+        Returns the cached reply content for `prompt`, or None, and counts the hit or miss.
+        """
+        key = self.key(prompt)
+        entry = self.local.get(key)
+        content = entry[1] if entry is not None and entry[0] > time.monotonic() else None
+
+        if content is None:
+            content = cache.get(key)
+            if content is not None:
+                self.local.set(key, (time.monotonic() + self.timeout, content))
+
+        with self.lock:
+            if content is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        LLM_RESPONSE_CACHE_TOTAL.labels("miss" if content is None else "hit").inc()
+        return content
+
+    def set(self, prompt, content):
+        key = self.key(prompt)
+        cache.set(key, content, timeout=self.timeout)
+        self.local.set(key, (time.monotonic() + self.timeout, content))
+
+    def invoke(self, prompt, invoke):
+        """
+        `invoke(prompt)` (an LLM call returning a message) served from the cache when possible.
+        """
+        content = self.get(prompt)
+        if content is None:
+            content = invoke(prompt).content
+            self.set(prompt, content)
+        return AIMessage(content=content)
+
+    async def ainvoke(self, prompt, ainvoke):
+        """
+        Async variant of `invoke`.
+        """
+        content = await sync_to_async(self.get)(prompt)
+        if content is None:
+            content = (await ainvoke(prompt)).content
+            await sync_to_async(self.set)(prompt, content)
+        return AIMessage(content=content)
+
+    def stats(self):
+        """
+        Hit and miss counters of this process.
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+# Replies of opted-in coaching steps (settings.LLM_RESPONSE_CACHE_STEPS)
+LLM_RESPONSE_CACHE = LLMResponseCache(
+    'llm-response',
+    maxsize=settings.LLM_RESPONSE_CACHE_SIZE,
+    timeout=settings.LLM_RESPONSE_CACHE_TIMEOUT,
+)
+
+
+def is_cacheable_turn(step_type, user_message):
+    """
+    Only opening turns (no user message yet) of opted-in steps are cached:
+    their prompt repeats for every new chat a user opens.
+    """
+    return step_type in settings.LLM_RESPONSE_CACHE_STEPS and not (user_message and user_message.strip())
@@ -0,0 +1,138 @@
+import logging
+import os
+from functools import lru_cache
+
+import httpx
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+# Chat model factories by LLM_BACKEND name. LLM_BACKEND may also be the dotted
+# path of a custom factory. A factory takes the CHAT_API settings and returns a
+# LangChain chat model.
+LLM_BACKENDS = {
+    'azure': 'aiCoach.llm_backends.azure_chat_model',
+    'fake': 'aiCoach.llm_backends.fake_chat_model',
+    'router': 'aiCoach.llm_backends.router_chat_model',
+}
+
+logger = logging.getLogger(__name__)
+
+
+def create_chat_model(chat_api, backend=None):
+    backend = backend or settings.LLM_BACKEND
+    factory = import_string(LLM_BACKENDS.get(backend, backend))
+    logger.info("LLM backend: %s", backend)
+    return factory(chat_api)
+
+
+def http_client_options():
+    return {
+        "limits": httpx.Limits(
+            max_connections=settings.LLM_HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=settings.LLM_HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=settings.LLM_HTTP_KEEPALIVE_EXPIRY,
+        ),
+        "timeout": httpx.Timeout(settings.LLM_REQUEST_TIMEOUT, connect=10.0),
+    }
+
+
+@lru_cache(maxsize=None)
+def shared_http_client():
+    """
+    The process's keep-alive connection pool for LLM API calls, shared by all
+    chat models so calls reuse open TLS connections. Connections are opened by
+    the first call, so a parent process that makes no LLM calls (Celery
+    prefork, gunicorn --preload) hands an empty pool to its forked workers.
+    """
+    return httpx.Client(**http_client_options())
+
+
+@lru_cache(maxsize=None)
+def shared_async_http_client():
+    """
+    Async variant of `shared_http_client`, for `ainvoke` under ASGI.
+    """
+    return httpx.AsyncClient(**http_client_options())
+
+
+def azure_chat_model(chat_api):
+    from langchain_openai import AzureChatOpenAI
+
+    return AzureChatOpenAI(
+        azure_deployment=chat_api["MODEL_DEPLOYMENT"],
+        azure_endpoint=chat_api["OPENAI_ENDPOINT"],
+        openai_api_version=chat_api["OPENAI_API_VERSION"],
+        model=chat_api["MODEL_NAME"],
+        temperature=chat_api["TEMPERATURE"],
+        max_tokens=chat_api["MAX_TOKENS"],
+        http_client=shared_http_client(),
+        http_async_client=shared_async_http_client(),
+        request_timeout=settings.LLM_REQUEST_TIMEOUT,
+        **({"api_key": os.getenv(chat_api["API_KEY_ENV"])} if chat_api.get("API_KEY_ENV") else {}),
+    )
+
+
+def fake_chat_model(chat_api):
+    """
+    Offline deterministic model (aiCoach/fake_llm.py), configured by the FAKE_LLM_* settings
+    (or the same keys in `chat_api`, e.g. for fake deployments of the router).
+    """
+    from aiCoach.fake_llm import FakeChatModel
+
+    def option(name):
+        return chat_api.get(name, getattr(settings, name))
+
+    return FakeChatModel(
+        latency=option("FAKE_LLM_LATENCY"),
+        token_delay=option("FAKE_LLM_TOKEN_DELAY"),
+        error_rate=option("FAKE_LLM_ERROR_RATE"),
+        error=option("FAKE_LLM_ERROR"),
+        step_completion_rate=option("FAKE_LLM_STEP_COMPLETION_RATE"),
+        seed=option("FAKE_LLM_SEED"),
+    )
+
+
+def router_chat_model(chat_api):
+    """
+    Latency-weighted, hedged routing over the deployments of LLM_DEPLOYMENTS
+    (aiCoach/llm_router.py). Each deployment is created by its own backend
+    with its keys overriding `chat_api`. A deployment with any of RATE_LIMIT_RPM,
+    RATE_LIMIT_TPM or MAX_CONCURRENCY gets its own rate limiter for its quota.
+    """
+    from aiCoach.llm_router import DeploymentRouterChatModel
+    from aiCoach.rate_limit import LLM_RATE_LIMITER, LLMRateLimiter
+
+    deployments = [dict(deployment) for deployment in settings.LLM_DEPLOYMENTS]
+    if not deployments:
+        raise ImproperlyConfigured("LLM_BACKEND 'router' needs at least one deployment in LLM_DEPLOYMENTS")
+    names = [deployment.pop("name", deployment.get("MODEL_DEPLOYMENT")) for deployment in deployments]
+    if None in names or len(set(names)) < len(names):
+        # Latency stats and quotas are kept by name
+        raise ImproperlyConfigured(f"LLM_DEPLOYMENTS need unique names (a name or MODEL_DEPLOYMENT), got {names}")
+
+    limiters = []
+    for name, deployment in zip(names, deployments):
+        limits = {
+            "rpm": deployment.pop("RATE_LIMIT_RPM", None),
+            "tpm": deployment.pop("RATE_LIMIT_TPM", None),
+            "max_concurrency": deployment.pop("MAX_CONCURRENCY", None),
+        }
+        if any(limit is not None for limit in limits.values()):
+            # Unset limits of a deployment are off, not the shared LLM_RATE_LIMIT_* values
+            limiters.append(LLMRateLimiter(f"llm-quota:{name}", **{key: value or 0 for key, value in limits.items()}))
+        else:
+            limiters.append(None)
+
+    return DeploymentRouterChatModel(
+        names=names,
+        deployments=[
+            create_chat_model({**chat_api, **deployment}, deployment.pop("backend", 'azure'))
+            for deployment in deployments
+        ],
+        limiters=limiters,
+        hedge_limiter=LLM_RATE_LIMITER,
+        hedge_percentile=settings.LLM_ROUTER_HEDGE_PERCENTILE,
+        hedge_delay=settings.LLM_ROUTER_HEDGE_DELAY,
+        min_samples=settings.LLM_ROUTER_MIN_SAMPLES,
+    )
@@ -0,0 +1,304 @@
+import asyncio
+import contextvars
+import logging
+import math
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import ExitStack, nullcontext
+from functools import lru_cache
+from typing import Any, AsyncIterator, Iterator, List, Optional
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.outputs import ChatGenerationChunk, ChatResult
+
+from aiCoach.metrics import LLM_DEPLOYMENT_REQUESTS_TOTAL, LLM_HEDGED_REQUESTS_TOTAL, LLM_HEDGES_SKIPPED_TOTAL
+from aiCoach.rate_limit import HEDGE
+
+logger = logging.getLogger(__name__)
+
+
+class DeploymentStats:
+    """
+    Recent latencies of one deployment: a moving average for weighting and a
+    window of samples for the hedge percentile. Failed calls count as the
+    request timeout, so a failing deployment loses its traffic quickly.
+    """
+
+    def __init__(self, samples, smoothing):
+        self.samples = deque(maxlen=samples)
+        self.smoothing = smoothing
+        self.average = None
+        self.lock = threading.Lock()
+
+    def record(self, seconds):
+        with self.lock:
+            self.samples.append(seconds)
+            if self.average is None:
+                self.average = seconds
+            else:
+                self.average = self.smoothing * seconds + (1 - self.smoothing) * self.average
+
+    def percentile(self, share):
+        with self.lock:
+            samples = sorted(self.samples)
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, math.ceil(share * len(samples)) - 1)]
+
+
+@lru_cache(maxsize=None)
+def hedge_executor():
+    # Runs the sync calls of a hedged pair; a losing call cannot be interrupted
+    # and finishes here, its reply is discarded
+    return ThreadPoolExecutor(max_workers=settings.LLM_HTTP_MAX_CONNECTIONS, thread_name_prefix='llm-hedge')
+
+
+def submit_in_context(executor, fn, *args, **kwargs):
+    # Runs `fn` with the caller's contextvars (request timings, callbacks), as the async path does
+    return executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+class DeploymentRouterChatModel(BaseChatModel):
+    """
+    Spreads calls over several deployments of the same model (e.g. regions),
+    picking one at random weighted by the inverse of its recent latency, so
+    a slow region gets less traffic. `invoke`/`ainvoke` are hedged: if the
+    chosen deployment has not answered within the `hedge_percentile` of its
+    recent latencies (`hedge_delay` until it has `min_samples`), the same
+    request is sent to a second deployment and the first reply wins; the
+    losing async call is cancelled. A call that fails is retried on the second
+    deployment right away. Streams go to one deployment and are not hedged.
+
+    A hedge is an extra request against the quota, so it is only sent if
+    quota for it can be taken right away, with the `hedge` priority, from
+    `hedge_limiter` (the shared LLM quota) and from the target's own limiter
+    in `limiters`, if it has one. Deployments with a limiter also wait for
+    it before their first request.
+    """
+    deployments: List[BaseChatModel]
+    names: List[str]
+    limiters: List[Any] = []  # LLMRateLimiter or None, per deployment
+    hedge_limiter: Any = None
+    hedge_percentile: float = 0.95  # 0 turns hedging off
+    hedge_delay: float = 2.0
+    min_samples: int = 10
+    latency_samples: int = 100
+    smoothing: float = 0.2
+    seed: Optional[int] = None
+
+    def model_post_init(self, __context: Any) -> None:
+        self._stats = {name: DeploymentStats(self.latency_samples, self.smoothing) for name in self.names}
+        self._rng = random.Random(self.seed)
+        self._lock = threading.Lock()
+
+    @property
+    def _llm_type(self) -> str:
+        return "deployment-router"
+
+    def get_num_tokens(self, text: str) -> int:
+        return self.deployments[0].get_num_tokens(text)
+
+    def get_num_tokens_from_messages(self, messages, tools=None) -> int:
+        return self.deployments[0].get_num_tokens_from_messages(messages)
+
+    def weights(self, candidates):
+        averages = [self._stats[self.names[index]].average for index in candidates]
+        known = [average for average in averages if average is not None]
+        # Deployments without calls yet count as the fastest, so they get tried
+        fastest = min(known, default=1.0)
+        return [1 / max(average if average is not None else fastest, 0.001) for average in averages]
+
+    def pick(self, exclude=None):
+        """
+        Index of a deployment chosen at random by latency weight.
+        """
+        candidates = [index for index in range(len(self.deployments)) if index != exclude]
+        if not candidates:
+            return None
+        weights = self.weights(candidates)
+        with self._lock:
+            return self._rng.choices(candidates, weights)[0]
+
+    def hedge_after(self, index):
+        """
+        Seconds to wait for deployment `index` before hedging, or None to not hedge.
+        """
+        if not self.hedge_percentile or len(self.deployments) < 2:
+            return None
+        stats = self._stats[self.names[index]]
+        if len(stats.samples) < self.min_samples:
+            return self.hedge_delay
+        return stats.percentile(self.hedge_percentile)
+
+    def limiter(self, index):
+        return self.limiters[index] if self.limiters else None
+
+    def deployment_limit(self, index, messages):
+        limiter = self.limiter(index)
+        return limiter.limit(self.get_num_tokens_from_messages(messages)) if limiter else nullcontext()
+
+    def adeployment_limit(self, index, messages):
+        limiter = self.limiter(index)
+        return limiter.alimit(self.get_num_tokens_from_messages(messages)) if limiter else nullcontext()
+
+    def hedge_quota(self, index, messages):
+        """
+        Takes quota for a hedged request to deployment `index` without waiting.
+        Returns a context whose exit gives back its concurrency slots, or None
+        (and no hedge is sent) if a quota is used up.
+        """
+        tokens = self.get_num_tokens_from_messages(messages)
+        quota = ExitStack()
+        for limiter in (self.limiter(index), self.hedge_limiter):
+            if limiter is not None and not quota.enter_context(limiter.try_limit(tokens, HEDGE)):
+                quota.close()
+                LLM_HEDGES_SKIPPED_TOTAL.labels(self.names[index]).inc()
+                return None
+        return quota
+
+    def record(self, index, started, outcome):
+        name = self.names[index]
+        elapsed = time.perf_counter() - started
+        # A failure counts as the slowest possible call; a cancelled call was at least this slow
+        self._stats[name].record(settings.LLM_REQUEST_TIMEOUT if outcome == "error" else elapsed)
+        LLM_DEPLOYMENT_REQUESTS_TOTAL.labels(name, outcome).inc()
+
+    def call(self, index, messages, stop, quota=None, **kwargs):
+        # `quota` is the hedge's, taken beforehand; first requests wait for the deployment's
+        with quota or self.deployment_limit(index, messages):
+            return self.timed_call(index, messages, stop, **kwargs)
+
+    def timed_call(self, index, messages, stop, **kwargs):
+        started = time.perf_counter()
+        try:
+            result = self.deployments[index]._generate(messages, stop=stop, **kwargs)
+        except Exception:
+            self.record(index, started, "error")
+            raise
+        self.record(index, started, "success")
+        return result
+
+    async def acall(self, index, messages, stop, quota=None, **kwargs):
+        if quota is None:
+            async with self.adeployment_limit(index, messages):
+                return await self.timed_acall(index, messages, stop, **kwargs)
+        try:
+            return await self.timed_acall(index, messages, stop, **kwargs)
+        finally:
+            await sync_to_async(quota.close, thread_sensitive=False)()
+
+    async def timed_acall(self, index, messages, stop, **kwargs):
+        started = time.perf_counter()
+        try:
+            result = await self.deployments[index]._agenerate(messages, stop=stop, **kwargs)
+        except asyncio.CancelledError:
+            self.record(index, started, "cancelled")
+            raise
+        except Exception:
+            self.record(index, started, "error")
+            raise
+        self.record(index, started, "success")
+        return result
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        primary = self.pick()
+        delay = self.hedge_after(primary)
+        if delay is None:
+            return self.call(primary, messages, stop, **kwargs)
+
+        executor = hedge_executor()
+        calls = {submit_in_context(executor, self.call, primary, messages, stop, **kwargs): "primary"}
+        hedged = False
+        done, _ = wait(calls, timeout=delay)
+        while True:
+            if not hedged and (not done or any(future.exception() for future in done)):
+                # Too slow or failed: send the request to a second deployment, if there is quota for it
+                hedged = True
+                secondary = self.pick(exclude=primary)
+                quota = self.hedge_quota(secondary, messages)
+                if quota is not None:
+                    logger.debug("Hedging call to %s with %s", self.names[primary], self.names[secondary])
+                    calls[submit_in_context(executor, self.call, secondary, messages, stop, quota=quota, **kwargs)] = "hedge"
+            succeeded = [future for future in calls if future.done() and not future.exception()]
+            if succeeded:
+                winner = succeeded[0]
+                if len(calls) > 1:
+                    LLM_HEDGED_REQUESTS_TOTAL.labels(calls[winner]).inc()
+                for future, request in calls.items():
+                    if future.cancel() and request == "hedge":
+                        quota.close()  # The hedge never started, so it did not give its quota back
+                return winner.result()
+            if all(future.done() for future in calls):
+                # Every deployment tried failed
+                raise list(calls)[-1].exception()
+            done, _ = wait([future for future in calls if not future.done()], return_when=FIRST_COMPLETED)
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        primary = self.pick()
+        delay = self.hedge_after(primary)
+        if delay is None:
+            return await self.acall(primary, messages, stop, **kwargs)
+
+        calls = {asyncio.ensure_future(self.acall(primary, messages, stop, **kwargs)): "primary"}
+        hedged = False
+        quota = None
+        try:
+            done, _ = await asyncio.wait(calls, timeout=delay)
+            while True:
+                if not hedged and (not done or any(task.exception() for task in done)):
+                    # Too slow or failed: send the request to a second deployment, if there is quota for it
+                    hedged = True
+                    secondary = self.pick(exclude=primary)
+                    quota = await sync_to_async(self.hedge_quota, thread_sensitive=False)(secondary, messages)
+                    if quota is not None:
+                        logger.debug("Hedging call to %s with %s", self.names[primary], self.names[secondary])
+                        calls[asyncio.ensure_future(self.acall(secondary, messages, stop, quota=quota, **kwargs))] = "hedge"
+                succeeded = [task for task in calls if task.done() and not task.exception()]
+                if succeeded:
+                    winner = succeeded[0]
+                    if len(calls) > 1:
+                        LLM_HEDGED_REQUESTS_TOTAL.labels(calls[winner]).inc()
+                    return winner.result()
+                if all(task.done() for task in calls):
+                    # Every deployment tried failed
+                    raise list(calls)[-1].exception()
+                done, _ = await asyncio.wait(
+                    [task for task in calls if not task.done()], return_when=asyncio.FIRST_COMPLETED,
+                )
+        finally:
+            # Cancels the losing request (and both if the caller was cancelled)
+            pending = [task for task in calls if not task.done()]
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            if quota is not None:
+                # A no-op unless the hedge was cancelled before it started
+                await sync_to_async(quota.close, thread_sensitive=False)()
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs) -> Iterator[ChatGenerationChunk]:
+        index = self.pick()
+        with self.deployment_limit(index, messages):
+            started = time.perf_counter()
+            try:
+                yield from self.deployments[index]._stream(messages, stop=stop, run_manager=run_manager, **kwargs)
+            except Exception:
+                self.record(index, started, "error")
+                raise
+            self.record(index, started, "success")
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs) -> AsyncIterator[ChatGenerationChunk]:
+        index = self.pick()
+        async with self.adeployment_limit(index, messages):
+            started = time.perf_counter()
+            try:
+                async for chunk in self.deployments[index]._astream(messages, stop=stop, run_manager=run_manager, **kwargs):
+                    yield chunk
+            except Exception:
+                self.record(index, started, "error")
+                raise
+            self.record(index, started, "success")
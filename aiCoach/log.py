@@ -0,0 +1,61 @@
+import atexit
+import logging
+import os
+import queue
+import random
+from logging.handlers import QueueHandler, QueueListener
+
+from django.conf import settings
+
+
+def log_payload(logger, message, *args):
+    """
+    Logs a DEBUG dump of a payload (conversation, LLM reply, ...) for a sample
+    of the calls (settings.LOG_PAYLOAD_SAMPLE_RATE). Callable args are only
+    called if the dump is logged, so e.g. serializing a conversation costs
+    nothing while DEBUG is off:
+
+        log_payload(logger, "Conversation: %s", lambda: serializer.data)
+    """
+    if not logger.isEnabledFor(logging.DEBUG) or random.random() >= settings.LOG_PAYLOAD_SAMPLE_RATE:
+        return
+    logger.debug(message, *[arg() if callable(arg) else arg for arg in args])
+
+
+class QueueLogHandler(QueueHandler):
+    """
+    Puts records on a bounded in-memory queue that a background thread writes
+    to stderr (or `stream`), so requests never block on log I/O. Records are
+    dropped, and counted in `dropped`, while the queue is full. The writer
+    thread is restarted in forked children (Celery prefork, gunicorn --preload).
+    """
+
+    def __init__(self, stream=None, maxsize=10000):
+        super().__init__(queue.Queue(maxsize))
+        self.target = logging.StreamHandler(stream)
+        self.dropped = 0
+        self.listener = None
+        self.start()
+        atexit.register(self.stop)
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self.restart)
+
+    def start(self):
+        self.listener = QueueListener(self.queue, self.target)
+        self.listener.start()
+
+    def stop(self):
+        # Writes what is still queued
+        if self.listener is not None and self.listener._thread is not None:
+            self.listener.stop()
+
+    def restart(self):
+        # The parent's writer thread does not exist in a forked child
+        self.queue = queue.Queue(self.queue.maxsize)
+        self.start()
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
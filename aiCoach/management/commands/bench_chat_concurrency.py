@@ -0,0 +1,95 @@
+import asyncio
+import json
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+
+from aiCoach import services
+from aiCoach.context import aload_coaching_context, load_coaching_context
+from aiCoach.fake_llm import FakeChatModel
+from aiCoach.models import User
+
+# Openings are served from the LLM response cache, so every turn carries a user message
+USER_MESSAGE = "I rushed my questions on the last call."
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares throughput of the sync chat path (a fixed pool of worker threads) "
+        "and the async chat path (a single event loop) against the fake LLM with a fixed latency."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200, help="Number of chat turns per run")
+        parser.add_argument('--latency', type=float, default=1.0, help="Fake LLM latency in seconds")
+        parser.add_argument('--sync-workers', type=int, default=8,
+                            help="Worker threads for the sync path (e.g. gunicorn workers x threads)")
+        parser.add_argument('--concurrency', type=int, default=200,
+                            help="Max in-flight turns on the async path")
+        parser.add_argument('--user-id', type=int, help="User to chat as (defaults to the first active user)")
+
+    def handle(self, *args, **options):
+        user = self.get_user(options['user_id'])
+        fake_llm = FakeChatModel(latency=f"fixed:{options['latency']}")
+
+        # The broker is not part of what is measured here
+        with mock.patch.object(services, 'LLM_MODEL', fake_llm), \
+                mock.patch.object(services.async_save_conversation, 'delay'):
+            sync_seconds = self.run_sync(user, options['requests'], options['sync_workers'])
+            async_seconds = asyncio.run(
+                self.run_async(user, options['requests'], options['concurrency'])
+            )
+
+        results = {
+            "requests": options['requests'],
+            "llm_latency_seconds": options['latency'],
+            "sync": {
+                "workers": options['sync_workers'],
+                "seconds": round(sync_seconds, 3),
+                "throughput_rps": round(options['requests'] / sync_seconds, 2),
+            },
+            "async": {
+                "concurrency": options['concurrency'],
+                "seconds": round(async_seconds, 3),
+                "throughput_rps": round(options['requests'] / async_seconds, 2),
+            },
+        }
+        self.stdout.write(json.dumps(results, indent=2))
+
+    def get_user(self, user_id):
+        users = User.objects.filter(is_active=True, goals__is_active=True)
+        if user_id is not None:
+            users = users.filter(id=user_id)
+        user = users.order_by('id').first()
+        if user is None:
+            raise CommandError("No active user with an active goal found. Seed the database first.")
+        return user
+
+    def run_sync(self, user, total, workers):
+        def turn(_):
+            try:
+                context = load_coaching_context(user.id, str(uuid.uuid4()))
+                services.chat_with_coach(context, user_message=USER_MESSAGE)
+            finally:
+                close_old_connections()
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(turn, range(total)))
+        return time.perf_counter() - started
+
+    async def run_async(self, user, total, concurrency):
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def turn():
+            async with semaphore:
+                context = await aload_coaching_context(user.id, str(uuid.uuid4()))
+                await services.achat_with_coach(context, user_message=USER_MESSAGE)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(turn() for _ in range(total)))
+        return time.perf_counter() - started
@@ -0,0 +1,284 @@
+import json
+import logging
+import queue
+import random
+import subprocess
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections, connection
+from django.test import Client
+
+from aiCoach import services, tasks
+from aiCoach.context import COACHING_STEPS
+from aiCoach.fake_llm import FakeChatModel
+from aiCoach.models import (
+    CategoryLevel,
+    CoachingPrompt,
+    User,
+    UserCallStatementsWithLevel,
+    UserGoal,
+    UserPerformanceData,
+)
+
+USER_MESSAGES = [
+    "I think I rushed the opening of my last call.",
+    "I want to ask more open questions so the customer talks more.",
+    "I could start with a question about their current setup.",
+    "Maybe I should summarize what they said before pitching.",
+    "I'll try that on my call with a new customer on Thursday.",
+    "What else should I keep in mind?",
+]
+
+logger = logging.getLogger(__name__)
+
+# Users created by a run share this email prefix, so leftovers can be removed with --cleanup-only
+EMAIL_PREFIX = "loadtest+"
+
+
+def percentile(values, pct):
+    """
+    Nearest-rank percentile of a list of numbers (None if empty).
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * pct // 100))
+    return ordered[int(rank) - 1]
+
+
+def summarize(values):
+    return {
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": max(values) if values else None,
+    }
+
+
+class QueryCounter:
+    """
+    Counts the queries of the current thread's connection (installed with
+    `connection.execute_wrapper`).
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+class SaveWorkerPool:
+    """
+    Stands in for the Celery worker: `delay()` puts the save on an in-process
+    queue that `workers` threads consume, recording how long each save waited
+    in the queue (lag) and until it was persisted.
+    """
+
+    def __init__(self, workers):
+        self.queue = queue.Queue()
+        self.queue_lag = []
+        self.persist_lag = []
+        self.errors = Counter()  # "ErrorType: message" -> count
+        self.lock = threading.Lock()
+        self.threads = [threading.Thread(target=self.work, daemon=True) for _ in range(workers)]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def delay(self, **kwargs):
+        self.queue.put((time.perf_counter(), kwargs))
+
+    def work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            enqueued, kwargs = item
+            started = time.perf_counter()
+            try:
+                tasks.async_save_conversation(**kwargs)
+            except Exception as error:
+                logger.exception("Save of chat %s failed", kwargs.get('chat_id'))
+                with self.lock:
+                    self.errors[f"{type(error).__name__}: {error}"] += 1
+            finally:
+                close_old_connections()
+            with self.lock:
+                self.queue_lag.append((started - enqueued) * 1000)
+                self.persist_lag.append((time.perf_counter() - enqueued) * 1000)
+
+    def drain(self):
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+
+class Command(BaseCommand):
+    help = (
+        "End-to-end load benchmark of the chat API: seeds users, drives concurrent "
+        "multi-turn GROW conversations through /api/chat/, /api/chat-messages/ and "
+        "/api/chat-history/ against the fake LLM, and prints JSON results."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=20, help="Users to seed, one conversation each")
+        parser.add_argument('--turns', type=int, default=6, help="Chat turns per conversation after the opening")
+        parser.add_argument('--concurrency', type=int, default=8, help="Conversations driven in parallel")
+        parser.add_argument('--save-workers', type=int, default=2, help="Threads standing in for the Celery worker")
+        parser.add_argument('--llm-latency', default='lognormal:-1.5,0.4',
+                            help="Fake LLM latency distribution (see FAKE_LLM_LATENCY)")
+        parser.add_argument('--seed', type=int, default=0, help="Random seed for the fake LLM")
+        parser.add_argument('--output', help="Also write the JSON results to this file")
+        parser.add_argument('--keep-data', action='store_true', help="Keep the seeded users and their chats")
+        parser.add_argument('--cleanup-only', action='store_true', help="Only delete users left by earlier runs")
+
+    def handle(self, *args, **options):
+        if options['cleanup_only']:
+            deleted, _ = User.objects.filter(email__startswith=EMAIL_PREFIX).delete()
+            self.stdout.write(f"Deleted {deleted} rows")
+            return
+
+        missing = {step for step, _ in COACHING_STEPS} - set(
+            CoachingPrompt.objects.filter(is_active=True).values_list('category', flat=True)
+        )
+        if missing:
+            raise CommandError(f"No active coaching prompt for {sorted(missing)}. Seed the database first.")
+
+        users = self.seed_users(options['users'])
+        fake_llm = FakeChatModel(latency=options['llm_latency'], seed=options['seed'])
+        save_workers = SaveWorkerPool(options['save_workers'])
+        samples = defaultdict(list)  # endpoint -> [(milliseconds, queries, status)]
+        samples_lock = threading.Lock()
+
+        def conversation(user):
+            client = Client()
+            counter = QueryCounter()
+            chat_id = str(uuid.uuid4())
+            rng = random.Random(user.id)
+
+            def request(endpoint, method, path, data=None):
+                counter.count = 0
+                started = time.perf_counter()
+                with connection.execute_wrapper(counter):
+                    if method == 'post':
+                        response = client.post(path, data, content_type='application/json')
+                    else:
+                        response = client.get(path)
+                elapsed = (time.perf_counter() - started) * 1000
+                with samples_lock:
+                    samples[endpoint].append((elapsed, counter.count, response.status_code))
+
+            try:
+                for turn in range(options['turns'] + 1):
+                    text = rng.choice(USER_MESSAGES) if turn else ''
+                    request('chat', 'post', '/api/chat/', {'user_id': user.id, 'chat_id': chat_id, 'text': text})
+                    request('chat-messages', 'get', f'/api/chat-messages/{chat_id}/')
+                request('chat-history', 'get', f'/api/chat-history/{user.id}/')
+            finally:
+                close_old_connections()
+
+        save_workers.start()
+        with mock.patch.object(services, 'LLM_MODEL', fake_llm), \
+                mock.patch.object(tasks, 'LLM_MODEL', fake_llm), \
+                mock.patch.object(services.async_save_conversation, 'delay', save_workers.delay), \
+                mock.patch.object(tasks, 'schedule_chat_labels'):  # Label batches are not part of the chat path
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=options['concurrency']) as executor:
+                list(executor.map(conversation, users))
+            elapsed = time.perf_counter() - started
+            save_workers.drain()
+            drained = time.perf_counter() - started
+
+        results = self.results(options, samples, elapsed, drained, save_workers)
+
+        if not options['keep_data']:
+            User.objects.filter(id__in=[user.id for user in users]).delete()
+
+        output = json.dumps(results, indent=2)
+        self.stdout.write(output)
+        if options['output']:
+            with open(options['output'], 'w') as file:
+                file.write(output + "\n")
+
+    def seed_users(self, count):
+        categories = list(CategoryLevel.objects.values_list('category', flat=True).distinct()) or ['QUESTIONING']
+        run = uuid.uuid4().hex[:8]
+        users = User.objects.bulk_create([
+            User(email=f"{EMAIL_PREFIX}{run}-{index}@example.com", first_name="Load", last_name=f"Tester {index}")
+            for index in range(count)
+        ])
+        UserGoal.objects.bulk_create([
+            UserGoal(user=user, category=categories[index % len(categories)], initial_level='8% DEVELOPING',
+                     current_level='22% DEVELOPING or ACCOMPLISHED', goal_level='35% DEVELOPING or ACCOMPLISHED')
+            for index, user in enumerate(users)
+        ])
+        UserPerformanceData.objects.bulk_create([
+            UserPerformanceData(user=user, category=category, date='2024-05-15', not_observed=0.0,
+                                foundational=70.0, developing=20.0, accomplished=10.0, combined_DA=30.0)
+            for user in users for category in categories
+        ])
+        UserCallStatementsWithLevel.objects.bulk_create([
+            UserCallStatementsWithLevel(user=user, statement=f"{category.title()} statement from the last call.",
+                                        category=category, level='2', reason='Seeded for load testing.',
+                                        confidence_score=90)
+            for user in users for category in categories
+        ])
+        return users
+
+    def results(self, options, samples, elapsed, drained, save_workers):
+        endpoints = {}
+        for endpoint, endpoint_samples in samples.items():
+            latencies = [sample[0] for sample in endpoint_samples]
+            queries = [sample[1] for sample in endpoint_samples]
+            endpoints[endpoint] = {
+                "requests": len(endpoint_samples),
+                # chat-history is a 404 until the user's first save is persisted
+                "status_codes": dict(Counter(str(sample[2]) for sample in endpoint_samples)),
+                "throughput_rps": round(len(endpoint_samples) / elapsed, 2),
+                "latency_ms": {key: round(value, 2) for key, value in summarize(latencies).items()},
+                "queries_per_request": {"mean": round(sum(queries) / len(queries), 2), "max": max(queries)},
+            }
+
+        total = sum(endpoint["requests"] for endpoint in endpoints.values())
+        return {
+            "commit": self.git_commit(),
+            "config": {
+                "users": options['users'],
+                "turns": options['turns'],
+                "concurrency": options['concurrency'],
+                "save_workers": options['save_workers'],
+                "llm_latency": options['llm_latency'],
+                "db_vendor": connection.vendor,
+                "cache_backend": settings.CACHES['default']['BACKEND'],
+            },
+            "seconds": round(elapsed, 3),
+            "throughput_rps": round(total / elapsed, 2),
+            "endpoints": endpoints,
+            "saves": {
+                "count": len(save_workers.persist_lag),
+                "errors": sum(save_workers.errors.values()),
+                "error_messages": dict(save_workers.errors.most_common(10)),
+                "queue_lag_ms": {key: round(value, 2) for key, value in summarize(save_workers.queue_lag).items()},
+                "persist_lag_ms": {key: round(value, 2) for key, value in summarize(save_workers.persist_lag).items()},
+                "drain_seconds": round(drained - elapsed, 3),
+            },
+        }
+
+    def git_commit(self):
+        try:
+            return subprocess.run(
+                ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
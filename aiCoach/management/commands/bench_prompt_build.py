@@ -0,0 +1,136 @@
+import datetime
+import json
+import timeit
+
+from django.core.management.base import BaseCommand
+from langchain.output_parsers import PydanticOutputParser
+from langchain.prompts import PromptTemplate
+
+from aiCoach.history import count_tokens
+from aiCoach.models import CategoryLevel
+from aiCoach.outputParser import ChatParser
+from aiCoach.prompts import (
+    CHAT_FORMAT_INSTRUCTIONS,
+    CONVERSATION_TEMPLATE,
+    CompiledPrompt,
+    format_category_levels,
+    load_coaching_prompt,
+)
+
+# Used when the database has no prompt for the step
+SAMPLE_TEMPLATE = (
+    "### You are a Remote Selling Skills coach called Bob. You are coaching {user_name} after a pharma sales call.\n"
+    "Coaching session data:\nGOAL: {goal}\nPerformance Data: {performance_data}\n\n"
+    "Category Level Data: {category_level_data}\n\n"
+    "INSTRUCTION: Ask {user_name} one question at a time.\n"
+    "Response must ONLY be in the following pure JSON format: ###{format_instructions}###"
+)
+
+# Used when the database has no levels for the category: full rows, as the
+# OPTIONS prompts got them before the compact level fragment
+SAMPLE_LEVELS = [
+    {
+        "id": level, "category": "QUESTIONING", "level": level,
+        "description": f"Description for level {level} of QUESTIONING.",
+        "examples": f"Examples for level {level} of QUESTIONING.",
+        "invalid_examples": f"Invalid examples for level {level} of QUESTIONING.",
+        "is_active": True,
+        "created_at": datetime.datetime(2024, 5, 15, 9, 30, tzinfo=datetime.timezone.utc),
+        "updated_at": datetime.datetime(2024, 5, 15, 9, 30, tzinfo=datetime.timezone.utc),
+    }
+    for level in range(1, 5)
+]
+
+SAMPLE_VALUES = {
+    "user_name": "John Doe",
+    "goal": "category: QUESTIONING\ninitial_level: 8% DEVELOPING\ngoal_level: 35% DEVELOPING or ACCOMPLISHED\n",
+    "performance_data": {
+        "skills": "category: QUESTIONING\nfoundational: 80.0\ndeveloping: 10.0\naccomplished: 10.0\n" * 5,
+        "last_call": [{"statement": "Who is it that mainly sees the eczema patients here?", "level": "2"}] * 5,
+    },
+    "category_level_data": SAMPLE_LEVELS,
+    "conversation_history": "User: Hi Bob Coach: Hello John! How did the call go? " * 5,
+    "user_message": "I think I asked too many closed questions.",
+}
+
+
+def legacy_build(template, values):
+    """
+    The per-turn prompt construction used before the compiled prompt registry.
+    """
+    parser = PydanticOutputParser(pydantic_object=ChatParser)
+    partial_variables = {"format_instructions": parser.get_format_instructions()}
+    prompt = PromptTemplate(
+        input_variables=["user_name", "goal", "performance_data", "category_level_data"],
+        partial_variables=partial_variables,
+        template=template,
+    )
+    user_name = values["user_name"]
+    full_prompt = (
+        f"{prompt.template} ### Conversation History: This is the conversation done with {user_name}, "
+        f"get a summary from it to proceed ahead: {values['conversation_history']} "
+        f"### Do not add any message on behalf of the user; if the user's message is empty, keep it empty. "
+        f"### {user_name}'s latest message: This is {user_name}'s message/reply to you. "
+        f"Analyze it to get further actions: {values['user_message']}"
+    )
+    return full_prompt.format(
+        user_name=user_name,
+        goal=values["goal"],
+        performance_data=values["performance_data"],
+        category_level_data=values["category_level_data"],
+        format_instructions=partial_variables["format_instructions"],
+    )
+
+
+class Command(BaseCommand):
+    help = (
+        "Microbenchmark of per-turn coaching prompt construction: legacy path vs compiled prompt registry, "
+        "and prompt tokens of the category level data as full rows vs the compact fragment."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--step', default='OPTIONS', help="Coaching step whose prompt template is used")
+        parser.add_argument('--category', default='QUESTIONING', help="Goal category whose levels are used")
+        parser.add_argument('--iterations', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        try:
+            template = load_coaching_prompt(options['step'])
+        except ValueError:
+            template = SAMPLE_TEMPLATE
+
+        level_rows = list(CategoryLevel.objects.filter(category=options['category']).order_by('level').values())
+        level_rows = level_rows or SAMPLE_LEVELS
+
+        values = dict(SAMPLE_VALUES, category_level_data=level_rows)
+        compact_values = dict(values, category_level_data=format_category_levels(
+            row for row in level_rows if row["is_active"]
+        ))
+        compiled = CompiledPrompt(template + CONVERSATION_TEMPLATE,
+                                  constants={"format_instructions": CHAT_FORMAT_INSTRUCTIONS})
+
+        if legacy_build(template, values) != compiled.render(**values):
+            self.stderr.write("Warning: legacy and compiled prompts differ")
+
+        iterations = options['iterations']
+        legacy_seconds = timeit.timeit(lambda: legacy_build(template, values), number=iterations)
+        compiled_seconds = timeit.timeit(lambda: compiled.render(**values), number=iterations)
+
+        # Token cost of the level definitions per OPTIONS turn
+        legacy_tokens = count_tokens(compiled.render(**values))
+        compact_tokens = count_tokens(compiled.render(**compact_values))
+
+        results = {
+            "step": options['step'],
+            "iterations": iterations,
+            "legacy_us_per_turn": round(legacy_seconds / iterations * 1e6, 2),
+            "compiled_us_per_turn": round(compiled_seconds / iterations * 1e6, 2),
+            "speedup": round(legacy_seconds / compiled_seconds, 1),
+            "category": options['category'],
+            "level_rows_tokens": count_tokens(str(level_rows)),
+            "compact_levels_tokens": count_tokens(compact_values["category_level_data"]),
+            "legacy_prompt_tokens": legacy_tokens,
+            "compact_prompt_tokens": compact_tokens,
+            "prompt_tokens_saved_per_turn": legacy_tokens - compact_tokens,
+        }
+        self.stdout.write(json.dumps(results, indent=2))
@@ -0,0 +1,148 @@
+import os
+import time
+from contextlib import contextmanager
+
+from langchain_community.callbacks import get_openai_callback
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+from aiCoach.timing import record_timing
+
+# LLM calls are labelled by operation ("coach", "summary", "label") and GROW step
+# ("" for calls that do not belong to a step).
+
+LLM_REQUEST_DURATION = Histogram(
+    'aicoach_llm_request_duration_seconds',
+    'Duration of LLM calls.',
+    ['operation', 'step'],
+    buckets=(0.25, 0.5, 1, 2, 3, 5, 8, 13, 20, 30, 60),
+)
+LLM_TOKENS = Histogram(
+    'aicoach_llm_request_tokens',
+    'Tokens per LLM call.',
+    ['operation', 'step', 'kind'],
+    buckets=(50, 100, 250, 500, 1000, 2000, 4000, 8000, 16000),
+)
+LLM_TOKENS_TOTAL = Counter(
+    'aicoach_llm_tokens_total',
+    'Tokens used by LLM calls, for rates against the TPM quota.',
+    ['operation', 'step', 'kind'],
+)
+LLM_REQUESTS_TOTAL = Counter(
+    'aicoach_llm_requests_total',
+    'LLM calls by outcome.',
+    ['operation', 'step', 'outcome'],
+)
+LLM_PARSE_FAILURES_TOTAL = Counter(
+    'aicoach_llm_parse_failures_total',
+    'LLM replies that could not be parsed as the expected JSON.',
+    ['operation', 'step'],
+)
+LLM_PARSE_RETRIES_TOTAL = Counter(
+    'aicoach_llm_parse_retries_total',
+    'LLM calls repeated because the previous reply did not match the schema.',
+    ['operation', 'step'],
+)
+LLM_RESPONSE_CACHE_TOTAL = Counter(
+    'aicoach_llm_response_cache_total',
+    'LLM response cache lookups.',
+    ['result'],
+)
+LLM_RATE_LIMIT_WAIT = Histogram(
+    'aicoach_llm_rate_limit_wait_seconds',
+    'Time LLM calls waited for quota (requests, tokens, concurrency), by priority class.',
+    ['priority'],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30),
+)
+LLM_DEPLOYMENT_REQUESTS_TOTAL = Counter(
+    'aicoach_llm_deployment_requests_total',
+    'LLM calls by deployment of the router backend and outcome (success, error, cancelled).',
+    ['deployment', 'outcome'],
+)
+LLM_HEDGED_REQUESTS_TOTAL = Counter(
+    'aicoach_llm_hedged_requests_total',
+    'Hedged LLM calls by the request that answered first (primary or hedge).',
+    ['winner'],
+)
+LLM_HEDGES_SKIPPED_TOTAL = Counter(
+    'aicoach_llm_hedges_skipped_total',
+    'Hedged LLM requests not sent because there was no quota left for them, by deployment.',
+    ['deployment'],
+)
+LLM_DEFERRED_TOTAL = Counter(
+    'aicoach_llm_deferred_total',
+    'Background LLM work put off because interactive calls were slow or out of quota.',
+    ['priority'],
+)
+CHAT_TURN_PHASE_DURATION = Histogram(
+    'aicoach_chat_turn_phase_duration_seconds',
+    'Duration of the phases of a chat turn (context load, LLM, save enqueue).',
+    ['phase'],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+
+
+@contextmanager
+def observe_llm_call(operation, step="", track_usage=True):
+    """
+    Records the duration, outcome and token usage of the LLM calls made in
+    the block. Usage is collected with LangChain's OpenAI callback, so it also
+    covers calls made inside LangChain helpers (e.g. summary memory pruning).
+    Pass `track_usage=False` for blocks that span generator yields (streaming),
+    where the callback's context variable cannot be reset reliably.
+    """
+    start = time.perf_counter()
+    outcome = "error"
+    usage = None
+    try:
+        if track_usage:
+            with get_openai_callback() as usage:
+                yield
+        else:
+            yield
+        outcome = "success"
+    finally:
+        elapsed = time.perf_counter() - start
+        LLM_REQUEST_DURATION.labels(operation, step).observe(elapsed)
+        record_timing("llm", elapsed)
+        LLM_REQUESTS_TOTAL.labels(operation, step, outcome).inc()
+
+    if usage is None:
+        return
+    for kind, tokens in (("prompt", usage.prompt_tokens), ("completion", usage.completion_tokens)):
+        if tokens:
+            LLM_TOKENS.labels(operation, step, kind).observe(tokens)
+            LLM_TOKENS_TOTAL.labels(operation, step, kind).inc(tokens)
+
+
+@contextmanager
+def observe_phase(phase):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        CHAT_TURN_PHASE_DURATION.labels(phase).observe(elapsed)
+        record_timing(phase, elapsed)
+
+
+def render_metrics():
+    """
+    Returns (body, content type) of the Prometheus exposition. With several
+    processes per host (gunicorn workers, Celery workers) set
+    PROMETHEUS_MULTIPROC_DIR to a directory shared by all of them, and the
+    metrics of every process are aggregated.
+    """
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
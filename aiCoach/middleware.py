@@ -0,0 +1,87 @@
+import json
+import logging
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+from aiCoach.timing import REQUEST_TIMINGS, RequestTimings
+
+request_logger = logging.getLogger('aiCoach.requests')
+
+
+class ServerTimingMiddleware:
+    """
+    Collects per-request timings (DB queries, LLM calls, broker enqueue,
+    serialization, ...) and reports them in a `Server-Timing` header and one
+    JSON log line on the `aiCoach.requests` logger. Streaming responses get
+    the header for the work done before streaming; their log line is written
+    when the stream is closed, so it includes the LLM time.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        timings = RequestTimings()
+        token = REQUEST_TIMINGS.set(timings)
+        try:
+            response = self.get_response(request)
+        finally:
+            REQUEST_TIMINGS.reset(token)
+        return self.finish(request, response, timings)
+
+    async def __acall__(self, request):
+        timings = RequestTimings()
+        token = REQUEST_TIMINGS.set(timings)
+        try:
+            response = await self.get_response(request)
+        finally:
+            REQUEST_TIMINGS.reset(token)
+        return self.finish(request, response, timings)
+
+    def finish(self, request, response, timings):
+        response['Server-Timing'] = timings.server_timing()
+        if response.streaming:
+            # The stream runs outside this call; keep collecting until it is closed
+            response.streaming_content = self.stream(response.streaming_content, timings)
+            response._resource_closers.append(lambda: self.log(request, response, timings))
+        else:
+            self.log(request, response, timings)
+        return response
+
+    def stream(self, content, timings):
+        if hasattr(content, '__aiter__'):
+            return self.astream(content, timings)
+        return self.sync_stream(content, timings)
+
+    def sync_stream(self, content, timings):
+        token = REQUEST_TIMINGS.set(timings)
+        try:
+            yield from content
+        finally:
+            REQUEST_TIMINGS.reset(token)
+
+    async def astream(self, content, timings):
+        token = REQUEST_TIMINGS.set(timings)
+        try:
+            async for chunk in content:
+                yield chunk
+        finally:
+            REQUEST_TIMINGS.reset(token)
+
+    def log(self, request, response, timings):
+        if not request_logger.isEnabledFor(logging.INFO):
+            return
+        request_logger.info(json.dumps({
+            "method": request.method,
+            "path": request.path,
+            "status": response.status_code,
+            "total_ms": round(timings.total() * 1000, 1),
+            **{f"{name}_ms": round(seconds * 1000, 1) for name, seconds in timings.durations.items()},
+            **{f"{name}_count": count for name, count in timings.counts.items()},
+        }))
@@ -0,0 +1,152 @@
+# Generated by Django 5.1.1 on 2026-10-18 17:52
+
+import django.db.models.deletion
+import django.utils.timezone
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Category',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('category', models.CharField(choices=[('OPENING', 'Opening'), ('QUESTIONING', 'Questioning'), ('PRESENTING', 'Presenting'), ('CLOSING', 'Closing'), ('OUTCOME', 'Outcome')], max_length=20)),
+                ('definition', models.TextField()),
+                ('instruction', models.TextField(blank=True, null=True)),
+                ('examples', models.TextField(blank=True, null=True)),
+                ('invalid_examples', models.TextField(blank=True, null=True)),
+                ('is_active', models.BooleanField(default=True)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='CoachingPrompt',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('category', models.CharField(choices=[('GOAL', 'Goal'), ('REALITY', 'Reality'), ('OPTIONS', 'Options'), ('OPTION_IMPROVEMENT', 'Option_improvement'), ('WILL', 'Will')], max_length=50, unique=True)),
+                ('prompt', models.TextField()),
+                ('is_active', models.BooleanField(default=True)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='User',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('email', models.EmailField(max_length=254, unique=True)),
+                ('password', models.CharField(max_length=128)),
+                ('first_name', models.CharField(blank=True, max_length=100, null=True)),
+                ('last_name', models.CharField(blank=True, max_length=100, null=True)),
+                ('is_active', models.BooleanField(default=True)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='CategoryLevel',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('category', models.CharField(choices=[('OPENING', 'Opening'), ('QUESTIONING', 'Questioning'), ('PRESENTING', 'Presenting'), ('CLOSING', 'Closing'), ('OUTCOME', 'Outcome')], max_length=20)),
+                ('level', models.IntegerField(choices=[(1, '1'), (2, '2'), (3, '3'), (4, '4')])),
+                ('description', models.TextField(blank=True, null=True)),
+                ('examples', models.TextField(blank=True, null=True)),
+                ('invalid_examples', models.TextField(blank=True, null=True)),
+                ('is_active', models.BooleanField(default=True)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'unique_together': {('category', 'level')},
+            },
+        ),
+        migrations.CreateModel(
+            name='CategoryLevelExample',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('example_text', models.TextField()),
+                ('reason', models.TextField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('category_level', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='level_examples', to='aiCoach.categorylevel')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='UserCallStatementsWithLevel',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('statement', models.TextField()),
+                ('category', models.CharField(choices=[('OPENING', 'Opening'), ('QUESTIONING', 'Questioning'), ('PRESENTING', 'Presenting'), ('CLOSING', 'Closing'), ('OUTCOME', 'Outcome')], max_length=20)),
+                ('level', models.TextField()),
+                ('reason', models.TextField(blank=True, null=True)),
+                ('confidence_score', models.FloatField()),
+                ('is_active', models.BooleanField(default=True)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='last_calls', to='aiCoach.user')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='UserConversationHistory',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('chat_id', models.UUIDField(default=uuid.uuid4, editable=False, unique=True)),
+                ('messages', models.JSONField(default=list)),
+                ('chat_label', models.CharField(blank=True, max_length=100, null=True)),
+                ('summary', models.JSONField(default=dict)),
+                ('isGoalStepCompleted', models.BooleanField(default=False)),
+                ('isRealityStepCompleted', models.BooleanField(default=False)),
+                ('isOptionStepCompleted', models.BooleanField(default=False)),
+                ('isOptionImprovementStepCompleted', models.BooleanField(default=False)),
+                ('isWillStepCompleted', models.BooleanField(default=False)),
+                ('is_active', models.BooleanField(default=True)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='conversation_history', to='aiCoach.user')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='UserPerformanceData',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('category', models.CharField(choices=[('OPENING', 'Opening'), ('QUESTIONING', 'Questioning'), ('PRESENTING', 'Presenting'), ('CLOSING', 'Closing'), ('OUTCOME', 'Outcome')], max_length=20)),
+                ('date', models.DateField()),
+                ('not_observed', models.FloatField(blank=True, null=True)),
+                ('foundational', models.FloatField(blank=True, null=True)),
+                ('developing', models.FloatField(blank=True, null=True)),
+                ('accomplished', models.FloatField(blank=True, null=True)),
+                ('combined_DA', models.FloatField(blank=True, null=True)),
+                ('is_active', models.BooleanField(default=True)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='performance_data', to='aiCoach.user')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='UserGoal',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('category', models.CharField(choices=[('OPENING', 'Opening'), ('QUESTIONING', 'Questioning'), ('PRESENTING', 'Presenting'), ('CLOSING', 'Closing'), ('OUTCOME', 'Outcome')], max_length=20)),
+                ('initial_level', models.TextField(blank=True, null=True)),
+                ('current_level', models.TextField(blank=True, null=True)),
+                ('goal_level', models.TextField()),
+                ('goal_confirmation', models.BooleanField(default=True)),
+                ('is_active', models.BooleanField(default=True)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='goals', to='aiCoach.user')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('user', 'category', 'is_active'), name='unique_category_is_active')],
+            },
+        ),
+    ]
@@ -0,0 +1,78 @@
+# Generated by Django 5.1.1 on 2026-10-18 17:52
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+BATCH_SIZE = 500
+
+
+def backfill_conversation_messages(apps, schema_editor):
+    """
+    Splits every stored messages blob ([{"user": ..., "coach": ...}, ...]) into
+    ConversationMessage rows, one per non-empty message, in conversation order.
+    """
+    UserConversationHistory = apps.get_model('aiCoach', 'UserConversationHistory')
+    ConversationMessage = apps.get_model('aiCoach', 'ConversationMessage')
+
+    rows = []
+    for history in UserConversationHistory.objects.only('id', 'messages', 'updated_at').iterator(chunk_size=BATCH_SIZE):
+        sequence = 0
+        for message in history.messages or []:
+            for role in ('user', 'coach'):
+                text = message.get(role)
+                if not text:
+                    continue
+                sequence += 1
+                rows.append(ConversationMessage(
+                    chat_id=history.id, sequence=sequence, role=role, text=text, created_at=history.updated_at,
+                ))
+        if len(rows) >= BATCH_SIZE:
+            ConversationMessage.objects.bulk_create(rows)
+            rows = []
+    ConversationMessage.objects.bulk_create(rows)
+
+
+def restore_messages_blob(apps, schema_editor):
+    UserConversationHistory = apps.get_model('aiCoach', 'UserConversationHistory')
+    ConversationMessage = apps.get_model('aiCoach', 'ConversationMessage')
+
+    for history in UserConversationHistory.objects.iterator(chunk_size=BATCH_SIZE):
+        messages = []
+        for row in ConversationMessage.objects.filter(chat_id=history.id).order_by('sequence'):
+            if row.role == 'coach' and messages and 'coach' not in messages[-1]:
+                messages[-1]['coach'] = row.text
+            else:
+                messages.append({row.role: row.text})
+        history.messages = messages
+        history.save(update_fields=['messages'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aiCoach', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ConversationMessage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sequence', models.PositiveIntegerField()),
+                ('role', models.CharField(choices=[('user', 'User'), ('coach', 'Coach')], max_length=10)),
+                ('text', models.TextField()),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('chat', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='conversation_messages', to='aiCoach.userconversationhistory')),
+            ],
+            options={
+                'ordering': ['sequence'],
+                'constraints': [models.UniqueConstraint(fields=('chat', 'sequence'), name='unique_chat_message_sequence')],
+            },
+        ),
+        migrations.RunPython(backfill_conversation_messages, restore_messages_blob),
+        migrations.RemoveField(
+            model_name='userconversationhistory',
+            name='messages',
+        ),
+    ]
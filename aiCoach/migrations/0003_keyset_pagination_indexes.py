@@ -0,0 +1,41 @@
+# Generated by Django 5.1.1 on 2026-10-18 18:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aiCoach', '0002_conversationmessage'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='category',
+            index=models.Index(fields=['created_at', 'id'], name='category_keyset'),
+        ),
+        migrations.AddIndex(
+            model_name='categorylevel',
+            index=models.Index(fields=['created_at', 'id'], name='category_level_keyset'),
+        ),
+        migrations.AddIndex(
+            model_name='categorylevelexample',
+            index=models.Index(fields=['created_at', 'id'], name='level_example_keyset'),
+        ),
+        migrations.AddIndex(
+            model_name='coachingprompt',
+            index=models.Index(fields=['created_at', 'id'], name='coaching_prompt_keyset'),
+        ),
+        migrations.AddIndex(
+            model_name='usercallstatementswithlevel',
+            index=models.Index(fields=['user', 'created_at', 'id'], name='last_call_user_keyset'),
+        ),
+        migrations.AddIndex(
+            model_name='userconversationhistory',
+            index=models.Index(fields=['user', 'created_at', 'id'], name='chat_history_user_keyset'),
+        ),
+        migrations.AddIndex(
+            model_name='userperformancedata',
+            index=models.Index(fields=['user', 'created_at', 'id'], name='performance_user_keyset'),
+        ),
+    ]
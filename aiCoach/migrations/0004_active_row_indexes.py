@@ -0,0 +1,49 @@
+# Generated by Django 5.1.1 on 2026-10-18 18:25
+
+from django.contrib.postgres.operations import AddIndexConcurrently, RemoveIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # The indexes are built without blocking writes to the tables
+    atomic = False
+
+    dependencies = [
+        ('aiCoach', '0003_keyset_pagination_indexes'),
+    ]
+
+    operations = [
+        # The new indexes are in place before the ones they replace are dropped
+        AddIndexConcurrently(
+            model_name='usercallstatementswithlevel',
+            index=models.Index(condition=models.Q(('is_active', True)), fields=['user', 'created_at', 'id'], name='last_call_user_active'),
+        ),
+        AddIndexConcurrently(
+            model_name='userconversationhistory',
+            index=models.Index(condition=models.Q(('is_active', True)), fields=['user', 'created_at', 'id'], name='chat_history_user_active'),
+        ),
+        AddIndexConcurrently(
+            model_name='userconversationhistory',
+            index=models.Index(condition=models.Q(('is_active', True), models.Q(('chat_label__isnull', True), ('chat_label', ''), _connector='OR')), fields=['created_at'], name='chat_history_unlabelled'),
+        ),
+        AddIndexConcurrently(
+            model_name='usergoal',
+            index=models.Index(condition=models.Q(('is_active', True)), fields=['user', 'id'], name='user_goal_active'),
+        ),
+        AddIndexConcurrently(
+            model_name='userperformancedata',
+            index=models.Index(condition=models.Q(('is_active', True)), fields=['user', 'created_at', 'id'], name='performance_user_active'),
+        ),
+        RemoveIndexConcurrently(
+            model_name='usercallstatementswithlevel',
+            name='last_call_user_keyset',
+        ),
+        RemoveIndexConcurrently(
+            model_name='userconversationhistory',
+            name='chat_history_user_keyset',
+        ),
+        RemoveIndexConcurrently(
+            model_name='userperformancedata',
+            name='performance_user_keyset',
+        ),
+    ]
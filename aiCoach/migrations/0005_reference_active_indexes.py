@@ -0,0 +1,24 @@
+# Generated by Django 5.1.1 on 2026-10-18 19:02
+
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # The indexes are built without blocking writes to the tables
+    atomic = False
+
+    dependencies = [
+        ('aiCoach', '0004_active_row_indexes'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='categorylevel',
+            index=models.Index(condition=models.Q(('is_active', True)), fields=['category', 'level'], name='category_level_active'),
+        ),
+        AddIndexConcurrently(
+            model_name='coachingprompt',
+            index=models.Index(condition=models.Q(('is_active', True)), fields=['category'], name='coaching_prompt_active'),
+        ),
+    ]
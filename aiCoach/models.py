@@ -21,6 +21,12 @@ COACHING_PROMPT_TYPES = [
     ('WILL', 'Will'),
 ]
 
+# Roles of the messages in a conversation
+MESSAGE_ROLES = [
+    ('user', 'User'),
+    ('coach', 'Coach'),
+]
+
 # Define category levels
 LEVEL_CHOICES = [(i, str(i)) for i in range(1, 5)]  # Creates tuples: [(1, '1'), (2, '2'), (3, '3'), (4, '4')]
 
@@ -57,6 +63,12 @@ class Category(models.Model):
     created_at = models.DateTimeField(default=timezone.now)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            # Keyset pagination of the list endpoint (aiCoach/pagination.py)
+            models.Index(fields=['created_at', 'id'], name='category_keyset'),
+        ]
+
     def __str__(self):
         return f"{self.category}"
 
@@ -74,6 +86,12 @@ class CategoryLevel(models.Model):
 
     class Meta:
         unique_together = ('category', 'level')  # Prevent duplicate levels for the same category
+        indexes = [
+            # Keyset pagination of the list endpoint (aiCoach/pagination.py)
+            models.Index(fields=['created_at', 'id'], name='category_level_keyset'),
+            # Active levels of a goal category, in level order (aiCoach/prompts.py)
+            models.Index(fields=['category', 'level'], condition=models.Q(is_active=True), name='category_level_active'),
+        ]
 
     # def __str__(self):
     #     return f"{self.category} - Level: {self.level}"
@@ -87,6 +105,12 @@ class CategoryLevelExample(models.Model):
     created_at = models.DateTimeField(default=timezone.now)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            # Keyset pagination of the list endpoint (aiCoach/pagination.py)
+            models.Index(fields=['created_at', 'id'], name='level_example_keyset'),
+        ]
+
     def __str__(self):
         return f"Examples of {self.category_level.category.category} - Level: {self.category_level.level}"
 
@@ -103,6 +127,12 @@ class UserCallStatementsWithLevel(models.Model):
     created_at = models.DateTimeField(default=timezone.now)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            # A user's active rows: the coaching context and the keyset-paginated list endpoint (aiCoach/pagination.py)
+            models.Index(fields=['user', 'created_at', 'id'], condition=models.Q(is_active=True), name='last_call_user_active'),
+        ]
+
     def __str__(self):
         return f"Calls of {self.user.first_name} {self.user.last_name}, with {self.category}"
 
@@ -123,6 +153,10 @@ class UserGoal(models.Model):
         constraints = [
             models.UniqueConstraint(fields=['user', 'category', 'is_active'], name='unique_category_is_active')
         ]
+        indexes = [
+            # A user's active goals in id order, as read by the coaching context and get_user_goal
+            models.Index(fields=['user', 'id'], condition=models.Q(is_active=True), name='user_goal_active'),
+        ]
 
     def __str__(self):
         return f"{self.user.first_name} {self.user.last_name} - {self.category} - Goal Level: {self.goal_level}"
@@ -142,6 +176,12 @@ class UserPerformanceData(models.Model):
     created_at = models.DateTimeField(default=timezone.now)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            # A user's active rows: the coaching context and the keyset-paginated list endpoint (aiCoach/pagination.py)
+            models.Index(fields=['user', 'created_at', 'id'], condition=models.Q(is_active=True), name='performance_user_active'),
+        ]
+
     def __str__(self):
         return f"{self.user.first_name} {self.user.last_name} performance data of {self.category}"
 
@@ -150,7 +190,6 @@ class UserPerformanceData(models.Model):
 class UserConversationHistory(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='conversation_history')
     chat_id = models.UUIDField(default=uuid.uuid4, editable=False, unique=True)
-    messages = models.JSONField(default=list)
     chat_label = models.CharField(max_length=100, blank=True, null=True)
     summary = models.JSONField(default=dict)
     isGoalStepCompleted: bool = models.BooleanField(default=False)
@@ -162,10 +201,41 @@ class UserConversationHistory(models.Model):
     created_at = models.DateTimeField(default=timezone.now)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            # A user's active chats, keyset-paginated by the chat history endpoint (aiCoach/pagination.py)
+            models.Index(fields=['user', 'created_at', 'id'], condition=models.Q(is_active=True), name='chat_history_user_active'),
+            # The chats still waiting for a label, oldest first (tasks.generate_chat_labels)
+            models.Index(
+                fields=['created_at'],
+                condition=models.Q(is_active=True) & (models.Q(chat_label__isnull=True) | models.Q(chat_label='')),
+                name='chat_history_unlabelled',
+            ),
+        ]
+
     def __str__(self):
         return f"Conversation history for {self.user.first_name} {self.user.last_name}"
 
 
+# ConversationMessage Model, one row per message of a conversation (append-only)
+class ConversationMessage(models.Model):
+    chat = models.ForeignKey(UserConversationHistory, on_delete=models.CASCADE, related_name='conversation_messages')
+    sequence = models.PositiveIntegerField()  # Position of the message in the chat, starting at 1
+    role = models.CharField(max_length=10, choices=MESSAGE_ROLES)
+    text = models.TextField()
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        ordering = ['sequence']
+        constraints = [
+            # Also the index used to read a chat's messages in order and its last-N window
+            models.UniqueConstraint(fields=['chat', 'sequence'], name='unique_chat_message_sequence')
+        ]
+
+    def __str__(self):
+        return f"{self.role} message {self.sequence} of chat {self.chat_id}"
+
+
 
 # CoachingPrompt Model
 class CoachingPrompt(models.Model):
@@ -175,6 +245,14 @@ class CoachingPrompt(models.Model):
     created_at = models.DateTimeField(default=timezone.now)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            # Keyset pagination of the list endpoint (aiCoach/pagination.py)
+            models.Index(fields=['created_at', 'id'], name='coaching_prompt_keyset'),
+            # The active prompt of a coaching step (aiCoach/prompts.py)
+            models.Index(fields=['category'], condition=models.Q(is_active=True), name='coaching_prompt_active'),
+        ]
+
     def __str__(self):
         return f"{self.category}"
 
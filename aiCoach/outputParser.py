@@ -3,7 +3,11 @@ from typing import List, Dict
 from pydantic import BaseModel, Field
 
 class ChatLabelParser(BaseModel):
+    chatId: str = Field(description="Chat ID of the conversation, as given in the input")
     chatLabel: str = Field(description="Response from AI for conversation label")
+
+class ChatLabelsParser(BaseModel):
+    labels: List[ChatLabelParser] = Field(description="One label for every conversation in the input")
     
 class ChatParser(BaseModel):
     message: str = Field(description="Response from AI")
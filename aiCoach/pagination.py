@@ -0,0 +1,100 @@
+import base64
+import binascii
+import json
+
+from django.conf import settings
+from django.db.models import BooleanField, Field, Func, Value
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class Row(Func):
+    """
+    A row value, `(a, b, ...)`.
+    """
+    template = '(%(expressions)s)'
+    output_field = Field()
+
+
+class RowComparison(Func):
+    """
+    A row-wise comparison such as `(created_at, id) < (%s, %s)`, which
+    Postgres uses as an index condition on the row's columns.
+    """
+    template = '%(expressions)s'
+    output_field = BooleanField()
+
+    def __init__(self, lhs, operator, rhs):
+        self.arg_joiner = f' {operator} '
+        super().__init__(lhs, rhs)
+
+
+class KeysetPagination(BasePagination):
+    """
+    Keyset pagination on (created_at, id). A page is read with
+    `WHERE (created_at, id) < cursor ORDER BY created_at DESC, id DESC LIMIT n`
+    (or the ascending equivalent), so with an index on the filter columns
+    followed by (created_at, id) a deep page costs the same as the first one,
+    unlike OFFSET. Responses are `{"next": <url or null>, "results": [...]}`;
+    the client follows `next` (an opaque `?cursor=`) until it is null.
+    """
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    invalid_cursor_message = "Invalid cursor"
+
+    def __init__(self, descending=True):
+        self.descending = descending
+        self.ordering = ('-created_at', '-id') if descending else ('created_at', 'id')
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return settings.API_PAGE_SIZE
+        return min(page_size, settings.API_MAX_PAGE_SIZE) if page_size > 0 else settings.API_PAGE_SIZE
+
+    def encode_cursor(self, row):
+        created_at, pk = (row['created_at'], row['id']) if isinstance(row, dict) else (row.created_at, row.pk)
+        return base64.urlsafe_b64encode(json.dumps([created_at.isoformat(), pk]).encode()).decode()
+
+    def decode_cursor(self, request):
+        cursor = request.query_params.get(self.cursor_query_param)
+        if not cursor:
+            return None
+        try:
+            created_at, pk = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            created_at = parse_datetime(created_at)
+            if created_at is None or not isinstance(pk, int):
+                raise ValueError
+        except (binascii.Error, TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+        return created_at, pk
+
+    def after(self, created_at, pk):
+        # As a row value, not `created_at < c OR (created_at = c AND id < i)`, so the
+        # index is sought to the cursor instead of scanned from the first row and filtered
+        return RowComparison(
+            Row('created_at', 'id'), '<' if self.descending else '>', Row(Value(created_at), Value(pk)),
+        )
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        page_size = self.get_page_size(request)
+        position = self.decode_cursor(request)
+        if position:
+            queryset = queryset.filter(self.after(*position))
+        # One extra row tells whether there is a next page
+        rows = list(queryset.order_by(*self.ordering)[:page_size + 1])
+        self.next_cursor = self.encode_cursor(rows[page_size - 1]) if len(rows) > page_size else None
+        return rows[:page_size]
+
+    def get_next_link(self):
+        if self.next_cursor is None:
+            return None
+        return replace_query_param(self.request.build_absolute_uri(), self.cursor_query_param, self.next_cursor)
+
+    def get_paginated_response(self, data):
+        return Response({"next": self.get_next_link(), "results": data})
@@ -0,0 +1,145 @@
+from string import Formatter
+
+from langchain_core.output_parsers import PydanticOutputParser
+
+from aiCoach.cache import LocalLRUCache, VersionedCache
+from aiCoach.db_router import REFERENCE_DATA, replica_reads
+from aiCoach.models import CategoryLevel, CoachingPrompt
+from aiCoach.outputParser import ChatParser
+from aiCoach.structured_output import format_instructions
+
+# Coaching prompt templates by step category. The version is bumped by the
+# CoachingPrompt save/delete signals (see aiCoach/signals.py).
+COACHING_PROMPT_CACHE = VersionedCache('coaching-prompt', maxsize=32)
+
+# Compact level definitions by goal category, for the OPTIONS steps. The
+# version is bumped by the CategoryLevel save/delete signals.
+CATEGORY_LEVEL_CACHE = VersionedCache('category-level-prompt', maxsize=16)
+
+# Compiled coaching prompts by (step category, prompt version), per process
+COMPILED_PROMPTS = LocalLRUCache(maxsize=32)
+
+# JSON schema instructions for the coach's reply. Generating them means building
+# the JSON schema of ChatParser, so it is done once at import.
+CHAT_FORMAT_INSTRUCTIONS = PydanticOutputParser(pydantic_object=ChatParser).get_format_instructions()
+
+# What coaching prompts get for {format_instructions}: only a short note when the
+# schema is sent as the structured output format (settings.LLM_STRUCTURED_OUTPUT)
+COACH_FORMAT_INSTRUCTIONS = format_instructions(ChatParser)
+
+# Appended to every coaching step prompt
+CONVERSATION_TEMPLATE = (
+    " ### Conversation History: This is the conversation done with {user_name}, "
+    "get a summary from it to proceed ahead: {conversation_history} "
+    "### Do not add any message on behalf of the user; if the user's message is empty, keep it empty. "
+    "### {user_name}'s latest message: This is {user_name}'s message/reply to you. "
+    "Analyze it to get further actions: {user_message}"
+)
+
+
+class CompiledPrompt:
+    """
+    A prompt template parsed once into literal text and fields. Constants (such
+    as the format instructions) are substituted at compile time, so rendering a
+    turn is a single pass that joins the literals with the turn's values.
+    """
+
+    def __init__(self, template, constants=None):
+        constants = constants or {}
+        self.parts = []  # Literal strings and (field_name, conversion, format_spec) tuples
+        literal = []
+
+        for text, field_name, format_spec, conversion in Formatter().parse(template):
+            literal.append(text)
+            if field_name is None:
+                continue
+            if field_name in constants:
+                literal.append(format_value(constants[field_name], conversion, format_spec))
+                continue
+            self.parts.append("".join(literal))
+            literal = []
+            self.parts.append((field_name, conversion, format_spec))
+
+        self.parts.append("".join(literal))
+        self.input_variables = sorted({part[0] for part in self.parts if isinstance(part, tuple)})
+
+    def render(self, **values):
+        return "".join(
+            part if isinstance(part, str) else format_value(values[part[0]], part[1], part[2])
+            for part in self.parts
+        )
+
+
+def format_value(value, conversion, format_spec):
+    # Same conversion rules as str.format
+    if conversion == 'r':
+        value = repr(value)
+    elif conversion == 's':
+        value = str(value)
+    elif conversion == 'a':
+        value = ascii(value)
+    return format(value, format_spec or "")
+
+
+def get_coaching_prompt(category):
+    """
+    Retrieves the coaching prompt for the given category.
+    """
+    return COACHING_PROMPT_CACHE.get_or_set(category, lambda: load_coaching_prompt(category))
+
+
+def load_coaching_prompt(category):
+    with replica_reads(REFERENCE_DATA):
+        prompt = CoachingPrompt.objects.filter(category=category, is_active=True).first()
+    if not prompt:
+        raise ValueError(f"No active coaching prompt found for category: {category}")
+    return prompt.prompt
+
+
+def get_compiled_prompt(category):
+    """
+    Returns the compiled coaching prompt (step template, format instructions and
+    conversation section) for the given category at the current prompt version.
+    """
+    key = (category, COACHING_PROMPT_CACHE.get_version())
+    compiled = COMPILED_PROMPTS.get(key)
+    if compiled is None:
+        compiled = CompiledPrompt(
+            get_coaching_prompt(category) + CONVERSATION_TEMPLATE,
+            constants={"format_instructions": COACH_FORMAT_INSTRUCTIONS},
+        )
+        COMPILED_PROMPTS.set(key, compiled)
+    return compiled
+
+
+def get_category_level_prompt(category):
+    """
+    Returns the prompt fragment with the active level definitions of the given
+    goal category ("" if it has none).
+    """
+    return CATEGORY_LEVEL_CACHE.get_or_set(category, lambda: load_category_level_prompt(category))
+
+
+def load_category_level_prompt(category):
+    with replica_reads(REFERENCE_DATA):
+        levels = list(
+            CategoryLevel.objects.filter(category=category, is_active=True)
+            .order_by('level').values('level', 'description', 'examples', 'invalid_examples')
+        )
+    return format_category_levels(levels)
+
+
+def format_category_levels(levels):
+    """
+    One line per level with only what the coach needs: the description,
+    examples and invalid examples (empty fields are left out).
+    """
+    lines = []
+    for level in levels:
+        line = f"Level {level['level']}: {level['description'] or ''}".rstrip()
+        if level['examples']:
+            line += f" Examples: {level['examples']}"
+        if level['invalid_examples']:
+            line += f" Invalid examples: {level['invalid_examples']}"
+        lines.append(line)
+    return "\n".join(lines)
@@ -0,0 +1,322 @@
+import asyncio
+import logging
+import time
+import uuid
+from contextlib import asynccontextmanager, contextmanager
+from functools import lru_cache
+
+import redis
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+from aiCoach.history import count_tokens
+from aiCoach.metrics import LLM_DEFERRED_TOTAL, LLM_RATE_LIMIT_WAIT
+from aiCoach.timing import record_timing
+
+logger = logging.getLogger(__name__)
+
+# Priority classes of LLM work. Background classes cannot use the share of the
+# quota reserved for interactive calls (settings.LLM_PRIORITY_RESERVES) and are
+# deferred while interactive calls are slower than LLM_INTERACTIVE_LATENCY_TARGET.
+# Hedges are the duplicate requests of the router backend (aiCoach/llm_router.py).
+INTERACTIVE = 'interactive'
+SUMMARY = 'summary'
+LABEL = 'label'
+HEDGE = 'hedge'
+
+# Atomically refills the request and token buckets, checks them and the
+# in-flight calls, and either takes one request, `cost` tokens and a slot
+# (returns 0) or returns the milliseconds to wait before trying again. The
+# `reserve` share of each limit is kept free for higher priority calls.
+# KEYS: request bucket, token bucket, in-flight sorted set
+# ARGV: rpm, tpm, cost, max concurrency, slot id, slot ttl (ms), retry (ms), reserve
+ACQUIRE_SCRIPT = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + tonumber(time[2]) / 1000
+local rpm, tpm, cost = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local max_concurrency, slot_ttl, retry = tonumber(ARGV[4]), tonumber(ARGV[6]), tonumber(ARGV[7])
+local reserve = tonumber(ARGV[8])
+
+local function level(key, per_minute)
+    local bucket = redis.call('HMGET', key, 'level', 'updated')
+    local value = tonumber(bucket[1]) or per_minute
+    local updated = tonumber(bucket[2]) or now
+    return math.min(per_minute, value + (now - updated) * per_minute / 60000)
+end
+
+local requests = rpm > 0 and level(KEYS[1], rpm) or 0
+local tokens = tpm > 0 and level(KEYS[2], tpm) or 0
+cost = math.min(cost, tpm * (1 - reserve))
+local wait = 0
+if rpm > 0 and requests < 1 + reserve * rpm then
+    wait = math.max(wait, (1 + reserve * rpm - requests) * 60000 / rpm)
+end
+if tpm > 0 and tokens < cost + reserve * tpm then
+    wait = math.max(wait, (cost + reserve * tpm - tokens) * 60000 / tpm)
+end
+if max_concurrency > 0 then
+    redis.call('ZREMRANGEBYSCORE', KEYS[3], '-inf', now - slot_ttl)
+    if redis.call('ZCARD', KEYS[3]) >= math.max(1, math.floor(max_concurrency * (1 - reserve))) then
+        wait = math.max(wait, retry)
+    end
+end
+if wait > 0 then
+    return math.ceil(wait)
+end
+
+if rpm > 0 then
+    redis.call('HSET', KEYS[1], 'level', requests - 1, 'updated', now)
+    redis.call('PEXPIRE', KEYS[1], 60000)
+end
+if tpm > 0 then
+    redis.call('HSET', KEYS[2], 'level', tokens - cost, 'updated', now)
+    redis.call('PEXPIRE', KEYS[2], 60000)
+end
+if max_concurrency > 0 then
+    redis.call('ZADD', KEYS[3], now, ARGV[5])
+    redis.call('PEXPIRE', KEYS[3], slot_ttl)
+end
+return 0
+"""
+
+# Updates the moving average of interactive call latency (KEYS[1]) with a new
+# duration ARGV[1] (seconds). The average expires after ARGV[3] ms without calls.
+# ARGV: duration, smoothing factor, window (ms)
+RECORD_LATENCY_SCRIPT = """
+local duration, alpha, window = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local average = tonumber(redis.call('GET', KEYS[1]))
+if average then
+    duration = alpha * duration + (1 - alpha) * average
+end
+redis.call('SET', KEYS[1], tostring(duration), 'PX', window)
+return redis.status_reply('OK')
+"""
+
+
+class LLMRateLimitError(APIException):
+    """
+    No LLM quota became free within LLM_RATE_LIMIT_MAX_WAIT.
+    """
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = "The coach is busy right now. Please try again in a moment."
+    default_code = 'llm_rate_limited'
+
+
+@lru_cache(maxsize=None)
+def get_redis():
+    # redis-py reconnects after fork, so one client per process is safe
+    return redis.Redis.from_url(settings.LLM_RATE_LIMIT_REDIS_URL)
+
+
+class LLMRateLimiter:
+    """
+    Limits the LLM calls of all web and Celery processes to the deployment's
+    quota with Redis token buckets: LLM_RATE_LIMIT_RPM requests and
+    LLM_RATE_LIMIT_TPM tokens per minute, and at most LLM_MAX_CONCURRENCY calls
+    in flight. A call counts its prompt tokens plus MAX_TOKENS, the same
+    estimate Azure OpenAI charges against the TPM quota when a request comes in.
+    Calls wait for quota up to LLM_RATE_LIMIT_MAX_WAIT seconds instead of
+    failing with a 429. If Redis is unavailable, calls are not limited.
+
+    Calls have a priority class. Background calls (summaries, labels) leave
+    their reserved share of every limit to interactive coach calls, and callers
+    defer them (`should_defer`) while the moving average of interactive call
+    latency is above LLM_INTERACTIVE_LATENCY_TARGET.
+
+    `rpm`, `tpm` and `max_concurrency` override the settings, e.g. for the
+    quota of a single deployment of the router backend.
+    """
+
+    def __init__(self, namespace, rpm=None, tpm=None, max_concurrency=None):
+        self.keys = [f"aicoach:{namespace}:{name}" for name in ("requests", "tokens", "in-flight")]
+        self.latency_key = f"aicoach:{namespace}:interactive-latency"
+        self.limits = {"rpm": rpm, "tpm": tpm, "max_concurrency": max_concurrency}
+
+    @property
+    def rpm(self):
+        return settings.LLM_RATE_LIMIT_RPM if self.limits["rpm"] is None else self.limits["rpm"]
+
+    @property
+    def tpm(self):
+        return settings.LLM_RATE_LIMIT_TPM if self.limits["tpm"] is None else self.limits["tpm"]
+
+    @property
+    def max_concurrency(self):
+        return settings.LLM_MAX_CONCURRENCY if self.limits["max_concurrency"] is None else self.limits["max_concurrency"]
+
+    def enabled(self):
+        return bool(self.rpm or self.tpm or self.max_concurrency)
+
+    def cost(self, prompt_tokens):
+        return prompt_tokens + settings.AZURE_OPENAI_CHAT_MAX_TOKENS
+
+    def try_acquire(self, cost, priority, slot):
+        """
+        Takes quota for one call, or returns the seconds to wait before trying again.
+        """
+        wait_ms = get_redis().eval(
+            ACQUIRE_SCRIPT, len(self.keys), *self.keys,
+            self.rpm, self.tpm, cost, self.max_concurrency,
+            slot, int(settings.LLM_REQUEST_TIMEOUT * 1000), int(settings.LLM_RATE_LIMIT_RETRY * 1000),
+            settings.LLM_PRIORITY_RESERVES.get(priority, 0),
+        )
+        return wait_ms / 1000
+
+    def release(self, slot):
+        if self.max_concurrency:
+            get_redis().zrem(self.keys[2], slot)
+
+    @contextmanager
+    def limit(self, prompt, priority=INTERACTIVE):
+        """
+        Waits for quota for a call with `prompt` (text, or its token count) and
+        holds a concurrency slot for the duration of the block.
+        """
+        slot = None
+        if self.enabled():
+            slot = uuid.uuid4().hex
+            if not self.acquire(self.cost(prompt_tokens(prompt)), priority, slot, time.perf_counter()):
+                slot = None
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            if slot:
+                self.safe_release(slot)
+        if priority == INTERACTIVE:
+            self.record_latency(time.perf_counter() - started)
+
+    @asynccontextmanager
+    async def alimit(self, prompt, priority=INTERACTIVE):
+        """
+        Async variant of `limit`.
+        """
+        slot = None
+        if self.enabled():
+            slot = uuid.uuid4().hex
+            if not await self.aacquire(self.cost(prompt_tokens(prompt)), priority, slot, time.perf_counter()):
+                slot = None
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            if slot:
+                await sync_to_async(self.safe_release, thread_sensitive=False)(slot)
+        if priority == INTERACTIVE:
+            await sync_to_async(self.record_latency, thread_sensitive=False)(time.perf_counter() - started)
+
+    @contextmanager
+    def try_limit(self, prompt, priority=INTERACTIVE):
+        """
+        Like `limit`, but does not wait: yields whether quota for the call was
+        taken. If it was not, nothing is taken and the call should not be made.
+        """
+        slot = None
+        if self.enabled():
+            slot = uuid.uuid4().hex
+            wait = self.safe_try_acquire(self.cost(prompt_tokens(prompt)), priority, slot)
+            if wait:
+                yield False
+                return
+            if wait is None:
+                slot = None
+        try:
+            yield True
+        finally:
+            if slot:
+                self.safe_release(slot)
+
+    def acquire(self, cost, priority, slot, started):
+        while True:
+            wait = self.safe_try_acquire(cost, priority, slot)
+            if wait is None:
+                return False
+            if not wait:
+                self.observe_wait(priority, started)
+                return True
+            self.check_deadline(priority, started, wait)
+            time.sleep(wait)
+
+    async def aacquire(self, cost, priority, slot, started):
+        while True:
+            wait = await sync_to_async(self.safe_try_acquire, thread_sensitive=False)(cost, priority, slot)
+            if wait is None:
+                return False
+            if not wait:
+                self.observe_wait(priority, started)
+                return True
+            self.check_deadline(priority, started, wait)
+            await asyncio.sleep(wait)
+
+    def safe_try_acquire(self, cost, priority, slot):
+        # None: Redis is unavailable and the call goes ahead unlimited
+        try:
+            return self.try_acquire(cost, priority, slot)
+        except redis.RedisError as error:
+            logger.warning("LLM rate limiter unavailable, not limiting: %s", error)
+            return None
+
+    def safe_release(self, slot):
+        try:
+            self.release(slot)
+        except redis.RedisError as error:
+            # The slot expires after LLM_REQUEST_TIMEOUT
+            logger.warning("Could not release LLM rate limiter slot: %s", error)
+
+    def check_deadline(self, priority, started, wait):
+        if time.perf_counter() - started + wait > settings.LLM_RATE_LIMIT_MAX_WAIT:
+            self.observe_wait(priority, started)
+            raise LLMRateLimitError()
+
+    def observe_wait(self, priority, started):
+        waited = time.perf_counter() - started
+        LLM_RATE_LIMIT_WAIT.labels(priority).observe(waited)
+        record_timing("llm_queue", waited)
+
+    def record_latency(self, seconds):
+        if settings.LLM_INTERACTIVE_LATENCY_TARGET <= 0:
+            return
+        try:
+            get_redis().eval(
+                RECORD_LATENCY_SCRIPT, 1, self.latency_key,
+                seconds, settings.LLM_INTERACTIVE_LATENCY_SMOOTHING, int(settings.LLM_INTERACTIVE_LATENCY_WINDOW * 1000),
+            )
+        except redis.RedisError as error:
+            logger.warning("Could not record interactive LLM latency: %s", error)
+
+    def interactive_latency(self):
+        """
+        Moving average of the latency of recent interactive calls in seconds, or
+        None if there were none within LLM_INTERACTIVE_LATENCY_WINDOW.
+        """
+        try:
+            latency = get_redis().get(self.latency_key)
+        except redis.RedisError as error:
+            logger.warning("Could not read interactive LLM latency: %s", error)
+            return None
+        return float(latency) if latency is not None else None
+
+    def should_defer(self, priority):
+        """
+        Whether background work of `priority` should be put off (and is counted
+        as deferred) because interactive calls are slower than the target.
+        """
+        target = settings.LLM_INTERACTIVE_LATENCY_TARGET
+        if priority == INTERACTIVE or target <= 0:
+            return False
+        latency = self.interactive_latency()
+        if latency is None or latency <= target:
+            return False
+        logger.info("Deferring %s LLM work, interactive latency %.2fs is above %.2fs", priority, latency, target)
+        LLM_DEFERRED_TOTAL.labels(priority).inc()
+        return True
+
+
+def prompt_tokens(prompt):
+    return prompt if isinstance(prompt, int) else count_tokens(prompt)
+
+
+# Shared by every LLM call of the configured deployment
+LLM_RATE_LIMITER = LLMRateLimiter('llm-quota')
@@ -0,0 +1,54 @@
+import hashlib
+from functools import wraps
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.cache import patch_cache_control
+from django.utils.http import parse_etags
+
+from aiCoach.cache import VersionedCache
+from aiCoach.timing import TimedJSONRenderer
+
+# Rendered list responses of the reference data endpoints (categories, levels,
+# level examples). The version is bumped by the save/delete signals of these
+# models (see aiCoach/signals.py) and is part of every ETag.
+REFERENCE_DATA_CACHE = VersionedCache('reference-data', maxsize=256)
+
+
+def url_digest(request):
+    # The page and page size are in the query string; the `next` links include the host
+    return hashlib.sha256(request.build_absolute_uri().encode()).hexdigest()[:16]
+
+
+def etag_matches(request, etag):
+    etags = parse_etags(request.headers.get('If-None-Match', ''))
+    return '*' in etags or any(tag.removeprefix('W/') == etag for tag in etags)
+
+
+def cache_versioned_response(versioned_cache):
+    """
+    Decorator for read-only JSON views whose data is versioned by
+    `versioned_cache`. The rendered body is cached per version and URL, and
+    responses carry a strong ETag of the version and URL plus a
+    `Cache-Control` max-age of REFERENCE_DATA_MAX_AGE. A request whose
+    `If-None-Match` has the current ETag gets a 304 without a DB query.
+    Apply it under `api_view`; the view must return a 200 `Response`.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            digest = url_digest(request)
+            etag = f'"{versioned_cache.get_version()}-{digest}"'
+            if etag_matches(request, etag):
+                response = HttpResponseNotModified()
+            else:
+                content = versioned_cache.get_or_set(
+                    f"response:{digest}",
+                    lambda: TimedJSONRenderer().render(view(request, *args, **kwargs).data),
+                )
+                response = HttpResponse(content, content_type='application/json')
+            response['ETag'] = etag
+            patch_cache_control(response, public=True, max_age=settings.REFERENCE_DATA_MAX_AGE)
+            return response
+        return wrapper
+    return decorator
@@ -1,6 +1,7 @@
 # serializers.py
 from rest_framework import serializers
 from .models import Category, CategoryLevel, CategoryLevelExample, CoachingPrompt, User, UserCallStatementsWithLevel, UserConversationHistory, UserGoal, UserPerformanceData
+from .utils import group_turns
 
 class UserSerializer(serializers.ModelSerializer):
     class Meta:
@@ -44,11 +45,24 @@ class UserPerformanceDataSerializer(serializers.ModelSerializer):
         fields = '__all__'
 
 class UserConversationHistorySerializer(serializers.ModelSerializer):
+    # Assembled from the ConversationMessage rows; prefetch `conversation_messages` when serializing many
+    messages = serializers.SerializerMethodField()
+
+    def get_messages(self, obj):
+        return group_turns(obj.conversation_messages.all())
+
     class Meta:
         model = UserConversationHistory
         fields = ['chat_id', 'messages', 'summary', 'chat_label', 'isGoalStepCompleted', 'isRealityStepCompleted', 'isOptionStepCompleted', 'isOptionImprovementStepCompleted', 'isWillStepCompleted', 'is_active']
 
 
+# Conversation state without the messages, as used by the coaching turn
+class ConversationStateSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = UserConversationHistory
+        fields = ['chat_id', 'summary', 'chat_label', 'isGoalStepCompleted', 'isRealityStepCompleted', 'isOptionStepCompleted', 'isOptionImprovementStepCompleted', 'isWillStepCompleted', 'is_active']
+
+
 class CoachingPromptSerializer(serializers.ModelSerializer):
     class Meta:
         model = CoachingPrompt
@@ -1,221 +1,315 @@
+import logging
+
+from asgiref.sync import sync_to_async
 from django.core.exceptions import ValidationError, ObjectDoesNotExist
 from django.core.validators import validate_email
 from aiCoach.models import (
     Category,
     CategoryLevel,
     CategoryLevelExample,
-    CoachingPrompt,
     User,
     UserCallStatementsWithLevel,
     UserConversationHistory,
     UserGoal,
     UserPerformanceData,
 )
-from langchain.prompts import PromptTemplate
-from langchain.output_parsers import PydanticOutputParser
+from aiCoach.utils import CHAT_API, LLM_MODEL, split_turn
+from aiCoach.streaming import MessageStreamExtractor
+from aiCoach.llm import LLM_RESPONSE_CACHE, is_cacheable_turn
+from aiCoach.history import build_conversation_history, history_token_budget
+from aiCoach.metrics import LLM_PARSE_FAILURES_TOTAL, observe_llm_call, observe_phase
+from aiCoach.chat_session import allocate_message_sequences, set_chat_session
+from aiCoach.context import CATEGORY_LEVEL_STEPS, COACHING_STEPS, RECENT_MESSAGES_WINDOW
 from aiCoach.outputParser import ChatParser
-from aiCoach.utils import CHAT_API, LLM_MODEL, parse_response
-from collections import deque
-from aiCoach.serializers import (
-    UserCallStatementsWithLevelSerializer,
-    UserConversationHistorySerializer,
-    UserGoalSerializer,
-    UserPerformanceDataSerializer,
-)
+from aiCoach.prompts import get_category_level_prompt, get_compiled_prompt
+from aiCoach.rate_limit import LLM_RATE_LIMITER
+from aiCoach.structured_output import ainvoke_structured, invoke_structured, parse_reply, structured_output_kwargs
 from aiCoach.tasks import async_save_conversation
-from aiCoach.utils import format_dict
+from aiCoach.log import log_payload
 
 # Uncomment for debugging
 # set_debug(True)
 
-print("CHAT_API:", CHAT_API)
+logger = logging.getLogger(__name__)
+logger.debug("CHAT_API: %s", CHAT_API)
+
 
+COACHING_COMPLETED_MESSAGE = "We've completed all coaching steps. How else can I assist you today?"
 
-def chat_with_coach(user_name, user_id, chat_id, user_message=""):
+
+def chat_with_coach(context, user_message=""):
     """
     Main function to handle chat with the coach.
     """
-    # Initialize conversation history
-    chat_history = deque(maxlen=10)  # Keep the last 10 messages
-
-    print("User Name:", user_name)
-    print("User Message:", user_message)
-    print("Chat ID:", chat_id)
-
-    # Get the user's conversation history
-    conversation_history = get_conversation(chat_id)
-    conversation_history_serialized = UserConversationHistorySerializer(
-        conversation_history, many=True
-    ).data
-
-    print("Serialized Conversation History:", conversation_history_serialized)
-
-    # Check if conversation history is empty
-    if not conversation_history_serialized:
-        print(f"No conversation history found, starting new session for chat_id: {chat_id}")
-        conversation_history_serialized = [
-            {
-                "messages": [],
-                "summary": {},
-                "chat_label": "",
-                "isGoalStepCompleted": False,
-                "isRealityStepCompleted": False,
-                "isOptionStepCompleted": False,
-                "isOptionImprovementStepCompleted": False,
-                "isWillStepCompleted": False,
-            }
-        ]
-        chat_history = []
-        messages = []
-    else:
-        messages = conversation_history_serialized[0].get('messages') or []
-        print("Messages:", messages)
-
-        # Get the last 10 messages or fewer if available
-        last_messages = messages[-10:]  # Slices the last 10 messages from the list
-
-        # Iterate through the last messages and format them
-        for message in last_messages:
-            # Safely check if the 'user' key exists and is not empty
-            message_text = message.get('user', '')
-            if message_text:  # If message_text is not empty
-                chat_history.append(f"User: {message_text}")
-            if 'coach' in message:
-                chat_history.append(f"Coach: {message['coach']}")
-
-    print("Chat History:", chat_history)
-
-    # Get call statements, user goal, and performance data
-    call_statements = UserCallStatementsWithLevelSerializer(
-        user_call_statements(user_id), many=True
-    ).data
-    user_goal = UserGoalSerializer(get_user_goal(user_id)).data
-    user_goal = format_dict(user_goal)
-    user_performance_data = UserPerformanceDataSerializer(
-        get_user_performance_data(user_id), many=True
-    ).data
-    user_performance_data = format_dict(user_performance_data)
-
-    print("User Goal:", user_goal)
-    print("User Performance Data:", user_performance_data)
-
-    performance_data = {
-        "skills": user_performance_data,
-        "last_call": call_statements,
-    }
-
-    # Create a list of steps and their corresponding status keys
-    steps = [
-        ('GOAL', 'isGoalStepCompleted'),
-        ('REALITY', 'isRealityStepCompleted'),
-        ('OPTIONS', 'isOptionStepCompleted'),
-        ('OPTION_IMPROVEMENT', 'isOptionImprovementStepCompleted'),
-        ('WILL', 'isWillStepCompleted'),
-    ]
+    log_payload(logger, "Chat %s, user %s: %s", context.chat_id, context.user_name, user_message)
 
-    # Iterate through the steps and call the generalized coach function
-    for step_type, step_key in steps:
-        print(f"Processing step: {step_type}")
-        if not conversation_history_serialized[0][step_key]:
-            result = coach(
-                step_type=step_type,
-                user_name=user_name,
-                user_message=user_message,
-                goal=user_goal,
-                performance_data=performance_data,
-                conversation_history=chat_history,
-            )
-
-            print("Result:", result)
-
-            # Add the new messages to the conversation history
-            if user_message and user_message.strip():  # Check if user_message is not empty or just whitespace
-                messages.append({"user": user_message, "coach": result["message"]})  # Add both
-            else:
-                messages.append({"coach": result["message"]})  # Only add coach message
-
-            # Save the conversation asynchronously
-            async_save_conversation.delay(
-                user_id=user_id,
-                chat_id=chat_id,
-                user_goal=user_goal,
-                messages=messages,
-                conversation_data=result,
-                previous_conversation_data=conversation_history_serialized[0],
-            )
-
-            # Return the result without waiting for the async save
-            return result
+    step_type = context.pending_step
 
     # If all steps are completed, continue the conversation or conclude
-    result = {
-        "message": "We've completed all coaching steps. How else can I assist you today?"
-    }
-    print("Result:", result)
+    if step_type is None:
+        return {"message": COACHING_COMPLETED_MESSAGE}
+
+    logger.debug("Chat %s: processing step %s", context.chat_id, step_type)
+    result = coach(step_type=step_type, context=context, user_message=user_message)
+    log_payload(logger, "Chat %s result: %s", context.chat_id, result)
+
+    with observe_phase("enqueue"):
+        complete_chat_turn(context, user_message, result)
+
+    # Return the result without waiting for the async save
     return result
 
 
-def coach(step_type, user_name, user_message, goal, performance_data, conversation_history):
+def stream_chat_with_coach(context, user_message=""):
     """
-    Generalized coaching function to handle different coaching steps.
+    Streaming variant of `chat_with_coach`. Yields `(event, data)` tuples:
+    a `token` event for every new piece of the coach's message as the LLM
+    generates it, then a single `done` event with the full parsed result
+    (message and GROW step flags) once the conversation save is enqueued.
     """
-    input_variables = ["user_name", "goal", "performance_data"]
-    parser = PydanticOutputParser(pydantic_object=ChatParser)
-    partial_variables = {
-        "format_instructions": parser.get_format_instructions(),
-    }
+    step_type = context.pending_step
 
-    # Additional variables for OPTIONS and OPTION_IMPROVEMENT steps
-    if step_type in ["OPTIONS", "OPTION_IMPROVEMENT"]:
-        input_variables.append("category_level_data")
-        category_levels = CategoryLevel.objects.filter(category=goal["category"])
-        category_level_data = list(category_levels.values())
-    else:
-        category_level_data = None
+    if step_type is None:
+        result = {"message": COACHING_COMPLETED_MESSAGE}
+        yield "token", {"text": result["message"]}
+        yield "done", result
+        return
 
-    prompt_template = get_coaching_prompt(step_type)
+    prompt = build_coach_prompt(step_type=step_type, context=context, user_message=user_message)
+    cacheable = is_cacheable_turn(step_type, user_message)
+    cached_content = LLM_RESPONSE_CACHE.get(prompt) if cacheable else None
 
-    prompt = PromptTemplate(
-        input_variables=input_variables,
-        partial_variables=partial_variables,
-        template=prompt_template,
-    )
+    extractor = MessageStreamExtractor()
+    response_chunks = []
+    # A cached reply is sent as a single chunk
+    chunks = [cached_content] if cached_content is not None else stream_coach_reply(step_type, prompt)
+    for content in chunks:
+        response_chunks.append(content)
+        text = extractor.feed(content)
+        if text:
+            yield "token", {"text": text}
+
+    result = finish_streamed_reply(context, step_type, prompt, "".join(response_chunks), extractor,
+                                   cache_reply=cacheable and cached_content is None)
+
+    with observe_phase("enqueue"):
+        complete_chat_turn(context, user_message, result)
+
+    yield "done", result
 
-    # Construct a full prompt that includes the conversation history
-    full_prompt = (
-        f"{prompt.template} ### Conversation History: This is the conversation done with {user_name}, "
-        f"get a summary from it to proceed ahead: {''.join(conversation_history)} "
-        f"### Do not add any message on behalf of the user; if the user's message is empty, keep it empty. "
-        f"### {user_name}'s latest message: This is {user_name}'s message/reply to you. Analyze it to get further actions: {user_message}"
+
+async def astream_chat_with_coach(context, user_message=""):
+    """
+    Async variant of `stream_chat_with_coach` for ASGI. The reply is streamed
+    with `astream`, so a turn waiting on the model does not hold a worker thread.
+    """
+    step_type = context.pending_step
+
+    if step_type is None:
+        result = {"message": COACHING_COMPLETED_MESSAGE}
+        yield "token", {"text": result["message"]}
+        yield "done", result
+        return
+
+    # The compiled prompt and the response cache may fall back to the DB and Redis
+    prompt = await sync_to_async(build_coach_prompt)(step_type=step_type, context=context, user_message=user_message)
+    cacheable = is_cacheable_turn(step_type, user_message)
+    cached_content = await sync_to_async(LLM_RESPONSE_CACHE.get)(prompt) if cacheable else None
+
+    async def cached_reply():
+        # A cached reply is sent as a single chunk
+        yield cached_content
+
+    extractor = MessageStreamExtractor()
+    response_chunks = []
+    chunks = cached_reply() if cached_content is not None else astream_coach_reply(step_type, prompt)
+    async for content in chunks:
+        response_chunks.append(content)
+        text = extractor.feed(content)
+        if text:
+            yield "token", {"text": text}
+
+    result = await sync_to_async(finish_streamed_reply)(
+        context, step_type, prompt, "".join(response_chunks), extractor,
+        cache_reply=cacheable and cached_content is None,
     )
 
-    # Prepare the prompt parameters
-    prompt_params = {
-        "user_name": user_name,
-        "goal": goal,
-        "performance_data": performance_data,
-        "format_instructions": partial_variables["format_instructions"],
-    }
+    # Publishing to the broker is blocking I/O
+    with observe_phase("enqueue"):
+        await sync_to_async(complete_chat_turn)(context, user_message, result)
+
+    yield "done", result
+
+
+def finish_streamed_reply(context, step_type, prompt, content, extractor, cache_reply):
+    """
+    Parses a streamed reply into the turn's result, and caches it if it parsed
+    and `cache_reply` is set.
+    """
+    try:
+        result = parse_reply(content, ChatParser)
+    except ValueError:
+        # The reply is already streamed, so it is not retried; keep what the client got as the message
+        LLM_PARSE_FAILURES_TOTAL.labels("coach", step_type).inc()
+        result = {"message": extractor.text}
+    else:
+        if cache_reply:
+            LLM_RESPONSE_CACHE.set(prompt, content)
+    log_payload(logger, "Chat %s result: %s", context.chat_id, result)
+    return result
+
+
+def stream_coach_reply(step_type, prompt):
+    """
+    Yields the text chunks of the coach's reply as the LLM generates them.
+    """
+    # Streamed replies carry no token usage, so only the duration is recorded
+    with LLM_RATE_LIMITER.limit(prompt), observe_llm_call("coach", step_type, track_usage=False):
+        for chunk in LLM_MODEL.stream(prompt, **structured_output_kwargs(ChatParser)):
+            yield chunk.content
+
 
-    if category_level_data:
-        prompt_params["category_level_data"] = category_level_data
+async def astream_coach_reply(step_type, prompt):
+    """
+    Async variant of `stream_coach_reply`.
+    """
+    async with LLM_RATE_LIMITER.alimit(prompt):
+        with observe_llm_call("coach", step_type, track_usage=False):
+            async for chunk in LLM_MODEL.astream(prompt, **structured_output_kwargs(ChatParser)):
+                yield chunk.content
+
+
+async def achat_with_coach(context, user_message=""):
+    """
+    Async variant of `chat_with_coach` for ASGI. The LLM call uses `ainvoke`,
+    so a turn waiting on the model does not hold a worker thread.
+    """
+    step_type = context.pending_step
+
+    if step_type is None:
+        return {"message": COACHING_COMPLETED_MESSAGE}
+
+    result = await acoach(step_type=step_type, context=context, user_message=user_message)
 
-    # Use the LLM to generate a response
-    response = LLM_MODEL.invoke(full_prompt.format(**prompt_params))
+    # Publishing to the broker is blocking I/O
+    with observe_phase("enqueue"):
+        await sync_to_async(complete_chat_turn)(context, user_message, result)
 
-    # Parse and return the response
-    result = parse_response(response.content)
     return result
 
 
-def get_coaching_prompt(category):
+def complete_chat_turn(context, user_message, result):
     """
-    Retrieves the coaching prompt for the given category.
+    Writes the latest exchange through to the chat session cache, so the next
+    turn reads it right away, and enqueues its save to Postgres. Only the new
+    turn is sent; the task appends it to the conversation's message rows.
     """
-    prompt = CoachingPrompt.objects.filter(category=category, is_active=True).first()
-    if not prompt:
-        raise ValueError(f"No active coaching prompt found for category: {category}")
-    return prompt.prompt
+    # Check if user_message is not empty or just whitespace
+    if user_message and user_message.strip():
+        turn = {"user": user_message, "coach": result["message"]}  # Add both
+    else:
+        turn = {"coach": result["message"]}  # Only add coach message
+
+    # Allocate the turn's message sequences here, so saves that run out of order keep the order
+    messages = split_turn(turn)
+    last_sequence = context.recent_messages[-1].sequence if context.recent_messages else 0
+    first_sequence = allocate_message_sequences(context.user.id, context.chat_id, len(messages), last_sequence)
+
+    conversation = dict(context.conversation)
+    for _, step_key in COACHING_STEPS:
+        conversation[step_key] = bool(conversation[step_key] or result.get(step_key, False))
+    recent_messages = [
+        {"sequence": message.sequence, "role": message.role, "text": message.text}
+        for message in context.recent_messages
+    ] + [
+        {"sequence": sequence, "role": role, "text": text}
+        for sequence, (role, text) in enumerate(messages, start=first_sequence)
+    ]
+    set_chat_session(context.user.id, context.chat_id, conversation, recent_messages[-RECENT_MESSAGES_WINDOW:])
+
+    # Save the conversation asynchronously
+    async_save_conversation.delay(
+        user_id=context.user.id,
+        chat_id=context.chat_id,
+        turn=turn,
+        conversation_data=result,
+        previous_conversation_data=context.conversation,
+        first_sequence=first_sequence,
+    )
+
+
+def coach(step_type, context, user_message):
+    """
+    Generalized coaching function to handle different coaching steps.
+    """
+    prompt = build_coach_prompt(step_type=step_type, context=context, user_message=user_message)
+
+    def call(prompt):
+        with LLM_RATE_LIMITER.limit(prompt), observe_llm_call("coach", step_type):
+            return LLM_MODEL.invoke(prompt, **structured_output_kwargs(ChatParser))
+
+    def invoke(prompt):
+        # Replies that do not match ChatParser are retried, and never cached
+        return invoke_structured(call, prompt, ChatParser, "coach", step_type)
+
+    # Use the LLM to generate a response (opening turns may be served from the response cache)
+    if is_cacheable_turn(step_type, user_message):
+        response = LLM_RESPONSE_CACHE.invoke(prompt, invoke)
+    else:
+        response = invoke(prompt)
+
+    return parse_reply(response.content, ChatParser)
+
+
+async def acoach(step_type, context, user_message):
+    """
+    Async variant of `coach`.
+    """
+    # The compiled prompt comes from the prompt cache, which may fall back to the DB
+    prompt = await sync_to_async(build_coach_prompt)(step_type=step_type, context=context, user_message=user_message)
+
+    async def call(prompt):
+        async with LLM_RATE_LIMITER.alimit(prompt):
+            with observe_llm_call("coach", step_type):
+                return await LLM_MODEL.ainvoke(prompt, **structured_output_kwargs(ChatParser))
+
+    async def ainvoke(prompt):
+        return await ainvoke_structured(call, prompt, ChatParser, "coach", step_type)
+
+    if is_cacheable_turn(step_type, user_message):
+        response = await LLM_RESPONSE_CACHE.ainvoke(prompt, ainvoke)
+    else:
+        response = await ainvoke(prompt)
+    return parse_reply(response.content, ChatParser)
+
+
+def build_coach_prompt(step_type, context, user_message):
+    """
+    Builds the full LLM prompt for the given coaching step from the loaded
+    CoachingContext, using the step's compiled prompt. The OPTIONS steps get
+    the goal category's levels from the category level cache, so the DB is
+    only read on a cache miss.
+    """
+    prompt_params = {
+        "user_name": context.user_name,
+        "goal": context.goal,
+        "performance_data": context.performance_data,
+        # Recent messages within the step's token budget, with the summary for older ones
+        "conversation_history": build_conversation_history(
+            context.chat_history,
+            context.conversation.get("summary"),
+            history_token_budget(step_type),
+            has_earlier_messages=bool(context.recent_messages) and context.recent_messages[0].sequence > 1,
+        ),
+        "user_message": user_message,
+    }
+
+    # Additional data for OPTIONS and OPTION_IMPROVEMENT steps
+    if step_type in CATEGORY_LEVEL_STEPS and context.goal_category:
+        prompt_params["category_level_data"] = get_category_level_prompt(context.goal_category)
+
+    with observe_phase("prompt"):
+        return get_compiled_prompt(step_type).render(**prompt_params)
 
 
 def get_conversation(chat_id, is_active=True):
@@ -259,7 +353,7 @@ def get_or_update_user(email, password, first_name='', last_name=''):
 
     # Check if the user already exists
     user_exists = User.objects.filter(email=email).exists()
-    print('User exists:', user_exists)
+    logger.debug("User %s exists: %s", email, user_exists)
     if user_exists:
         # If the user exists, update only the password
         user = User.objects.get(email=email)
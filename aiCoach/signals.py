@@ -0,0 +1,85 @@
+from django.db import transaction
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from aiCoach.db_router import REFERENCE_DATA, mark_primary
+from aiCoach.models import (
+    Category,
+    CategoryLevel,
+    CategoryLevelExample,
+    CoachingPrompt,
+    User,
+    UserCallStatementsWithLevel,
+    UserConversationHistory,
+    UserGoal,
+    UserPerformanceData,
+)
+from aiCoach.prompts import CATEGORY_LEVEL_CACHE, COACHING_PROMPT_CACHE
+from aiCoach.reference_data import REFERENCE_DATA_CACHE
+from aiCoach.timing import db_timing_wrapper
+
+
+def bump_on_commit(versioned_cache):
+    """
+    Bumps the cache version once the write is committed, otherwise another
+    worker could reload the old row under the new version. The writer sticks to
+    the primary first, so its own reload doesn't cache the lagging replica's rows.
+    """
+    def bump():
+        mark_primary(REFERENCE_DATA)
+        versioned_cache.bump_version()
+    transaction.on_commit(bump)
+
+
+@receiver(post_save, sender=CoachingPrompt)
+@receiver(post_delete, sender=CoachingPrompt)
+def invalidate_coaching_prompts(sender, **kwargs):
+    bump_on_commit(COACHING_PROMPT_CACHE)
+
+
+@receiver(post_save, sender=CategoryLevel)
+@receiver(post_delete, sender=CategoryLevel)
+def invalidate_category_level_prompts(sender, **kwargs):
+    bump_on_commit(CATEGORY_LEVEL_CACHE)
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+@receiver(post_save, sender=CategoryLevel)
+@receiver(post_delete, sender=CategoryLevel)
+@receiver(post_save, sender=CategoryLevelExample)
+@receiver(post_delete, sender=CategoryLevelExample)
+def invalidate_reference_data(sender, **kwargs):
+    # Creates through the API and admin edits; bulk writes send no signals
+    bump_on_commit(REFERENCE_DATA_CACHE)
+
+
+# Rows whose saves keep the read replica off for the writer (aiCoach/db_router.py)
+REFERENCE_DATA_MODELS = (Category, CategoryLevel, CategoryLevelExample, CoachingPrompt)
+USER_DATA_MODELS = (UserCallStatementsWithLevel, UserConversationHistory, UserGoal, UserPerformanceData)
+
+
+@receiver(post_save)
+@receiver(post_delete)
+def stick_to_primary(sender, instance, **kwargs):
+    # Bulk writes send no signals; chat messages are saved along with their UserConversationHistory
+    if issubclass(sender, REFERENCE_DATA_MODELS):
+        scopes = [REFERENCE_DATA]
+    elif issubclass(sender, User):
+        scopes = [f"user:{instance.pk}"]
+    elif issubclass(sender, USER_DATA_MODELS):
+        scopes = [f"user:{instance.user_id}"]
+        if issubclass(sender, UserConversationHistory):
+            scopes.append(f"chat:{instance.chat_id}")
+    else:
+        return
+    # The sticky window starts once the write is committed
+    transaction.on_commit(lambda: mark_primary(*scopes))
+
+
+@receiver(connection_created)
+def time_queries(sender, connection, **kwargs):
+    # Per-request query time for the Server-Timing header (aiCoach/middleware.py)
+    if db_timing_wrapper not in connection.execute_wrappers:
+        connection.execute_wrappers.append(db_timing_wrapper)
@@ -0,0 +1,100 @@
+import json
+import re
+
+from rest_framework.renderers import BaseRenderer
+
+# Matches the opening of the "message" string value in the coach's JSON reply,
+# e.g. `{"message": "` (with or without whitespace around the colon).
+MESSAGE_FIELD_START = re.compile(r'"message"\s*:\s*"')
+
+JSON_ESCAPES = {
+    '"': '"',
+    '\\': '\\',
+    '/': '/',
+    'b': '\b',
+    'f': '\f',
+    'n': '\n',
+    'r': '\r',
+    't': '\t',
+}
+
+
+class MessageStreamExtractor:
+    """
+    Incrementally pulls the value of the "message" field out of a JSON reply
+    that is still being generated, so it can be forwarded to the client token
+    by token while the rest of the object (the GROW step flags) is still coming.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.position = None  # Index in buffer where the message value starts
+        self.done = False
+        self.text = ""
+
+    def feed(self, chunk):
+        """
+        Adds a chunk of model output and returns the newly decoded part of the
+        message (empty string if nothing new is available yet).
+        """
+        if self.done or not chunk:
+            return ""
+
+        self.buffer += chunk
+
+        if self.position is None:
+            match = MESSAGE_FIELD_START.search(self.buffer)
+            if not match:
+                return ""
+            self.position = match.end()
+
+        decoded = []
+        index = self.position
+        while index < len(self.buffer):
+            char = self.buffer[index]
+            if char == '"':
+                self.done = True
+                index += 1
+                break
+            if char == '\\':
+                # Wait for the rest of the escape sequence before decoding it
+                if index + 1 >= len(self.buffer):
+                    break
+                escape = self.buffer[index + 1]
+                if escape == 'u':
+                    if index + 6 > len(self.buffer):
+                        break
+                    decoded.append(chr(int(self.buffer[index + 2:index + 6], 16)))
+                    index += 6
+                else:
+                    decoded.append(JSON_ESCAPES.get(escape, escape))
+                    index += 2
+                continue
+            decoded.append(char)
+            index += 1
+
+        self.position = index
+        delta = "".join(decoded)
+        self.text += delta
+        return delta
+
+
+def format_sse_event(event, data):
+    """
+    Formats a single Server-Sent Event with a JSON payload.
+    """
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+class EventStreamRenderer(BaseRenderer):
+    """
+    Lets DRF negotiate `Accept: text/event-stream`. Streaming views return a
+    StreamingHttpResponse themselves, so this only renders error responses
+    (404, validation errors, ...) as a single SSE `error` event.
+    """
+    media_type = 'text/event-stream'
+    format = 'event-stream'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return format_sse_event('error', data).encode(self.charset)
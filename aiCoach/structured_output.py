@@ -0,0 +1,129 @@
+import logging
+
+from django.conf import settings
+from langchain_core.output_parsers import PydanticOutputParser
+from pydantic import ValidationError
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+from aiCoach.metrics import LLM_PARSE_FAILURES_TOTAL, LLM_PARSE_RETRIES_TOTAL
+from aiCoach.utils import parse_response
+
+logger = logging.getLogger(__name__)
+
+# With native structured output the schema travels in `response_format`, so the
+# prompt only needs to say that the reply is JSON.
+STRUCTURED_FORMAT_INSTRUCTIONS = "Reply with a single JSON object that follows the response schema."
+
+
+class StructuredOutputError(APIException):
+    """
+    The LLM did not return a reply matching the schema, even after retrying.
+    """
+    status_code = status.HTTP_502_BAD_GATEWAY
+    default_detail = "The coach's reply could not be read. Please try again."
+    default_code = 'invalid_llm_reply'
+
+
+def strict_json_schema(schema):
+    """
+    The JSON schema of a pydantic model in the subset accepted by OpenAI's
+    strict mode: every property required, no additional properties, and no
+    `default`/`title` keywords.
+    """
+    def strict(node):
+        if isinstance(node, list):
+            return [strict(item) for item in node]
+        if not isinstance(node, dict):
+            return node
+        result = {}
+        for key, value in node.items():
+            if key in ('properties', '$defs'):
+                # Keys of these are names, not keywords
+                result[key] = {name: strict(definition) for name, definition in value.items()}
+            elif key not in ('default', 'title'):
+                result[key] = strict(value)
+        if result.get('type') == 'object':
+            result['required'] = list(result.get('properties', {}))
+            result['additionalProperties'] = False
+        return result
+
+    return strict(schema.model_json_schema())
+
+
+def response_format(schema):
+    return {
+        "type": "json_schema",
+        "json_schema": {"name": schema.__name__, "strict": True, "schema": strict_json_schema(schema)},
+    }
+
+
+def structured_output_kwargs(schema):
+    """
+    Extra `invoke`/`stream` arguments that ask the model for a reply matching
+    `schema` (none when LLM_STRUCTURED_OUTPUT is off).
+    """
+    if not settings.LLM_STRUCTURED_OUTPUT:
+        return {}
+    return {"response_format": response_format(schema)}
+
+
+def format_instructions(schema):
+    """
+    The `{format_instructions}` text of prompts whose reply follows `schema`:
+    a short note with native structured output, the full JSON schema otherwise.
+    """
+    if settings.LLM_STRUCTURED_OUTPUT:
+        return STRUCTURED_FORMAT_INSTRUCTIONS
+    return PydanticOutputParser(pydantic_object=schema).get_format_instructions()
+
+
+def parse_reply(content, schema):
+    """
+    Validates the reply content against `schema` and returns it as a dict.
+    Raises ValueError (e.g. pydantic's ValidationError) if it does not match.
+    """
+    try:
+        return schema.model_validate_json(content).model_dump()
+    except ValidationError:
+        if settings.LLM_STRUCTURED_OUTPUT:
+            raise
+    # Without structured output the JSON may come wrapped in a code fence
+    return schema.model_validate(parse_response(content)).model_dump()
+
+
+def invoke_structured(invoke, prompt, schema, operation, step=""):
+    """
+    Calls `invoke(prompt)` until the reply matches `schema`, at most
+    1 + LLM_STRUCTURED_OUTPUT_RETRIES times, and returns the reply message.
+    Every invalid reply is counted as a parse failure and every repeated call
+    as a retry.
+    """
+    for attempt in range(settings.LLM_STRUCTURED_OUTPUT_RETRIES + 1):
+        if attempt:
+            LLM_PARSE_RETRIES_TOTAL.labels(operation, step).inc()
+        response = invoke(prompt)
+        try:
+            parse_reply(response.content, schema)
+            return response
+        except ValueError as error:
+            LLM_PARSE_FAILURES_TOTAL.labels(operation, step).inc()
+            logger.warning("Invalid %s reply (attempt %d): %s", schema.__name__, attempt + 1, error)
+    raise StructuredOutputError()
+
+
+async def ainvoke_structured(ainvoke, prompt, schema, operation, step=""):
+    """
+    Async variant of `invoke_structured`.
+    """
+    for attempt in range(settings.LLM_STRUCTURED_OUTPUT_RETRIES + 1):
+        if attempt:
+            LLM_PARSE_RETRIES_TOTAL.labels(operation, step).inc()
+        response = await ainvoke(prompt)
+        try:
+            parse_reply(response.content, schema)
+            return response
+        except ValueError as error:
+            LLM_PARSE_FAILURES_TOTAL.labels(operation, step).inc()
+            logger.warning("Invalid %s reply (attempt %d): %s", schema.__name__, attempt + 1, error)
+    raise StructuredOutputError()
@@ -1,130 +1,292 @@
-from collections import deque
+import logging
+
 from celery import shared_task
-from datetime import date
+from django.conf import settings
+from django.core.cache import cache
 from django.core.exceptions import ObjectDoesNotExist
-from langchain_core.prompts import PromptTemplate
-from langchain_core.output_parsers import PydanticOutputParser
+from django.db import IntegrityError, transaction
+from django.db.models import Max, Prefetch, Q
 
-from aiCoach.models import UserConversationHistory, User
-from aiCoach.outputParser import ChatLabelParser, ChatParser
+from aiCoach.models import ConversationMessage, UserConversationHistory, UserGoal, User
+from aiCoach.outputParser import ChatLabelsParser
 from langchain.memory import ConversationSummaryBufferMemory
+from langchain_core.messages import messages_from_dict, messages_to_dict
 
-from aiCoach.serializers import UserConversationHistorySerializer
-from aiCoach.utils import CHAT_API, LLM_MODEL, parse_response
+from aiCoach.chat_session import set_saved_chat_state
+from aiCoach.log import log_payload
+from aiCoach.metrics import LLM_DEFERRED_TOTAL, observe_llm_call
+from aiCoach.prompts import CompiledPrompt
+from aiCoach.rate_limit import LABEL, LLM_RATE_LIMITER, SUMMARY, LLMRateLimitError
+from aiCoach.serializers import UserConversationHistorySerializer, UserGoalSerializer
+from aiCoach.structured_output import (
+    StructuredOutputError, format_instructions, invoke_structured, parse_reply, structured_output_kwargs,
+)
+from aiCoach.utils import CHAT_API, LLM_MODEL, format_dict, group_turns, split_turn
 # from aiCoach.services import save_conversation
 
+logger = logging.getLogger(__name__)
+
+
+# Prompt for labelling a batch of conversations in one call, compiled once with the
+# ChatLabelsParser format instructions
+CHAT_LABELS_PROMPT = CompiledPrompt(
+    '''
+            ### You are an AI assistant, you are here to help me.
+            Read each of the below conversations and give me a label (name to identify the conversation) for every conversation in less than 8 words.
+            The label should be subjective regarding the chat and goal.
+            Each label should start with the date of its conversation and information about the user goal with the user conversation.
+            ### Coaching sessions:
+            {conversations}
+            ### Instruction for your output format:
+            Return exactly one label per chat ID.
+            \nOutput: {format_instructions}\n
+        ''',
+    constants={"format_instructions": format_instructions(ChatLabelsParser)},
+)
+
+# Times a save folds the summary again when another save of the chat stored one
+# first; messages left out are folded in by the chat's next save
+SUMMARY_FOLD_ATTEMPTS = 3
+
+# Set while a label batch is scheduled, so a burst of new chats shares one batch
+CHAT_LABEL_PENDING_KEY = "aicoach:chat-labels:pending"
+
 
 @shared_task
-def async_save_conversation(user_id, chat_id, user_goal, messages, conversation_data, previous_conversation_data):
+def async_save_conversation(user_id, chat_id, turn, conversation_data, previous_conversation_data,
+                            first_sequence=None, user_goal=None):
     """
-    This function asynchronously saves the conversation data with context summary 
-    and a generated label using an AI model. It uses Celery to handle the saving 
-    asynchronously to avoid blocking main thread operations.
+    This function asynchronously saves the latest chat turn with the context summary.
+    It uses Celery to handle the saving asynchronously to avoid blocking main thread
+    operations. Chats without a label are labelled later in batches by
+    `generate_chat_labels`. (`user_goal` is ignored; saves enqueued before labels
+    were batched still pass it.)
     """
-    print("\n --user_id, chat_id", user_id, chat_id)
-    
-    # Initialize Conversation Summary Buffer Memory for tracking conversation context
-    # This will allow us to summarize and track the conversation with a token limit.
-    conversationSummaryMemory = ConversationSummaryBufferMemory(
-        llm=LLM_MODEL,  # LLM model used for summarization
-        max_token_limit=CHAT_API["CHAT_SUMMARY_MAX_TOKEN"]  # Set token limit for summary
-    )
+    logger.debug("Saving turn of chat %s (user %s)", chat_id, user_id)
 
-    # Iterate through the conversation messages and save them to memory
-    for message in messages:
-        # Safely check if the 'user' key exists and get the user message, if exists
-        user_message = message.get('user', '')
-        
-        # Save user input and corresponding coach output (response) in memory
-        conversationSummaryMemory.save_context(
-           {"input": user_message},  # Save user input message
-           {"output": message['coach']}  # Save coach (model) response
-        )
-    
-    # Update conversation_data with the latest messages and the conversation summary
-    conversation_data['messages'] = messages
-    summary = conversationSummaryMemory.load_memory_variables({})  # Load memory (context summary)
-    print("\n summary---------", summary)
+    # Fold the messages that are not in the stored summary yet, then save the updated
+    # conversation state and append the turn's messages
+    summary, folded_from = fold_conversation_summary(chat_id, turn, first_sequence)
+    log_payload(logger, "Chat %s summary: %s", chat_id, summary)
     conversation_data["summary"] = summary
+    history = save_conversation(user_id, chat_id, turn, conversation_data, previous_conversation_data,
+                                first_sequence, summary_folded_from=folded_from)
+
+    if history.summary != summary:
+        # Another save of this chat stored its summary in the meantime: fold again on top of it
+        for _ in range(SUMMARY_FOLD_ATTEMPTS):
+            if store_conversation_summary(user_id, chat_id, *fold_conversation_summary(chat_id)):
+                break
 
-    # Check if a chat label has already been generated for this conversation
-    if not previous_conversation_data["chat_label"]:
-        # If no chat label exists, we need to generate one
+    if not history.chat_label:
+        schedule_chat_labels()
 
-        # Define the parser for extracting the chat label using Pydantic
-        parser = PydanticOutputParser(pydantic_object=ChatLabelParser)
-        
-        # Prepare partial variables for the label format instructions
-        partial_variables = {
-            "format_instructions": parser.get_format_instructions(),
-        }
 
-        # Define input variables for the prompt template
-        input_variables = ["conversation", "user_goal", "current_date"]
+def schedule_chat_labels():
+    """
+    Schedules a label batch on the low-priority label queue, unless one is
+    already pending. The countdown lets new chats from a busy period collect.
+    """
+    delay = settings.CHAT_LABEL_BATCH_DELAY
+    if cache.add(CHAT_LABEL_PENDING_KEY, True, timeout=delay + 60):
+        generate_chat_labels.apply_async(countdown=delay)
 
-        current_date = date.today()
 
-        # Create a prompt template for the LLM model to generate a chat label
-        prompt_template = ('''
-            ### You are an AI assistant, you are here to help me.
-            Read the below conversation and give me a label (name to identify the conversation) for the conversation in less than 8 words.
-            The label should be subjective regarding the chat and goal.
-            ### Coaching session data:
-            Conversation: {conversation} \n
-            Goal: {user_goal} \n\n
-            current_data: {current_date}\n\n
-            label should start with the date of the conversation and information about user goal with the user conversation.
-            ### Instruction for your output format:
-            \nOutput: {format_instructions}\n
-        ''')
+@shared_task
+def generate_chat_labels():
+    """
+    Labels up to CHAT_LABEL_BATCH_SIZE unlabelled chats with one LLM call and
+    stores the labels with one bulk_update. Schedules another batch if more
+    chats are waiting. Labels are background work: the batch is put off while
+    coach calls are slow or the quota left to labels is used up.
+    """
+    cache.delete(CHAT_LABEL_PENDING_KEY)
+    if LLM_RATE_LIMITER.should_defer(LABEL):
+        schedule_chat_labels()
+        return 0
+    batch_size = settings.CHAT_LABEL_BATCH_SIZE
+
+    chats = list(
+        UserConversationHistory.objects.filter(Q(chat_label__isnull=True) | Q(chat_label=''), is_active=True)
+        .order_by('created_at')
+        # The opening messages are enough to label a chat
+        .prefetch_related(Prefetch(
+            'conversation_messages',
+            queryset=ConversationMessage.objects.filter(sequence__lte=settings.CHAT_LABEL_MESSAGES),
+        ))[:batch_size]
+    )
+    if not chats:
+        return 0
+
+    goals = {
+        goal.user_id: format_dict(UserGoalSerializer(goal).data)
+        for goal in UserGoal.objects.filter(user_id__in={chat.user_id for chat in chats}, is_active=True).order_by('-id')
+    }
+    conversations = "\n".join(
+        f"Chat ID: {chat.chat_id}\nDate: {chat.created_at.date()}\nGoal: {goals.get(chat.user_id, '')}"
+        f"Conversation: {group_turns(chat.conversation_messages.all())}\n"
+        for chat in chats
+    )
+
+    def invoke(prompt):
+        with LLM_RATE_LIMITER.limit(prompt, LABEL), observe_llm_call("label"):
+            return LLM_MODEL.invoke(prompt, **structured_output_kwargs(ChatLabelsParser))
+
+    try:
+        response = invoke_structured(invoke, CHAT_LABELS_PROMPT.render(conversations=conversations), ChatLabelsParser, "label")
+        labels = {label["chatId"]: label["chatLabel"] for label in parse_reply(response.content, ChatLabelsParser)["labels"]}
+    except StructuredOutputError:
+        # The chats stay unlabelled and are picked up by a later batch
+        labels = {}
+    except LLMRateLimitError:
+        LLM_DEFERRED_TOTAL.labels(LABEL).inc()
+        schedule_chat_labels()
+        return 0
+    logger.info("Labelled %d of %d chats", len(labels), len(chats))
+
+    labelled = []
+    for chat in chats:
+        label = labels.get(str(chat.chat_id))
+        if label:
+            chat.chat_label = label[:UserConversationHistory._meta.get_field('chat_label').max_length]
+            labelled.append(chat)
+    UserConversationHistory.objects.bulk_update(labelled, ['chat_label'])
+
+    # A full batch may have left chats behind; stop if this batch made no progress
+    if len(chats) == batch_size and labelled:
+        schedule_chat_labels()
+    return len(labelled)
+
 
-        # Create the prompt object for the language model (LLM)
-        prompt = PromptTemplate(
-            input_variables=input_variables,
-            template=prompt_template,
-            partial_variables=partial_variables,
+def fold_conversation_summary(chat_id, turn=None, first_sequence=None):
+    """
+    Folds the chat's messages that are not in its stored summary yet, with
+    `turn` if it is not stored yet, into the summary. Only the run of messages
+    without gaps after the summary's `folded_sequence` is folded, so a turn
+    whose earlier turns are still being saved is left to a later save.
+    Returns the new summary and the `folded_sequence` of the summary it was
+    folded from.
+    """
+    conversation = UserConversationHistory.objects.filter(chat_id=chat_id, is_active=True).only('summary').first()
+    summary = (conversation.summary if conversation else None) or {}
+    if "folded_sequence" not in summary:
+        # Summaries saved before messages had sequences are rebuilt once
+        summary = {}
+    folded_from = summary.get("folded_sequence", 0)
+
+    rows = {
+        row.sequence: row for row in ConversationMessage.objects.filter(
+            chat__chat_id=chat_id, chat__is_active=True, sequence__gt=folded_from,
         )
+    }
+    if turn is not None:
+        # A turn saved without sequences goes after the last stored message
+        if first_sequence is None:
+            first_sequence = max(rows, default=folded_from) + 1
+        for sequence, (role, text) in enumerate(split_turn(turn), start=first_sequence):
+            rows.setdefault(sequence, ConversationMessage(sequence=sequence, role=role, text=text))
 
-        # Invoke the LLM model with the formatted prompt to generate a chat label
-        chat_label_response = LLM_MODEL.invoke(prompt.format(
-            conversation=messages,  # Concatenate all messages
-            user_goal=user_goal,  # Pass the user goal
-            current_date=current_date,
-            format_instructions=partial_variables["format_instructions"]  # Include format instructions
-        ))
-      
-        # Parse the response from the LLM model to extract the chat label
-        chat_label_result = parse_response(chat_label_response.content)
-        print("\n chat_label_result", chat_label_result)
+    folded_sequence = folded_from
+    while folded_sequence + 1 in rows:
+        folded_sequence += 1
+    messages = group_turns(rows[sequence] for sequence in range(folded_from + 1, folded_sequence + 1))
+
+    return update_conversation_summary(summary, messages, folded_sequence), folded_from
+
+
+def store_conversation_summary(user_id, chat_id, summary, folded_from):
+    """
+    Stores a summary from `fold_conversation_summary`, unless another save
+    stored one since it was folded. Returns whether it was stored.
+    """
+    with transaction.atomic():
+        conversation = locked_conversation(user_id, chat_id)
+        if conversation is None or stored_folded_sequence(conversation.summary) != folded_from:
+            return False
+        conversation.summary = summary
+        conversation.save(update_fields=['summary', 'updated_at'])
+        transaction.on_commit(lambda: set_saved_chat_state(user_id, chat_id, summary, conversation.chat_label))
+    return True
+
+
+def locked_conversation(user_id, chat_id):
+    """
+    The chat's active conversation row, locked until the end of the transaction
+    (None if it does not exist yet).
+    """
+    return UserConversationHistory.objects.select_for_update().filter(
+        chat_id=chat_id, user_id=user_id, is_active=True,
+    ).first()
+
+
+def stored_folded_sequence(summary):
+    # Summaries saved before messages had sequences count as empty
+    return (summary or {}).get("folded_sequence", 0)
+
+
+def update_conversation_summary(summary, messages, folded_sequence):
+    """
+    Folds the messages added since the last save into the stored rolling summary
+    with at most one summarization LLM call.
+
+    The summary is stored as state: `moving_summary_buffer` (the running summary),
+    `buffer` (recent messages not summarized yet), and `folded_sequence` (the
+    sequence of the last ConversationMessage included, i.e. the last of `messages`). `history` is the
+    same value that ConversationSummaryBufferMemory.load_memory_variables returns.
+    """
+    # Initialize Conversation Summary Buffer Memory from the stored state
+    # This will allow us to summarize and track the conversation with a token limit.
+    conversationSummaryMemory = ConversationSummaryBufferMemory(
+        llm=LLM_MODEL,  # LLM model used for summarization
+        max_token_limit=CHAT_API["CHAT_SUMMARY_MAX_TOKEN"]  # Set token limit for summary
+    )
+    conversationSummaryMemory.moving_summary_buffer = summary.get("moving_summary_buffer", "")
+    conversationSummaryMemory.chat_memory.add_messages(messages_from_dict(summary.get("buffer", [])))
 
-        # Update the conversation data with the generated chat label
-        conversation_data['chat_label'] = chat_label_result["chatLabel"]
+    for message in messages:
+        # Safely check if the 'user' key exists and get the user message, if exists
+        conversationSummaryMemory.chat_memory.add_user_message(message.get('user', ''))
+        conversationSummaryMemory.chat_memory.add_ai_message(message['coach'])
 
-    # Save the updated conversation, including the chat label, messages, and summary
-    save_conversation(user_id, chat_id, conversation_data, previous_conversation_data)
+    # Summarize whatever no longer fits in the token limit in a single call. The
+    # call is put off while coach calls need the quota; the messages stay in the
+    # buffer and are folded in by a later save.
+    buffer = conversationSummaryMemory.chat_memory.messages
+    buffer_tokens = conversationSummaryMemory.llm.get_num_tokens_from_messages(buffer)
+    if buffer_tokens > conversationSummaryMemory.max_token_limit and not LLM_RATE_LIMITER.should_defer(SUMMARY):
+        try:
+            with LLM_RATE_LIMITER.limit(buffer_tokens, SUMMARY):
+                with observe_llm_call("summary"):
+                    conversationSummaryMemory.prune()
+        except LLMRateLimitError:
+            LLM_DEFERRED_TOTAL.labels(SUMMARY).inc()
 
+    return {
+        "history": conversationSummaryMemory.load_memory_variables({})["history"],
+        "moving_summary_buffer": conversationSummaryMemory.moving_summary_buffer,
+        "buffer": messages_to_dict(conversationSummaryMemory.chat_memory.messages),
+        "folded_sequence": folded_sequence,
+    }
 
-def save_conversation(user_id, chat_id, conversation_data, previous_conversation_data):
-    print(" inside save_conversation ")
-    print(user_id)
-    print(type(user_id))
-    print(chat_id)
-    print(type(chat_id))
-    print(conversation_data)
-    print(type(conversation_data))
-    print(previous_conversation_data)
-    print(type(previous_conversation_data))
+
+def save_conversation(user_id, chat_id, turn, conversation_data, previous_conversation_data, first_sequence=None,
+                      summary_folded_from=None):
+    """
+    Updates (or creates) the chat's conversation state and appends the turn's
+    messages. With `summary_folded_from`, the summary is only replaced if the
+    stored one still has that `folded_sequence`, so a summary folded from an
+    older one never overwrites a newer one.
+    """
+    log_payload(logger, "Saving chat %s turn %s with %s (previously %s)",
+                chat_id, turn, conversation_data, previous_conversation_data)
 
     try:
         user = User.objects.get(id=user_id)
-        print("user in save_conversation ", user )
     except ObjectDoesNotExist:
         raise ValueError(f"User with id {user_id} does not exist.")
-    print(" inside save_conversation2 ")
 
-    messages = conversation_data.get('messages', [])
     summary = conversation_data.get('summary', [])
-    chat_label = conversation_data.get('chat_label', [])
+    chat_label = conversation_data.get('chat_label', '')
     isGoalStepCompleted = conversation_data.get('isGoalStepCompleted', False) | previous_conversation_data.get(
         'isGoalStepCompleted', False)
     isRealityStepCompleted = conversation_data.get('isRealityStepCompleted', False) | previous_conversation_data.get(
@@ -138,38 +300,66 @@ def save_conversation(user_id, chat_id, conversation_data, previous_conversation
         'isWillStepCompleted', False)
     is_active = conversation_data.get('is_active', True)
 
-    # Check if the  conversation_history already exists
-    conversation_history_exists = UserConversationHistory.objects.filter(chat_id=chat_id, is_active=True).exists()
-
-    # If  conversation_history exists, update the UserConversationHistorys and summary, without touching chat_label
-    if conversation_history_exists:
-        print('UserConversationHistory just updation')
-
-        history_instance = UserConversationHistory.objects.filter(chat_id=chat_id, user_id=user_id).update(
-            messages=messages,
-            summary=summary,
-            isGoalStepCompleted=isGoalStepCompleted,
-            isRealityStepCompleted=isRealityStepCompleted,
-            isOptionStepCompleted=isOptionStepCompleted,
-            isOptionImprovementStepCompleted=isOptionImprovementStepCompleted,
-            isWillStepCompleted=isWillStepCompleted,
-            is_active=is_active,
-        )
-    else:
-        print('UserConversationHistory new creation')
-        # If chat does not exist, create a new one with chat_id
-        history_instance = UserConversationHistory.objects.create(
-            user=user,
-            chat_id=chat_id,
-            messages=messages,
-            chat_label=chat_label,
-            summary=summary,
-            isGoalStepCompleted=isGoalStepCompleted,
-            isRealityStepCompleted=isRealityStepCompleted,
-            isOptionStepCompleted=isOptionStepCompleted,
-            isOptionImprovementStepCompleted=isOptionImprovementStepCompleted,
-            isWillStepCompleted=isWillStepCompleted,
-            is_active=is_active,
-        )
-    print(UserConversationHistorySerializer(history_instance).data)
-    return UserConversationHistorySerializer(history_instance).data
\ No newline at end of file
+    with transaction.atomic():
+        # Lock the conversation so concurrent saves of the same chat get distinct sequences
+        history_instance = locked_conversation(user_id, chat_id)
+        created = False
+
+        if history_instance is None:
+            logger.debug("Creating conversation history for chat %s", chat_id)
+            # If chat does not exist, create a new one with chat_id. Nothing is locked before the
+            # row exists, so the saves of a new chat's first turns can race to create it.
+            try:
+                with transaction.atomic():
+                    history_instance = UserConversationHistory.objects.create(
+                        user=user,
+                        chat_id=chat_id,
+                        chat_label=chat_label,
+                        summary=summary,
+                        isGoalStepCompleted=isGoalStepCompleted,
+                        isRealityStepCompleted=isRealityStepCompleted,
+                        isOptionStepCompleted=isOptionStepCompleted,
+                        isOptionImprovementStepCompleted=isOptionImprovementStepCompleted,
+                        isWillStepCompleted=isWillStepCompleted,
+                        is_active=is_active,
+                    )
+                created = True
+            except IntegrityError:
+                # Another save created it and has committed; update its row like any later save
+                history_instance = locked_conversation(user_id, chat_id)
+                if history_instance is None:
+                    raise
+
+        # If  conversation_history exists, update the UserConversationHistorys and summary, without touching chat_label
+        if not created:
+            # Flags only ever get set, so a save that runs after a later turn's save keeps them
+            if summary_folded_from is None or stored_folded_sequence(history_instance.summary) == summary_folded_from:
+                history_instance.summary = summary
+            history_instance.isGoalStepCompleted |= isGoalStepCompleted
+            history_instance.isRealityStepCompleted |= isRealityStepCompleted
+            history_instance.isOptionStepCompleted |= isOptionStepCompleted
+            history_instance.isOptionImprovementStepCompleted |= isOptionImprovementStepCompleted
+            history_instance.isWillStepCompleted |= isWillStepCompleted
+            history_instance.is_active = is_active
+            history_instance.save(update_fields=[
+                'summary', 'isGoalStepCompleted', 'isRealityStepCompleted', 'isOptionStepCompleted',
+                'isOptionImprovementStepCompleted', 'isWillStepCompleted', 'is_active', 'updated_at',
+            ])
+
+        # Append the turn's messages with the sequences allocated by the chat session,
+        # or after the last stored one for turns enqueued without them
+        if first_sequence is None:
+            first_sequence = (history_instance.conversation_messages.aggregate(last=Max('sequence'))['last'] or 0) + 1
+        ConversationMessage.objects.bulk_create([
+            ConversationMessage(chat=history_instance, sequence=sequence, role=role, text=text)
+            for sequence, (role, text) in enumerate(split_turn(turn), start=first_sequence)
+        ], ignore_conflicts=True)  # A retried save does not duplicate the turn
+
+        # Let the next turns see the new summary and label without reading them back
+        transaction.on_commit(lambda: set_saved_chat_state(
+            user_id, chat_id, history_instance.summary, history_instance.chat_label,
+        ))
+
+    # Serializing the chat reads all of its messages, so only when the dump is logged
+    log_payload(logger, "Saved chat %s: %s", chat_id, lambda: UserConversationHistorySerializer(history_instance).data)
+    return history_instance
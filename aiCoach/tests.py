@@ -1,3 +1,1432 @@
-from django.test import TestCase
+import asyncio
+import contextlib
+import io
+import json
+import logging
+import random
+import threading
+import time
+import unittest
+import uuid
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+import openai
+import redis
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection, transaction
+from django.http import Http404
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from langchain_core.messages import AIMessage
+from prometheus_client import REGISTRY
+
+from aiCoach.chat_session import allocate_message_sequences
+from aiCoach.context import NEW_CONVERSATION, load_coaching_context
+from aiCoach.db_router import READ_DB_ALIAS, REFERENCE_DATA, mark_primary, read_from_replica, replica_reads
+from aiCoach.fake_llm import STEP_FLAGS, FakeChatModel, LatencyDistribution
+from aiCoach.history import build_conversation_history, count_tokens, get_encoding
+from aiCoach.llm import LLM_RESPONSE_CACHE
+from aiCoach.llm_backends import create_chat_model
+from aiCoach.llm_router import DeploymentRouterChatModel
+from aiCoach.log import QueueLogHandler, log_payload
+from aiCoach.management.commands.bench_prompt_build import SAMPLE_TEMPLATE, SAMPLE_VALUES, legacy_build
+from aiCoach.models import (
+    Category,
+    CategoryLevel,
+    CategoryLevelExample,
+    CoachingPrompt,
+    ConversationMessage,
+    User,
+    UserCallStatementsWithLevel,
+    UserConversationHistory,
+    UserGoal,
+    UserPerformanceData,
+)
+from aiCoach.outputParser import ChatLabelsParser, ChatParser
+from aiCoach.prompts import (
+    CATEGORY_LEVEL_CACHE,
+    CHAT_FORMAT_INSTRUCTIONS,
+    COACHING_PROMPT_CACHE,
+    CONVERSATION_TEMPLATE,
+    CompiledPrompt,
+    get_category_level_prompt,
+    get_coaching_prompt,
+    load_category_level_prompt,
+    load_coaching_prompt,
+)
+from aiCoach.rate_limit import HEDGE, INTERACTIVE, LABEL, LLMRateLimiter, LLMRateLimitError, get_redis
+from aiCoach.reference_data import REFERENCE_DATA_CACHE
+from aiCoach.services import (
+    get_conversation,
+    get_conversation_history_by_user,
+    get_user_goal,
+    get_user_performance_data,
+    user_call_statements,
+)
+from aiCoach.structured_output import STRUCTURED_FORMAT_INSTRUCTIONS, strict_json_schema, structured_output_kwargs
+from aiCoach.tasks import (
+    CHAT_LABELS_PROMPT,
+    async_save_conversation,
+    fold_conversation_summary,
+    generate_chat_labels,
+    save_conversation,
+    schedule_chat_labels,
+    update_conversation_summary,
+)
+from aiCoach.timing import REQUEST_TIMINGS, RequestTimings, record_timing
+
+COACH_REPLY = json.dumps({"message": "What could you try differently next time?"})
+
+# Keep tests off the shared Redis cache
+TEST_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+# Reads the primary only: the test replica mirrors the test database through a separate
+# connection, which does not see the rows of the test's transaction
+PRIMARY_ONLY = mock.patch('aiCoach.db_router.replica_configured', mock.Mock(return_value=False))
+
+
+def seed_coaching_data():
+    """
+    Creates a user with everything a coaching turn reads.
+    """
+    user = User.objects.create(email='johndoe@email.com', first_name='John', last_name='Doe')
+    UserGoal.objects.create(
+        user=user,
+        category='QUESTIONING',
+        initial_level='8% DEVELOPING',
+        current_level='22% DEVELOPING or ACCOMPLISHED',
+        goal_level='35% DEVELOPING or ACCOMPLISHED',
+    )
+    for category in ['OPENING', 'QUESTIONING']:
+        UserCallStatementsWithLevel.objects.create(
+            user=user, statement=f"{category} statement", category=category, level='2',
+            reason='Reason.', confidence_score=90,
+        )
+        UserPerformanceData.objects.create(
+            user=user, category=category, date='2024-05-15', not_observed=0.0, foundational=80.0,
+            developing=10.0, accomplished=10.0, combined_DA=20.0,
+        )
+    for level in range(1, 5):
+        CategoryLevel.objects.create(category='QUESTIONING', level=level, description=f"Level {level}.")
+        CategoryLevel.objects.create(category='OPENING', level=level, description=f"Level {level}.")
+    for category in ['GOAL', 'REALITY', 'OPTIONS', 'OPTION_IMPROVEMENT', 'WILL']:
+        # Only the OPTIONS and OPTION_IMPROVEMENT prompts get the category levels
+        levels = "Levels: {category_level_data} " if category in ['OPTIONS', 'OPTION_IMPROVEMENT'] else ""
+        CoachingPrompt.objects.create(
+            category=category,
+            prompt=f"{category} prompt for {{user_name}}. Goal: {{goal}} Data: {{performance_data}} "
+                   f"{levels}Output: {{format_instructions}}",
+        )
+    return user
+
+
+@override_settings(CACHES=TEST_CACHES)
+@PRIMARY_ONLY
+class CoachingContextQueryCountTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = seed_coaching_data()
+        cls.chat_id = uuid.uuid4()
+        conversation = UserConversationHistory.objects.create(
+            user=cls.user,
+            chat_id=cls.chat_id,
+            isGoalStepCompleted=True,
+            isRealityStepCompleted=True,
+        )
+        ConversationMessage.objects.bulk_create([
+            ConversationMessage(chat=conversation, sequence=1, role='coach', text="Hello John!"),
+            ConversationMessage(chat=conversation, sequence=2, role='user', text="Hi"),
+            ConversationMessage(chat=conversation, sequence=3, role='coach', text="How did the call go?"),
+        ])
+
+    def setUp(self):
+        cache.clear()
+        COACHING_PROMPT_CACHE.local.clear()
+        CATEGORY_LEVEL_CACHE.local.clear()
+
+    def test_context_loads_in_one_query(self):
+        with self.assertNumQueries(1):
+            context = load_coaching_context(self.user.id, str(self.chat_id))
+
+        self.assertEqual(context.pending_step, 'OPTIONS')
+        self.assertEqual(context.goal_category, 'QUESTIONING')
+        self.assertEqual(len(context.performance_data["last_call"]), 2)
+        self.assertEqual(context.chat_history, ["Coach: Hello John!", "User: Hi", "Coach: How did the call go?"])
+
+    def test_new_chat_context(self):
+        context = load_coaching_context(self.user.id, str(uuid.uuid4()))
+
+        self.assertEqual(context.pending_step, 'GOAL')
+        self.assertEqual(context.recent_messages, [])
+        self.assertEqual(context.chat_history, [])
+
+    def test_missing_user_raises_404(self):
+        with self.assertRaises(Http404):
+            load_coaching_context(self.user.id + 1000, str(self.chat_id))
+
+    @mock.patch('aiCoach.services.async_save_conversation')
+    @mock.patch('aiCoach.services.LLM_MODEL')
+    def test_chat_turn_query_count(self, llm_model, async_save_conversation):
+        llm_model.invoke.return_value = AIMessage(content=COACH_REPLY)
+        get_coaching_prompt('OPTIONS')  # Warm the prompt caches
+        get_category_level_prompt('QUESTIONING')
+
+        with self.assertNumQueries(1):
+            response = self.client.post(
+                '/api/chat/',
+                {'user_id': self.user.id, 'chat_id': str(self.chat_id), 'text': 'I rushed my questions.'},
+                content_type='application/json',
+            )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["message"], "What could you try differently next time?")
+        prompt = llm_model.invoke.call_args.args[0]
+        self.assertIn("OPTIONS prompt for John Doe", prompt)
+        self.assertIn("Levels: Level 1: Level 1.\nLevel 2: Level 2.", prompt)
+        self.assertIn("I rushed my questions.", prompt)
+        saved_turn = async_save_conversation.delay.call_args.kwargs["turn"]
+        self.assertEqual(saved_turn, {"user": "I rushed my questions.", "coach": "What could you try differently next time?"})
+
+    @mock.patch('aiCoach.services.async_save_conversation')
+    @mock.patch('aiCoach.services.LLM_MODEL')
+    def test_next_turn_reads_its_own_writes(self, llm_model, async_save_conversation):
+        llm_model.invoke.return_value = AIMessage(content=json.dumps(
+            {"message": "Which option will you try first?", "isOptionStepCompleted": True}
+        ))
+        self.client.post(
+            '/api/chat/',
+            {'user_id': self.user.id, 'chat_id': str(self.chat_id), 'text': 'Ask open questions.'},
+            content_type='application/json',
+        )
+        self.assertEqual(async_save_conversation.delay.call_args.kwargs["first_sequence"], 4)
+
+        # The save task has not run, the next turn still sees the turn from the session cache
+        with self.assertNumQueries(1):
+            context = load_coaching_context(self.user.id, str(self.chat_id))
+
+        self.assertEqual(context.pending_step, 'OPTION_IMPROVEMENT')
+        self.assertEqual(context.chat_history[-2:], ["User: Ask open questions.", "Coach: Which option will you try first?"])
+        self.assertEqual([message.sequence for message in context.recent_messages], [1, 2, 3, 4, 5])
+
+    def test_save_appends_turn_messages(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            save_conversation(
+                self.user.id, self.chat_id, {"user": "Fine", "coach": "What went well?"},
+                {"summary": {}, "chat_label": ""}, dict(NEW_CONVERSATION),
+            )
+
+        messages = ConversationMessage.objects.filter(chat__chat_id=self.chat_id)
+        self.assertEqual([(m.sequence, m.role) for m in messages], [(1, 'coach'), (2, 'user'), (3, 'coach'), (4, 'user'), (5, 'coach')])
+        chat = self.client.get(f'/api/chat-messages/{self.chat_id}/').json()
+        self.assertEqual(chat["messages"][-1], {"user": "Fine", "coach": "What went well?"})
+
+    def test_save_does_not_read_the_chat_messages(self):
+        with CaptureQueriesContext(connection) as queries:
+            history = save_conversation(
+                self.user.id, self.chat_id, {"user": "Fine", "coach": "What went well?"},
+                {"summary": {}, "chat_label": ""}, dict(NEW_CONVERSATION), first_sequence=4,
+            )
+
+        self.assertEqual(history.chat_id, self.chat_id)
+        selects = [query['sql'] for query in queries if query['sql'].startswith('SELECT')]
+        self.assertFalse([sql for sql in selects if 'conversationmessage' in sql.lower()])
+
+
+@override_settings(CACHES=TEST_CACHES)
+@mock.patch('aiCoach.tasks.schedule_chat_labels')
+@mock.patch('aiCoach.tasks.LLM_MODEL', FakeChatModel())
+@mock.patch.dict('aiCoach.tasks.CHAT_API', CHAT_SUMMARY_MAX_TOKEN=10000)  # Keep every message in the buffer
+class ConversationSummaryFoldTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(email='johndoe@email.com', first_name='John', last_name='Doe')
+        cls.chat_id = uuid.uuid4()
+
+    def save_turn(self, number, first_sequence):
+        turn = {"user": f"User turn {number}", "coach": f"Coach turn {number}"}
+        async_save_conversation(self.user.id, self.chat_id, turn, {}, dict(NEW_CONVERSATION), first_sequence)
+        return turn
+
+    def stored_summary(self):
+        return UserConversationHistory.objects.get(chat_id=self.chat_id).summary
+
+    def test_turn_saved_before_an_earlier_one_is_folded_after_it(self, schedule_chat_labels):
+        self.save_turn(1, first_sequence=1)
+        self.save_turn(3, first_sequence=5)
+        self.assertEqual(self.stored_summary()["folded_sequence"], 2)
+
+        self.save_turn(2, first_sequence=3)
+
+        summary = self.stored_summary()
+        self.assertEqual(summary["folded_sequence"], 6)
+        self.assertEqual(summary["history"].count("Human: "), 3)
+        self.assertLess(summary["history"].index("User turn 2"), summary["history"].index("User turn 3"))
+
+    def test_summary_folded_from_an_older_one_is_folded_again(self, schedule_chat_labels):
+        self.save_turn(1, first_sequence=1)
+        turn = {"user": "User turn 3", "coach": "Coach turn 3"}
+        # This save read the summary before the turn 2 save stored its own
+        stale = fold_conversation_summary(self.chat_id, turn, 5)
+        self.save_turn(2, first_sequence=3)
+
+        with mock.patch('aiCoach.tasks.fold_conversation_summary', side_effect=[stale, fold_conversation_summary(self.chat_id, turn, 5)]):
+            async_save_conversation(self.user.id, self.chat_id, turn, {}, dict(NEW_CONVERSATION), 5)
+
+        summary = self.stored_summary()
+        self.assertEqual(summary["folded_sequence"], 6)
+        self.assertEqual(summary["history"].count("Human: "), 3)
+        self.assertIn("User turn 2", summary["history"])
+
+
+@unittest.skipUnless(connection.vendor == 'postgresql', "Row locks are checked on PostgreSQL")
+@override_settings(CACHES=TEST_CACHES)
+class ConcurrentSaveTests(TransactionTestCase):
+    def test_first_turns_of_a_new_chat(self):
+        user = User.objects.create(email='johndoe@email.com', first_name='John')
+        chat_id = uuid.uuid4()
+        first_saved, commit_first = threading.Event(), threading.Event()
+        errors = []
+
+        def save(turn, first_sequence, hold=False):
+            try:
+                with transaction.atomic():
+                    save_conversation(user.id, chat_id, turn, {"summary": {}}, dict(NEW_CONVERSATION), first_sequence)
+                    if hold:
+                        first_saved.set()
+                        commit_first.wait(5)
+            except Exception as error:
+                errors.append(error)
+            finally:
+                first_saved.set()
+                connection.close()
+
+        first = threading.Thread(target=save, args=({"coach": "Hello John!"}, 1, True))
+        first.start()
+        first_saved.wait(5)
+        # Finds no row to lock and waits on the unique chat_id until the first save commits
+        second = threading.Thread(target=save, args=({"user": "Hi", "coach": "How did the call go?"}, 2))
+        second.start()
+        time.sleep(0.2)
+        commit_first.set()
+        first.join()
+        second.join()
+
+        self.assertEqual(errors, [])
+        messages = ConversationMessage.objects.filter(chat__chat_id=chat_id).order_by('sequence')
+        self.assertEqual([(message.sequence, message.role) for message in messages], [(1, 'coach'), (2, 'user'), (3, 'coach')])
+
+
+@override_settings(CACHES=TEST_CACHES)
+class ChatSessionTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_sequences_are_allocated_after_the_stored_ones(self):
+        self.assertEqual(allocate_message_sequences(1, 'chat', 2, last_stored_sequence=3), 4)
+        self.assertEqual(allocate_message_sequences(1, 'chat', 1, last_stored_sequence=3), 6)
+
+    def test_sequence_key_evicted_before_the_increment(self):
+        def evict_then_incr(key, delta=1):
+            cache.delete(key)
+            evicting_cache.incr.side_effect = None
+            return cache.incr(key, delta)
+
+        evicting_cache = mock.Mock(wraps=cache)
+        evicting_cache.incr.side_effect = evict_then_incr
+        with mock.patch('aiCoach.chat_session.cache', evicting_cache):
+            self.assertEqual(allocate_message_sequences(1, 'chat', 2, last_stored_sequence=3), 4)
+
+
+@override_settings(CACHES=TEST_CACHES)
+@PRIMARY_ONLY
+class LLMResponseCacheTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = seed_coaching_data()
+
+    def setUp(self):
+        cache.clear()
+        LLM_RESPONSE_CACHE.local.clear()
+
+    def start_chat(self, text=''):
+        return self.client.post(
+            '/api/chat/', {'user_id': self.user.id, 'chat_id': str(uuid.uuid4()), 'text': text},
+            content_type='application/json',
+        )
+
+    @mock.patch('aiCoach.services.async_save_conversation')
+    @mock.patch('aiCoach.services.LLM_MODEL')
+    def test_opening_turn_is_served_from_cache(self, llm_model, async_save_conversation):
+        llm_model.invoke.return_value = AIMessage(content=COACH_REPLY)
+        hits = LLM_RESPONSE_CACHE.stats()["hits"]
+
+        first = self.start_chat()
+        LLM_RESPONSE_CACHE.local.clear()  # Served from the shared tier, as in another process
+        second = self.start_chat()
+
+        llm_model.invoke.assert_called_once()
+        self.assertEqual(first.json(), second.json())
+        self.assertEqual(LLM_RESPONSE_CACHE.stats()["hits"], hits + 1)
+
+    @mock.patch('aiCoach.services.async_save_conversation')
+    @mock.patch('aiCoach.services.LLM_MODEL')
+    def test_turns_with_a_user_message_are_not_cached(self, llm_model, async_save_conversation):
+        llm_model.invoke.return_value = AIMessage(content=COACH_REPLY)
+
+        self.start_chat('Hi')
+        self.start_chat('Hi')
+
+        self.assertEqual(llm_model.invoke.call_count, 2)
+
+
+# Four characters per token, independent of the tiktoken download
+@mock.patch('aiCoach.history.get_encoding', return_value=None)
+class ConversationHistoryBudgetTests(SimpleTestCase):
+    chat_history = ["Coach: " + "a" * 33, "User: " + "b" * 34, "Coach: " + "c" * 33]  # 10 tokens + newline each
+    summary = {"moving_summary_buffer": "John wants to ask more open questions."}
+
+    def test_fills_budget_from_newest(self, get_encoding):
+        history = build_conversation_history(self.chat_history, self.summary, max_tokens=22)
+
+        self.assertEqual(history.split("\n"), self.chat_history[1:])
+
+    def test_summary_replaces_older_messages(self, get_encoding):
+        history = build_conversation_history(self.chat_history, self.summary, max_tokens=30)
+
+        self.assertTrue(history.startswith("Summary of the earlier"))
+        self.assertTrue(history.endswith("\n".join(self.chat_history[1:])))
+        self.assertLessEqual(count_tokens(history), 30)
+
+    def test_summary_covers_messages_outside_the_window(self, get_encoding):
+        history = build_conversation_history(self.chat_history, self.summary, max_tokens=500, has_earlier_messages=True)
+
+        self.assertEqual(history.split("\n")[0], "Summary of the earlier conversation: John wants to ask more open questions.")
+
+    def test_long_message_is_truncated(self, get_encoding):
+        history = build_conversation_history(["User: " + "x" * 4000], {}, max_tokens=50)
+
+        self.assertLessEqual(count_tokens(history), 50)
+        self.assertTrue(history.endswith(" ..."))
+
+    def test_everything_fits(self, get_encoding):
+        history = build_conversation_history(self.chat_history, self.summary, max_tokens=500)
+
+        self.assertEqual(history, "\n".join(self.chat_history))
+
+
+class TokenEncodingTests(SimpleTestCase):
+    def setUp(self):
+        get_encoding.cache_clear()
+        self.addCleanup(get_encoding.cache_clear)
+
+    @mock.patch('tiktoken.get_encoding', side_effect=OSError("No network"))
+    @mock.patch('tiktoken.encoding_for_model', side_effect=KeyError("custom-deployment"))
+    def test_unknown_model_offline_falls_back_to_estimate(self, encoding_for_model, tiktoken_get_encoding):
+        self.assertIsNone(get_encoding())
+        self.assertEqual(count_tokens("a" * 10), 3)
+
+
+@override_settings(CACHES=TEST_CACHES)
+@PRIMARY_ONLY
+class CoachingPromptCacheTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.prompt = CoachingPrompt.objects.create(category='GOAL', prompt='Original prompt')
+
+    def setUp(self):
+        cache.clear()
+        COACHING_PROMPT_CACHE.local.clear()
+
+    def test_steady_state_reads_skip_the_db(self):
+        self.assertEqual(get_coaching_prompt('GOAL'), 'Original prompt')
+
+        with self.assertNumQueries(0):
+            self.assertEqual(get_coaching_prompt('GOAL'), 'Original prompt')
+
+    def test_save_invalidates_cached_prompt(self):
+        get_coaching_prompt('GOAL')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(
+                '/api/coaching-prompt/create/',
+                {'category': 'GOAL', 'prompt': 'Edited prompt'},
+                content_type='application/json',
+            )
+
+        self.assertEqual(get_coaching_prompt('GOAL'), 'Edited prompt')
+
+    def test_delete_invalidates_cached_prompt(self):
+        get_coaching_prompt('GOAL')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.prompt.delete()
+
+        with self.assertRaises(ValueError):
+            get_coaching_prompt('GOAL')
+
+
+class CompiledPromptTests(SimpleTestCase):
+    def assertRendersLikeLegacy(self, template):
+        compiled = CompiledPrompt(template + CONVERSATION_TEMPLATE,
+                                  constants={"format_instructions": CHAT_FORMAT_INSTRUCTIONS})
+        self.assertEqual(compiled.render(**SAMPLE_VALUES), legacy_build(template, SAMPLE_VALUES))
+
+    def test_sample_template(self):
+        self.assertRendersLikeLegacy(SAMPLE_TEMPLATE)
+
+    def test_literal_braces(self):
+        self.assertRendersLikeLegacy('Reply as {{"message": "..."}} to {user_name}: {{{goal}}} {{}} ###{format_instructions}###')
+
+    def test_conversions_and_format_specs(self):
+        self.assertRendersLikeLegacy(
+            'Data: {performance_data!r} {category_level_data!s} {user_name!a} {user_name:>12} {goal:.10}'
+        )
+
+
+@override_settings(CACHES=TEST_CACHES)
+@PRIMARY_ONLY
+class CategoryLevelPromptTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.level = CategoryLevel.objects.create(
+            category='CLOSING', level=2, description="Foundational.", examples="Shall we book a follow up?",
+        )
+        CategoryLevel.objects.create(category='CLOSING', level=1, description="Not observed.", invalid_examples="Bye.")
+        CategoryLevel.objects.create(category='CLOSING', level=3, description="Retired.", is_active=False)
+
+    def setUp(self):
+        cache.clear()
+        CATEGORY_LEVEL_CACHE.local.clear()
+
+    def test_fragment_is_compact_and_cached(self):
+        self.assertEqual(
+            get_category_level_prompt('CLOSING'),
+            "Level 1: Not observed. Invalid examples: Bye.\n"
+            "Level 2: Foundational. Examples: Shall we book a follow up?",
+        )
+        self.assertEqual(get_category_level_prompt('OPENING'), "")
+
+        with self.assertNumQueries(0):
+            get_category_level_prompt('CLOSING')
+
+    def test_save_invalidates_cached_fragment(self):
+        get_category_level_prompt('CLOSING')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.level.description = "Foundational closing."
+            self.level.save()
+
+        self.assertIn("Level 2: Foundational closing.", get_category_level_prompt('CLOSING'))
+
+
+@override_settings(CACHES=TEST_CACHES, CHAT_LABEL_BATCH_SIZE=5)
+class ChatLabelBatchTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = seed_coaching_data()
+        cls.chats = [
+            UserConversationHistory.objects.create(user=cls.user, chat_id=uuid.uuid4(), chat_label=label)
+            for label in [None, '', 'Already labelled']
+        ]
+        for chat in cls.chats:
+            ConversationMessage.objects.create(chat=chat, sequence=1, role='coach', text="Hello John!")
+
+    def setUp(self):
+        cache.clear()
+
+    @mock.patch('aiCoach.tasks.LLM_MODEL')
+    def test_labels_batch_in_one_call(self, llm_model):
+        llm_model.invoke.return_value = AIMessage(content=json.dumps({"labels": [
+            {"chatId": str(chat.chat_id), "chatLabel": f"Label {index}"} for index, chat in enumerate(self.chats[:2])
+        ]}))
+
+        self.assertEqual(generate_chat_labels(), 2)
+
+        llm_model.invoke.assert_called_once()
+        self.assertNotIn(str(self.chats[2].chat_id), llm_model.invoke.call_args.args[0])
+        self.assertEqual(
+            [chat.chat_label for chat in UserConversationHistory.objects.order_by('id')],
+            ['Label 0', 'Label 1', 'Already labelled'],
+        )
+
+    @mock.patch('aiCoach.tasks.generate_chat_labels.apply_async')
+    def test_pending_batch_is_scheduled_once(self, apply_async):
+        schedule_chat_labels()
+        schedule_chat_labels()
+
+        apply_async.assert_called_once()
+
+    @mock.patch('aiCoach.tasks.generate_chat_labels.apply_async')
+    @mock.patch('aiCoach.tasks.LLM_MODEL')
+    @mock.patch('aiCoach.tasks.LLM_RATE_LIMITER.should_defer', return_value=True)
+    def test_labels_wait_while_coach_calls_are_slow(self, should_defer, llm_model, apply_async):
+        self.assertEqual(generate_chat_labels(), 0)
+
+        should_defer.assert_called_once_with(LABEL)
+        llm_model.invoke.assert_not_called()
+        apply_async.assert_called_once()
+
+
+@override_settings(CACHES=TEST_CACHES)
+@PRIMARY_ONLY
+class LLMMetricsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = seed_coaching_data()
+
+    def setUp(self):
+        cache.clear()
+
+    def sample(self, name, **labels):
+        return REGISTRY.get_sample_value(name, labels) or 0
+
+    @mock.patch('aiCoach.services.async_save_conversation')
+    @mock.patch('aiCoach.services.LLM_MODEL')
+    def test_chat_turn_is_exposed(self, llm_model, async_save_conversation):
+        llm_model.invoke.return_value = AIMessage(content=COACH_REPLY)
+        labels = {"operation": "coach", "step": "GOAL", "outcome": "success"}
+        before = self.sample('aicoach_llm_requests_total', **labels)
+
+        self.client.post(
+            '/api/chat/', {'user_id': self.user.id, 'chat_id': str(uuid.uuid4()), 'text': 'Hi'},
+            content_type='application/json',
+        )
+        response = self.client.get('/api/metrics/')
+
+        self.assertEqual(self.sample('aicoach_llm_requests_total', **labels), before + 1)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'aicoach_llm_request_duration_seconds_bucket{le="0.25",operation="coach",step="GOAL"}', response.content)
+
+    @mock.patch('aiCoach.tasks.LLM_MODEL')
+    def test_unparsable_label_reply_is_counted(self, llm_model):
+        UserConversationHistory.objects.create(user=self.user, chat_id=uuid.uuid4())
+        llm_model.invoke.return_value = AIMessage(content="Sorry, I can't do that.")
+        failures = self.sample('aicoach_llm_parse_failures_total', operation="label", step="")
+        retries = self.sample('aicoach_llm_parse_retries_total', operation="label", step="")
+
+        with override_settings(LLM_STRUCTURED_OUTPUT_RETRIES=1):
+            self.assertEqual(generate_chat_labels(), 0)
+
+        self.assertEqual(llm_model.invoke.call_count, 2)
+        self.assertEqual(self.sample('aicoach_llm_parse_failures_total', operation="label", step=""), failures + 2)
+        self.assertEqual(self.sample('aicoach_llm_parse_retries_total', operation="label", step=""), retries + 1)
+
+
+@override_settings(CACHES=TEST_CACHES, LLM_STRUCTURED_OUTPUT=True, LLM_STRUCTURED_OUTPUT_RETRIES=1)
+@PRIMARY_ONLY
+class StructuredOutputTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = seed_coaching_data()
+
+    def post_turn(self, path='/api/chat/'):
+        return self.client.post(
+            path, {'user_id': self.user.id, 'chat_id': str(uuid.uuid4()), 'text': 'I rushed my questions.'},
+            content_type='application/json',
+        )
+
+    def test_strict_schema(self):
+        schema = strict_json_schema(ChatLabelsParser)
+
+        self.assertFalse(schema["additionalProperties"])
+        label = schema["$defs"]["ChatLabelParser"]
+        self.assertEqual(label["required"], ["chatId", "chatLabel"])
+        self.assertNotIn("title", label)
+        self.assertEqual(strict_json_schema(ChatParser)["required"], list(ChatParser.model_fields))
+
+    @mock.patch('aiCoach.services.async_save_conversation')
+    @mock.patch('aiCoach.services.LLM_MODEL')
+    def test_reply_is_requested_in_the_schema(self, llm_model, async_save_conversation):
+        llm_model.invoke.return_value = AIMessage(content=COACH_REPLY)
+
+        self.post_turn()
+
+        prompt = llm_model.invoke.call_args.args[0]
+        self.assertIn(STRUCTURED_FORMAT_INSTRUCTIONS, prompt)
+        self.assertNotIn(CHAT_FORMAT_INSTRUCTIONS, prompt)
+        json_schema = llm_model.invoke.call_args.kwargs["response_format"]["json_schema"]
+        self.assertEqual((json_schema["name"], json_schema["strict"]), ("ChatParser", True))
+
+    @mock.patch('aiCoach.services.async_save_conversation')
+    @mock.patch('aiCoach.services.LLM_MODEL')
+    def test_invalid_reply_is_retried(self, llm_model, async_save_conversation):
+        llm_model.invoke.side_effect = [AIMessage(content='{"message": "Cut off'), AIMessage(content=COACH_REPLY)]
+
+        response = self.post_turn()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["message"], "What could you try differently next time?")
+        self.assertEqual(llm_model.invoke.call_count, 2)
+
+    @mock.patch('aiCoach.services.async_save_conversation')
+    @mock.patch('aiCoach.services.LLM_MODEL')
+    def test_retries_are_bounded(self, llm_model, async_save_conversation):
+        llm_model.invoke.return_value = AIMessage(content="Sorry, I can't do that.")
+
+        response = self.post_turn()
+
+        self.assertEqual(response.status_code, 502)
+        self.assertEqual(llm_model.invoke.call_count, 2)
+        async_save_conversation.delay.assert_not_called()
+
+
+@override_settings(CACHES=TEST_CACHES)
+@PRIMARY_ONLY
+class ServerTimingTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = seed_coaching_data()
+
+    @mock.patch('aiCoach.services.async_save_conversation')
+    @mock.patch('aiCoach.services.LLM_MODEL')
+    def test_chat_turn_reports_timings(self, llm_model, async_save_conversation):
+        llm_model.invoke.return_value = AIMessage(content=COACH_REPLY)
+
+        with self.assertLogs('aiCoach.requests', level='INFO') as logs:
+            response = self.client.post(
+                '/api/chat/', {'user_id': self.user.id, 'chat_id': str(uuid.uuid4()), 'text': 'Hi'},
+                content_type='application/json',
+            )
+
+        names = [metric.split(';')[0] for metric in response['Server-Timing'].split(', ')]
+        for name in ['db', 'context', 'llm', 'enqueue', 'serialize', 'total']:
+            self.assertIn(name, names)
+        line = json.loads(logs.records[0].getMessage())
+        self.assertEqual((line["method"], line["path"], line["status"]), ("POST", "/api/chat/", 200))
+        self.assertGreater(line["db_count"], 0)
+        self.assertEqual(line["llm_count"], 1)
+
+    def test_queries_outside_requests_are_not_timed(self):
+        with self.assertNoLogs('aiCoach.requests'):
+            User.objects.count()
+
+
+@override_settings(CACHES=TEST_CACHES)
+@PRIMARY_ONLY
+@mock.patch('aiCoach.services.async_save_conversation')
+@mock.patch('aiCoach.services.LLM_MODEL', FakeChatModel(seed=0))
+class ChatStreamTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = seed_coaching_data()
+
+    def assertStreamedTurn(self, body):
+        events = [event.split("\n")[0] for event in body.decode().split("\n\n") if event]
+        self.assertIn("event: token", events)
+        self.assertEqual(events[-1], "event: done")
+
+    def test_wsgi_stream(self, async_save_conversation):
+        response = self.client.post(
+            '/api/chat/stream/', {'user_id': self.user.id, 'chat_id': str(uuid.uuid4()), 'text': 'Hi'},
+            content_type='application/json',
+        )
+
+        self.assertFalse(response.is_async)
+        self.assertStreamedTurn(b"".join(response.streaming_content))
+        async_save_conversation.delay.assert_called_once()
+
+    async def test_asgi_stream_is_async(self, async_save_conversation):
+        response = await self.async_client.post(
+            '/api/chat/stream/', {'user_id': self.user.id, 'chat_id': str(uuid.uuid4()), 'text': 'Hi'},
+            content_type='application/json',
+        )
+
+        # An async iterator is streamed by the ASGI handler; a sync one would be read to the end first
+        self.assertTrue(response.is_async)
+        self.assertStreamedTurn(b"".join([chunk async for chunk in response.streaming_content]))
+        async_save_conversation.delay.assert_called_once()
+
+
+@override_settings(CACHES=TEST_CACHES, LLM_STRUCTURED_OUTPUT=True, LLM_STRUCTURED_OUTPUT_RETRIES=1)
+@PRIMARY_ONLY
+@mock.patch('aiCoach.services.async_save_conversation')
+class AsyncChatTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = seed_coaching_data()
+
+    def post_turn(self, data):
+        return self.async_client.post('/api/chat/async/', data, content_type='application/json')
+
+    @mock.patch('aiCoach.services.LLM_MODEL', FakeChatModel(seed=0))
+    async def test_chat_turn(self, async_save_conversation):
+        response = await self.post_turn({'user_id': self.user.id, 'chat_id': str(uuid.uuid4()), 'text': 'Hi'})
+
+        self.assertEqual(response.status_code, 200)
+        message = response.json()["message"]
+        self.assertTrue(message)
+        saved = async_save_conversation.delay.call_args.kwargs
+        self.assertEqual(saved["turn"], {"user": "Hi", "coach": message})
+        self.assertEqual(saved["first_sequence"], 1)
+
+    async def test_unknown_user(self, async_save_conversation):
+        response = await self.post_turn({'user_id': self.user.id + 1000, 'chat_id': str(uuid.uuid4()), 'text': 'Hi'})
+
+        self.assertEqual(response.status_code, 404)
+        async_save_conversation.delay.assert_not_called()
+
+    @mock.patch('aiCoach.services.LLM_MODEL')
+    async def test_unreadable_reply(self, llm_model, async_save_conversation):
+        llm_model.ainvoke = mock.AsyncMock(return_value=AIMessage(content="Sorry, I can't do that."))
+
+        response = await self.post_turn({'user_id': self.user.id, 'chat_id': str(uuid.uuid4()), 'text': 'Hi'})
+
+        self.assertEqual(response.status_code, 502)
+        self.assertEqual(llm_model.ainvoke.call_count, 2)
+        async_save_conversation.delay.assert_not_called()
+
+    async def test_invalid_user_id(self, async_save_conversation):
+        for data in [{'text': 'Hi'}, {'user_id': 'john', 'text': 'Hi'}, ['Hi']]:
+            response = await self.post_turn(data)
+
+            self.assertEqual(response.status_code, 400, data)
+        async_save_conversation.delay.assert_not_called()
+
+
+@override_settings(CACHES=TEST_CACHES, API_PAGE_SIZE=2)
+@mock.patch('aiCoach.db_router.replica_configured', mock.Mock(return_value=False))
+class KeysetPaginationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = seed_coaching_data()
+        cls.other_user = User.objects.create(email='janedoe@email.com', first_name='Jane')
+        created_at = timezone.now()
+        # Two chats share a created_at, so the id breaks the tie
+        for minutes in [0, 0, 1, 2, 3]:
+            UserConversationHistory.objects.create(user=cls.user, created_at=created_at - timedelta(minutes=minutes))
+
+    def pages(self, url):
+        results = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            results.append(response.json()["results"])
+            url = response.json()["next"]
+        return results
+
+    def test_pages_cover_every_row_once_newest_first(self):
+        pages = self.pages(f'/api/chat-history/{self.user.id}/')
+
+        expected = UserConversationHistory.objects.filter(user=self.user).order_by('-created_at', '-id')
+        self.assertEqual([len(page) for page in pages], [2, 2, 1])
+        self.assertEqual([chat["chat_id"] for page in pages for chat in page], [str(chat.chat_id) for chat in expected])
+
+    def test_deep_pages_run_the_same_queries(self):
+        first_page = self.client.get(f'/api/chat-history/{self.user.id}/')
+        with self.assertNumQueries(2):  # The user and one page
+            self.client.get(first_page.json()["next"])
+
+    def test_invalid_cursor(self):
+        response = self.client.get(f'/api/chat-history/{self.user.id}/', {'cursor': 'not-a-cursor'})
+
+        self.assertEqual(response.status_code, 404)
+
+    def test_user_scoped_lists(self):
+        self.assertEqual(self.client.get('/api/last-calls/').status_code, 400)
+
+        last_calls = self.pages(f'/api/last-calls/?user_id={self.user.id}&page_size=5')
+        performance = self.client.get('/api/performance-data/', {'user_id': self.other_user.id}).json()
+
+        self.assertEqual(
+            [call["statement"] for call in last_calls[0]], ["QUESTIONING statement", "OPENING statement"],
+        )
+        self.assertEqual(performance, {"next": None, "results": []})
+
+    def test_reference_data_pages_oldest_first(self):
+        pages = self.pages('/api/category-levels/?page_size=3')
+
+        self.assertEqual(sum(len(page) for page in pages), 8)
+        self.assertEqual([level["id"] for page in pages for level in page], sorted(CategoryLevel.objects.values_list('id', flat=True)))
+
+
+@override_settings(CACHES=TEST_CACHES, REFERENCE_DATA_MAX_AGE=60)
+@mock.patch('aiCoach.db_router.replica_configured', mock.Mock(return_value=False))
+class ReferenceDataCacheTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        seed_coaching_data()
+
+    def setUp(self):
+        cache.clear()
+
+    def test_unchanged_data_is_served_without_queries(self):
+        response = self.client.get('/api/category-levels/')
+        etag = response['ETag']
+
+        with self.assertNumQueries(0):
+            cached = self.client.get('/api/category-levels/')
+            not_modified = self.client.get('/api/category-levels/', HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(cached.content, response.content)
+        self.assertEqual(cached['ETag'], etag)
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(not_modified['ETag'], etag)
+        self.assertIn('max-age=60', not_modified['Cache-Control'])
+
+    def test_pages_have_their_own_etag(self):
+        first = self.client.get('/api/category-levels/', {'page_size': 2})
+        second = self.client.get(first.json()["next"])
+
+        self.assertNotEqual(first['ETag'], second['ETag'])
+        self.assertNotEqual(first.json()["results"], second.json()["results"])
+
+    def test_create_changes_the_version(self):
+        etag = self.client.get('/api/categories/')['ETag']
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post('/api/categories/create/', {'category': 'OPENING', 'definition': 'Opening the call.'},
+                             content_type='application/json')
+        response = self.client.get('/api/categories/', HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual([category["category"] for category in response.json()["results"]], ['OPENING'])
+
+    def test_writer_sticks_to_the_primary_before_the_bump(self):
+        calls = mock.Mock()
+        with mock.patch('aiCoach.signals.mark_primary', calls.mark_primary), \
+                mock.patch.object(REFERENCE_DATA_CACHE, 'bump_version', calls.bump_version), \
+                self.captureOnCommitCallbacks(execute=True):
+            Category.objects.create(category='OPENING', definition='Opening the call.')
+
+        self.assertEqual(calls.mock_calls[:2], [mock.call.mark_primary(REFERENCE_DATA), mock.call.bump_version()])
+
+
+def seq_scans(plan):
+    """
+    Tables read by a sequential scan anywhere in an EXPLAIN (FORMAT JSON) plan.
+    """
+    scans = {plan['Relation Name']} if plan['Node Type'] == 'Seq Scan' else set()
+    for child in plan.get('Plans', []):
+        scans |= seq_scans(child)
+    return scans
+
+
+def index_names(plan):
+    """
+    The indexes read anywhere in an EXPLAIN (FORMAT JSON) plan.
+    """
+    names = {plan['Index Name']} if 'Index Name' in plan else set()
+    for child in plan.get('Plans', []):
+        names |= index_names(child)
+    return names
+
+
+def index_conditions(plan):
+    """
+    The index conditions of all index scans in an EXPLAIN (FORMAT JSON) plan.
+    """
+    conditions = [plan['Index Cond']] if 'Index Cond' in plan else []
+    for child in plan.get('Plans', []):
+        conditions += index_conditions(child)
+    return conditions
+
+
+@unittest.skipUnless(connection.vendor == 'postgresql', "Query plans are checked on PostgreSQL")
+@override_settings(CACHES=TEST_CACHES)
+@PRIMARY_ONLY
+class QueryPlanTests(TestCase):
+    """
+    EXPLAINs every SELECT of the hot lookups at a seeded volume and fails on
+    sequential scans.
+    """
+    USERS = 1000
+    REFERENCE_ROWS = 2000
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = seed_coaching_data()
+        cls.chat = UserConversationHistory.objects.create(user=cls.user)
+        ConversationMessage.objects.create(chat=cls.chat, sequence=1, role='coach', text="Hello John!")
+
+        users = User.objects.bulk_create(User(email=f'user{index}@email.com') for index in range(cls.USERS))
+        categories = ['OPENING', 'QUESTIONING', 'PRESENTING', 'CLOSING', 'OUTCOME']
+        # A quarter of the rows are inactive (deleted chats, replaced goals and data)
+        chats = UserConversationHistory.objects.bulk_create(
+            UserConversationHistory(user=user, chat_label='Labelled', is_active=index % 4 != 0)
+            for user in users for index in range(8)
+        )
+        ConversationMessage.objects.bulk_create(
+            ConversationMessage(chat=chat, sequence=sequence, role=role, text="Message")
+            for chat in chats for sequence, role in enumerate(['coach', 'user', 'coach'], start=1)
+        )
+        UserGoal.objects.bulk_create(
+            UserGoal(user=user, category=category, goal_level='35%', is_active=is_active)
+            for user in users for category in categories for is_active in (True, False)
+        )
+        UserCallStatementsWithLevel.objects.bulk_create(
+            UserCallStatementsWithLevel(user=user, statement="Statement", category=category, level='2',
+                                        confidence_score=90, is_active=index % 4 != 0)
+            for user in users for index, category in enumerate(categories * 2)
+        )
+        UserPerformanceData.objects.bulk_create(
+            UserPerformanceData(user=user, category=category, date='2024-05-15', is_active=index % 4 != 0)
+            for user in users for index, category in enumerate(categories * 2)
+        )
+        # Reference data of other programs, a quarter of it retired
+        Category.objects.bulk_create(
+            Category(category=f'PROGRAM{index}', definition="Definition", is_active=index % 4 != 0)
+            for index in range(cls.REFERENCE_ROWS)
+        )
+        levels = CategoryLevel.objects.bulk_create(
+            CategoryLevel(category=f'PROGRAM{index // 4}', level=index % 4 + 1, is_active=index % 4 != 0)
+            for index in range(cls.REFERENCE_ROWS)
+        )
+        CategoryLevelExample.objects.bulk_create(
+            CategoryLevelExample(category_level=level, example_text="Example") for level in levels
+        )
+        CoachingPrompt.objects.bulk_create(
+            CoachingPrompt(category=f'PROGRAM{index}', prompt="Prompt", is_active=index % 4 != 0)
+            for index in range(cls.REFERENCE_ROWS)
+        )
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+
+    def setUp(self):
+        cache.clear()
+
+    def explain_selects(self, run):
+        """
+        The (sql, plan) of every SELECT issued by `run`.
+        """
+        with CaptureQueriesContext(connection) as queries:
+            run()
+        selects = [query['sql'] for query in queries if query['sql'].startswith('SELECT')]
+        self.assertTrue(selects)
+        plans = []
+        with connection.cursor() as cursor:
+            for sql in selects:
+                cursor.execute(f"EXPLAIN (FORMAT JSON) {sql}")
+                plans.append((sql, cursor.fetchone()[0][0]['Plan']))
+        return plans
+
+    def assertNoSeqScans(self, run):
+        for sql, plan in self.explain_selects(run):
+            scans = seq_scans(plan)
+            self.assertFalse(scans, f"Sequential scan of {scans} in: {sql}")
+
+    def test_service_lookups(self):
+        def run():
+            list(get_conversation(self.chat.chat_id))
+            get_user_goal(self.user.id)
+            list(user_call_statements(self.user.id))
+            list(get_user_performance_data(self.user.id))
+            list(get_conversation_history_by_user(self.user.id))
+
+        self.assertNoSeqScans(run)
+
+    def test_paginated_user_lists(self):
+        user = User.objects.get(email='user0@email.com')
+
+        def run():
+            for url in [f'/api/chat-history/{user.id}/?page_size=2', f'/api/last-calls/?user_id={user.id}&page_size=2',
+                        f'/api/performance-data/?user_id={user.id}&page_size=2']:
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+                self.client.get(response.json()["next"])  # A deeper page
+            self.client.get(f'/api/user-goals/{user.id}/')
+
+        self.assertNoSeqScans(run)
+
+    def test_keyset_cursor_is_an_index_condition(self):
+        user = User.objects.get(email='user0@email.com')
+        for url in [f'/api/chat-history/{user.id}/?page_size=2', f'/api/last-calls/?user_id={user.id}&page_size=2',
+                    f'/api/performance-data/?user_id={user.id}&page_size=2']:
+            next_page = self.client.get(url).json()["next"]
+            with CaptureQueriesContext(connection) as queries:
+                self.client.get(next_page)
+            sql = next(query['sql'] for query in queries if 'ORDER BY' in query['sql'])
+            with connection.cursor() as cursor:
+                cursor.execute(f"EXPLAIN (FORMAT JSON) {sql}")
+                conditions = index_conditions(cursor.fetchone()[0][0]['Plan'])
+            # The index is sought to the cursor, not read from the newest row
+            self.assertTrue([condition for condition in conditions if 'ROW(created_at, id) <' in condition], conditions)
+
+    def test_coaching_context(self):
+        self.assertNoSeqScans(lambda: load_coaching_context(self.user.id, self.chat.chat_id))
+
+    @mock.patch('aiCoach.tasks.LLM_MODEL')
+    def test_label_batch(self, llm_model):
+        llm_model.invoke.return_value = AIMessage(content=json.dumps({"labels": []}))
+
+        self.assertNoSeqScans(generate_chat_labels)
+
+    def test_reference_lookups(self):
+        def run():
+            load_coaching_prompt('GOAL')
+            load_category_level_prompt('QUESTIONING')
+            for url in ['/api/categories/', '/api/category-levels/', '/api/category-level-examples/', '/api/coaching-prompt/']:
+                self.client.get(url)
+
+        self.assertNoSeqScans(run)
+
+    def test_prompt_lookups_use_the_active_indexes(self):
+        for run, index in [(lambda: load_coaching_prompt('GOAL'), 'coaching_prompt_active'),
+                           (lambda: load_category_level_prompt('QUESTIONING'), 'category_level_active')]:
+            [(sql, plan)] = self.explain_selects(run)
+            self.assertIn(index, index_names(plan), sql)
+
+
+class FakeChatModelTests(SimpleTestCase):
+    coach_prompt = f"GOAL prompt. Output: {CHAT_FORMAT_INSTRUCTIONS}"
+
+    def test_coach_reply_is_schema_valid_and_deterministic(self):
+        model = FakeChatModel(step_completion_rate=1.0)
+
+        content = model.invoke(self.coach_prompt).content
+
+        reply = ChatParser.model_validate_json(content)
+        self.assertTrue(reply.message)
+        self.assertEqual(sum(getattr(reply, flag) for flag in STEP_FLAGS), 1)
+        self.assertEqual(model.invoke(self.coach_prompt).content, content)
+
+    def test_streamed_reply_matches_invoke(self):
+        model = FakeChatModel()
+
+        chunks = [chunk.content for chunk in model.stream(self.coach_prompt)]
+
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual("".join(chunks), model.invoke(self.coach_prompt).content)
+
+    def test_label_reply_covers_every_chat(self):
+        chat_ids = [str(uuid.uuid4()) for _ in range(3)]
+        prompt = CHAT_LABELS_PROMPT.render(conversations="\n".join(f"Chat ID: {chat_id}" for chat_id in chat_ids))
+
+        reply = ChatLabelsParser.model_validate_json(
+            FakeChatModel().invoke(prompt, **structured_output_kwargs(ChatLabelsParser)).content
+        )
+
+        self.assertEqual([label.chatId for label in reply.labels], chat_ids)
+
+    def test_injected_errors(self):
+        with self.assertRaises(openai.RateLimitError):
+            FakeChatModel(error_rate=1.0).invoke(self.coach_prompt)
+        with self.assertRaises(openai.APITimeoutError):
+            asyncio.run(FakeChatModel(error_rate=1.0, error="timeout").ainvoke(self.coach_prompt))
+
+    def test_latency_distributions(self):
+        rng = random.Random(0)
+
+        self.assertEqual(LatencyDistribution("fixed:0.5").sample(rng), 0.5)
+        self.assertTrue(0.2 <= LatencyDistribution("uniform:0.2,0.4").sample(rng) <= 0.4)
+        self.assertGreater(LatencyDistribution("lognormal:0,0.5").sample(rng), 0)
+        with self.assertRaises(ValueError):
+            LatencyDistribution("pareto:1")
+
+    def test_summary_prunes_with_fake_model(self):
+        with mock.patch('aiCoach.tasks.LLM_MODEL', FakeChatModel()):
+            summary = update_conversation_summary({}, [{"user": "Hi " * 50, "coach": "Hello " * 50}], 2)
+
+        self.assertTrue(summary["moving_summary_buffer"])
+        self.assertEqual(summary["folded_sequence"], 2)
+
+
+class DeploymentRouterTests(SimpleTestCase):
+    prompt = FakeChatModelTests.coach_prompt
+
+    def router(self, fast_latency="fixed:0", slow_latency="fixed:0.5", slow_error_rate=0.0, **options):
+        return DeploymentRouterChatModel(
+            names=["slow", "fast"],
+            deployments=[
+                FakeChatModel(latency=slow_latency, error_rate=slow_error_rate),
+                FakeChatModel(latency=fast_latency),
+            ],
+            seed=0,
+            **options,
+        )
+
+    def test_traffic_follows_latency(self):
+        router = self.router(hedge_percentile=0)
+        router._stats["slow"].record(1.0)
+        router._stats["fast"].record(0.1)
+
+        picks = [router.names[router.pick()] for _ in range(200)]
+
+        self.assertGreater(picks.count("fast"), 150)
+
+    @mock.patch.object(DeploymentRouterChatModel, 'pick', side_effect=[0, 1])  # Slow first
+    def test_slow_call_is_hedged(self, pick):
+        router = self.router(hedge_delay=0.05, min_samples=1)
+
+        started = time.perf_counter()
+        reply = router.invoke(self.prompt)
+
+        self.assertLess(time.perf_counter() - started, 0.4)
+        self.assertEqual(reply.content, FakeChatModel().invoke(self.prompt).content)
+
+    @mock.patch.object(DeploymentRouterChatModel, 'pick', side_effect=[0, 1])  # Slow first
+    def test_hedged_sync_call_keeps_the_request_timings(self, pick):
+        @contextlib.contextmanager
+        def limit(tokens):
+            record_timing("llm_queue", 0.01)  # As once the deployment's quota was waited for
+            yield
+
+        router = self.router(hedge_delay=0.05, min_samples=1, limiters=[mock.Mock(limit=limit), None])
+        timings = RequestTimings()
+
+        token = REQUEST_TIMINGS.set(timings)
+        try:
+            router.invoke(self.prompt)
+        finally:
+            REQUEST_TIMINGS.reset(token)
+
+        # Recorded by the slow call, which ran on a hedge thread
+        self.assertEqual(timings.counts, {"llm_queue": 1})
+
+    @mock.patch.object(DeploymentRouterChatModel, 'pick', side_effect=[0, 1])  # Slow first
+    def test_losing_async_call_is_cancelled(self, pick):
+        router = self.router(hedge_delay=0.05, min_samples=1)
+        cancelled = REGISTRY.get_sample_value('aicoach_llm_deployment_requests_total', {"deployment": "slow", "outcome": "cancelled"}) or 0
+
+        started = time.perf_counter()
+        asyncio.run(router.ainvoke(self.prompt))
+
+        self.assertLess(time.perf_counter() - started, 0.4)
+        self.assertEqual(
+            REGISTRY.get_sample_value('aicoach_llm_deployment_requests_total', {"deployment": "slow", "outcome": "cancelled"}),
+            cancelled + 1,
+        )
+
+    @mock.patch.object(DeploymentRouterChatModel, 'pick', side_effect=[0, 1])  # Slow first
+    def test_failed_call_moves_to_the_other_deployment(self, pick):
+        router = self.router(slow_latency="fixed:0", slow_error_rate=1.0, hedge_delay=5)
+
+        started = time.perf_counter()
+        reply = router.invoke(self.prompt)
+
+        self.assertLess(time.perf_counter() - started, 1)
+        self.assertTrue(reply.content)
+        self.assertEqual(router._stats["slow"].average, settings.LLM_REQUEST_TIMEOUT)
+
+    @override_settings(LLM_DEPLOYMENTS=[
+        {"name": "stub-a", "backend": "fake", "FAKE_LLM_LATENCY": "fixed:0.1"},
+        {"name": "stub-b", "backend": "fake"},
+    ])
+    def test_router_backend_builds_each_deployment(self):
+        router = create_chat_model({}, 'router')
+
+        self.assertEqual(router.names, ["stub-a", "stub-b"])
+        self.assertEqual([model.latency for model in router.deployments], ["fixed:0.1", settings.FAKE_LLM_LATENCY])
+
+    @mock.patch.object(DeploymentRouterChatModel, 'pick', side_effect=[0, 1])  # Slow first
+    def test_hedge_takes_quota(self, pick):
+        hedge_limiter = mock.Mock(**{"try_limit.return_value": contextlib.nullcontext(True)})
+        router = self.router(hedge_delay=0.05, min_samples=1, hedge_limiter=hedge_limiter)
+
+        started = time.perf_counter()
+        router.invoke(self.prompt)
+
+        self.assertLess(time.perf_counter() - started, 0.4)
+        hedge_limiter.try_limit.assert_called_once_with(mock.ANY, HEDGE)
+
+    @mock.patch.object(DeploymentRouterChatModel, 'pick', side_effect=[0, 1, 0, 1])  # Slow first
+    def test_hedge_without_quota_is_not_sent(self, pick):
+        no_quota = mock.Mock(**{"try_limit.side_effect": lambda *args: contextlib.nullcontext(False)})
+        router = self.router(hedge_delay=0.05, min_samples=1, hedge_limiter=no_quota)
+        skipped = REGISTRY.get_sample_value('aicoach_llm_hedges_skipped_total', {"deployment": "fast"}) or 0
+
+        started = time.perf_counter()
+        router.invoke(self.prompt)
+        self.assertGreaterEqual(time.perf_counter() - started, 0.5)  # Waited for the slow deployment
+        async_router = self.router(hedge_delay=0.05, min_samples=1, hedge_limiter=no_quota)
+        asyncio.run(async_router.ainvoke(self.prompt))
+
+        self.assertEqual(REGISTRY.get_sample_value('aicoach_llm_hedges_skipped_total', {"deployment": "fast"}), skipped + 2)
+        self.assertFalse(router._stats["fast"].samples or async_router._stats["fast"].samples)
+
+    @override_settings(LLM_DEPLOYMENTS=[
+        {"name": "stub-a", "backend": "fake", "RATE_LIMIT_RPM": 100},
+        {"name": "stub-b", "backend": "fake"},
+    ])
+    def test_deployment_quota(self):
+        router = create_chat_model({}, 'router')
+
+        self.assertEqual((router.limiters[0].rpm, router.limiters[0].tpm), (100, 0))
+        self.assertIsNone(router.limiters[1])
+
+    @override_settings(LLM_DEPLOYMENTS=[{"backend": "fake"}, {"backend": "fake"}])
+    def test_deployments_need_unique_names(self):
+        with self.assertRaises(ImproperlyConfigured):
+            create_chat_model({}, 'router')
+
+
+class LoggingTests(SimpleTestCase):
+    def setUp(self):
+        self.logger = logging.getLogger('aiCoach.tests')
+        self.payload = mock.Mock(return_value={"summary": "..."})
+
+    def test_payload_is_not_built_while_debug_is_off(self):
+        self.logger.setLevel(logging.INFO)
+        self.addCleanup(self.logger.setLevel, logging.NOTSET)
+
+        log_payload(self.logger, "Payload: %s", self.payload)
+
+        self.payload.assert_not_called()
+
+    @override_settings(LOG_PAYLOAD_SAMPLE_RATE=0.0)
+    def test_unsampled_payload_is_not_built(self):
+        with self.assertNoLogs(self.logger, level='DEBUG'):
+            log_payload(self.logger, "Payload: %s", self.payload)
+
+        self.payload.assert_not_called()
+
+    @override_settings(LOG_PAYLOAD_SAMPLE_RATE=1.0)
+    def test_sampled_payload_is_logged(self):
+        with self.assertLogs(self.logger, level='DEBUG') as logs:
+            log_payload(self.logger, "Payload: %s", self.payload)
+
+        self.assertEqual(logs.records[0].getMessage(), "Payload: {'summary': '...'}")
+
+    def test_queue_handler_writes_in_the_background_and_drops_when_full(self):
+        stream = io.StringIO()
+        handler = QueueLogHandler(stream, maxsize=1)
+        handler.stop()  # Nothing is written while the writer is stopped
+        record = logging.LogRecord('aiCoach', logging.INFO, __file__, 1, "Saved chat %s", ("abc",), None)
+
+        handler.handle(record)
+        handler.handle(record)
+        handler.start()
+        handler.stop()
+
+        self.assertEqual(handler.dropped, 1)
+        self.assertEqual(stream.getvalue(), "Saved chat abc\n")
+
+
+@override_settings(CACHES=TEST_CACHES, DATABASE_REPLICA_STICKY_SECONDS=10)
+@mock.patch('aiCoach.db_router.replica_configured', mock.Mock(return_value=True))
+class ReplicaRoutingTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_reads_go_to_the_replica_only_in_read_only_blocks(self):
+        self.assertIsNone(READ_DB_ALIAS.get())
+        with replica_reads("user:1"):
+            self.assertEqual(READ_DB_ALIAS.get(), 'replica')
+        self.assertIsNone(READ_DB_ALIAS.get())
+
+    def test_writer_reads_from_the_primary(self):
+        mark_primary("user:1", REFERENCE_DATA)
+
+        with replica_reads("user:1"):
+            self.assertEqual(READ_DB_ALIAS.get(), 'default')
+        with replica_reads(REFERENCE_DATA):
+            self.assertEqual(READ_DB_ALIAS.get(), 'default')
+        with replica_reads("user:2"):
+            self.assertEqual(READ_DB_ALIAS.get(), 'replica')
+
+    def test_without_replica(self):
+        with mock.patch('aiCoach.db_router.replica_configured', return_value=False), replica_reads("user:1"):
+            self.assertIsNone(READ_DB_ALIAS.get())
+
+    @mock.patch('aiCoach.db_router.replica_configured', mock.Mock(return_value=True))
+    def test_view_scopes_match_the_save_signals(self):
+        chat_id = uuid.uuid4()
+        mark_primary("user:5", f"chat:{chat_id}")
+
+        @read_from_replica(user='user_id', chat='chat_id')
+        def view(request, **kwargs):
+            return READ_DB_ALIAS.get()
+
+        factory = RequestFactory()
+        self.assertEqual(view(factory.get('/', {'user_id': '5'})), 'default')
+        self.assertEqual(view(factory.get('/', {'user_id': '05'})), 'default')
+        self.assertEqual(view(factory.get('/'), chat_id=str(chat_id).upper()), 'default')
+        self.assertEqual(view(factory.get('/', {'user_id': '6'})), 'replica')
+
+
+def redis_available():
+    try:
+        return get_redis().ping()
+    except Exception:
+        return False
+
+
+class LLMRateLimiterTests(SimpleTestCase):
+    def setUp(self):
+        self.limiter = LLMRateLimiter(f"test-quota-{uuid.uuid4().hex}")
+        self.addCleanup(lambda: redis_available() and get_redis().delete(*self.limiter.keys, self.limiter.latency_key))
+
+    @override_settings(LLM_RATE_LIMIT_RPM=0, LLM_RATE_LIMIT_TPM=0, LLM_MAX_CONCURRENCY=0)
+    @mock.patch('aiCoach.rate_limit.get_redis')
+    def test_disabled_limiter_skips_redis(self, get_redis):
+        with self.limiter.limit("Hello"):
+            pass
+
+        get_redis.assert_not_called()
+
+    @override_settings(LLM_RATE_LIMIT_RPM=10)
+    @mock.patch('aiCoach.rate_limit.get_redis')
+    def test_calls_go_ahead_when_redis_is_down(self, get_redis):
+        get_redis.return_value.eval.side_effect = redis.ConnectionError("down")
+
+        with self.limiter.limit("Hello"):
+            pass
+
+    @unittest.skipUnless(redis_available(), "Redis is not available")
+    @override_settings(LLM_RATE_LIMIT_RPM=60, LLM_RATE_LIMIT_TPM=0, LLM_MAX_CONCURRENCY=0,
+                       LLM_RATE_LIMIT_MAX_WAIT=1.5)
+    def test_requests_wait_for_the_bucket_to_refill(self):
+        get_redis().hset(self.limiter.keys[0], mapping={"level": 0, "updated": int(time.time() * 1000)})
+
+        started = time.perf_counter()
+        with self.limiter.limit("Hello"):  # One request per second refills
+            pass
+
+        self.assertGreater(time.perf_counter() - started, 0.5)
+
+    @unittest.skipUnless(redis_available(), "Redis is not available")
+    @override_settings(LLM_RATE_LIMIT_RPM=0, LLM_RATE_LIMIT_TPM=0, LLM_MAX_CONCURRENCY=1,
+                       LLM_RATE_LIMIT_MAX_WAIT=0.2)
+    def test_concurrency_limit(self):
+        with self.limiter.limit("Hello"):
+            with self.assertRaises(LLMRateLimitError):
+                asyncio.run(self.enter_async())
+
+        asyncio.run(self.enter_async())  # The slot is released
+
+    @unittest.skipUnless(redis_available(), "Redis is not available")
+    @override_settings(LLM_RATE_LIMIT_RPM=0, LLM_RATE_LIMIT_TPM=0, LLM_MAX_CONCURRENCY=0)
+    def test_try_limit_does_not_wait(self):
+        limiter = LLMRateLimiter(f"test-quota-{uuid.uuid4().hex}", rpm=1)
+        self.addCleanup(lambda: get_redis().delete(*limiter.keys))
+
+        started = time.perf_counter()
+        with limiter.try_limit("Hello") as taken:
+            self.assertTrue(taken)
+        with limiter.try_limit("Hello") as taken:
+            self.assertFalse(taken)
+        self.assertLess(time.perf_counter() - started, 0.5)
+
+    @unittest.skipUnless(redis_available(), "Redis is not available")
+    @override_settings(LLM_RATE_LIMIT_RPM=10, LLM_RATE_LIMIT_TPM=0, LLM_MAX_CONCURRENCY=0,
+                       LLM_RATE_LIMIT_MAX_WAIT=0.2, LLM_PRIORITY_RESERVES={LABEL: 0.5})
+    def test_background_calls_leave_the_reserve_to_interactive_calls(self):
+        get_redis().hset(self.limiter.keys[0], mapping={"level": 3, "updated": int(time.time() * 1000)})
+
+        with self.assertRaises(LLMRateLimitError):
+            with self.limiter.limit("Hello", LABEL):  # Needs 1 + 5 reserved requests
+                pass
+        with self.limiter.limit("Hello", INTERACTIVE):
+            pass
+
+    @unittest.skipUnless(redis_available(), "Redis is not available")
+    @override_settings(LLM_INTERACTIVE_LATENCY_TARGET=1, LLM_INTERACTIVE_LATENCY_SMOOTHING=0.5,
+                       LLM_INTERACTIVE_LATENCY_WINDOW=60, LLM_RATE_LIMIT_RPM=0, LLM_RATE_LIMIT_TPM=0,
+                       LLM_MAX_CONCURRENCY=0)
+    def test_background_work_is_deferred_while_interactive_calls_are_slow(self):
+        self.limiter.record_latency(3)
+        self.assertTrue(self.limiter.should_defer(LABEL))
+        self.assertFalse(self.limiter.should_defer(INTERACTIVE))
+
+        self.limiter.record_latency(0)
+        self.limiter.record_latency(0)  # Average 0.75s
+        self.assertAlmostEqual(self.limiter.interactive_latency(), 0.75)
+        self.assertFalse(self.limiter.should_defer(LABEL))
+
+    async def enter_async(self):
+        async with self.limiter.alimit(10):
+            pass
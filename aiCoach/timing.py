@@ -0,0 +1,74 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from rest_framework.renderers import JSONRenderer
+
+# Timings of the request being handled; None outside of requests (Celery, shell)
+REQUEST_TIMINGS = ContextVar('request_timings', default=None)
+
+
+class RequestTimings:
+    """
+    Accumulated durations (seconds) and counts per component of one request,
+    e.g. {"db": 0.012, "llm": 0.81}. Filled by `record_timing` from anywhere
+    in the request, including code run through sync_to_async.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.durations = {}
+        self.counts = {}
+
+    def add(self, name, seconds, count=1):
+        self.durations[name] = self.durations.get(name, 0.0) + seconds
+        self.counts[name] = self.counts.get(name, 0) + count
+
+    def total(self):
+        return time.perf_counter() - self.started
+
+    def server_timing(self):
+        """
+        The Server-Timing header value, durations in milliseconds.
+        """
+        metrics = [
+            f'{name};dur={seconds * 1000:.1f};desc="{self.counts[name]}x"'
+            for name, seconds in self.durations.items()
+        ]
+        metrics.append(f"total;dur={self.total() * 1000:.1f}")
+        return ", ".join(metrics)
+
+
+def record_timing(name, seconds, count=1):
+    timings = REQUEST_TIMINGS.get()
+    if timings is not None:
+        timings.add(name, seconds, count)
+
+
+@contextmanager
+def observe_timing(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_timing(name, time.perf_counter() - start)
+
+
+def db_timing_wrapper(execute, sql, params, many, context):
+    """
+    Execute wrapper that adds every query's duration to the request's "db" timing.
+    """
+    if REQUEST_TIMINGS.get() is None:
+        return execute(sql, params, many, context)
+    with observe_timing("db"):
+        return execute(sql, params, many, context)
+
+
+class TimedJSONRenderer(JSONRenderer):
+    """
+    JSONRenderer that records the response serialization time.
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        with observe_timing("serialize"):
+            return super().render(data, accepted_media_type, renderer_context)
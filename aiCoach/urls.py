@@ -1,10 +1,10 @@
 # urls.py
 from django.urls import path
-from aiCoach.views import (coach_chat, create_category_level_example_view,
+from aiCoach.views import (coach_chat, coach_chat_async, coach_chat_stream, create_category_level_example_view,
   create_category_level_view, create_category_view, create_coaching_prompts_view, create_user_call_statements_view,
   create_user_performance_data_view, create_user_goal_view, get_categories_view,
   get_category_level_examples_view, get_category_levels_view, get_chat, get_coaching_prompts_view, get_last_calls_view,
-  get_performance_data_view, get_user, get_user_chat_history, get_user_goals_view, login_signup)
+  get_performance_data_view, get_user, get_user_chat_history, get_user_goals_view, login_signup, metrics_view)
 
 urlpatterns = [
     path('categories/', get_categories_view, name='get-categories'),
@@ -19,7 +19,7 @@ urlpatterns = [
     path('last-calls/', get_last_calls_view, name='get-last-calls'),
     path('last-calls/create/', create_user_call_statements_view, name='create-last-call'),
 
-    path('user-goals/', get_user_goals_view, name='get-user-goals'),
+    path('user-goals/<int:user_id>/', get_user_goals_view, name='get-user-goals'),
     path('user-goals/create/', create_user_goal_view, name='create-user-goal'),
 
     path('performance-data/', get_performance_data_view, name='get-performance-data'),
@@ -31,8 +31,12 @@ urlpatterns = [
     path('login/', login_signup, name='login'),
     path('get-user/', get_user, name='get-user'),
     path('chat/', coach_chat, name='coach-chat'),
+    path('chat/stream/', coach_chat_stream, name='coach-chat-stream'),
+    path('chat/async/', coach_chat_async, name='coach-chat-async'),
 
     path('chat-messages/<str:chat_id>/', get_chat, name='conversation_history_messages'),
     path('chat-history/<int:user_id>/', get_user_chat_history, name='user_conversation_history'),
 
+    path('metrics/', metrics_view, name='metrics'),
+
 ]
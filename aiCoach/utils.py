@@ -1,21 +1,50 @@
 import json
+import logging
 import re
 from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
 from dotenv import load_dotenv
-from langchain_openai import AzureChatOpenAI
 
+from aiCoach.llm_backends import create_chat_model
+from aiCoach.log import log_payload
 from aiCoach.models import UserConversationHistory, User
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 def format_dict(data):
+    # Lists of records (e.g. serialized with many=True) are formatted one record per block
+    if isinstance(data, list):
+        return "\n".join(format_dict(item) for item in data)
     output = ""
     for key, value in data.items():
         output += f"{key}: {value}\n"
     return output
 
 
+def split_turn(turn):
+    """
+    Splits a chat turn ({"user": ..., "coach": ...}) into (role, text) messages,
+    skipping empty ones (e.g. the user's part of the opening turn).
+    """
+    return [(role, turn[role]) for role in ('user', 'coach') if turn.get(role)]
+
+
+def group_turns(rows):
+    """
+    Rebuilds chat turns ([{"user": ..., "coach": ...}, ...]) from
+    ConversationMessage rows in sequence order.
+    """
+    turns = []
+    for row in rows:
+        if row.role == 'coach' and turns and 'coach' not in turns[-1]:
+            turns[-1]['coach'] = row.text
+        else:
+            turns.append({row.role: row.text})
+    return turns
+
+
 # Azure OpenAI Configurations (from your settings)
 CHAT_API = {
     "MODEL_DEPLOYMENT": settings.AZURE_OPENAI_DEPLOYMENT_NAME,  # Azure OpenAI Model
@@ -29,19 +58,12 @@ CHAT_API = {
     "CHAT_SUMMARY_MAX_TOKEN": settings.AZURE_OPENAI_CHAT_SUMMARY_MAX_TOKEN,
 }
 
-# Initialize the OpenAI LLM Model
-LLM_MODEL = AzureChatOpenAI(
-    azure_deployment=CHAT_API["MODEL_DEPLOYMENT"],
-    azure_endpoint=CHAT_API["OPENAI_ENDPOINT"],
-    openai_api_version=CHAT_API["OPENAI_API_VERSION"],
-    model=CHAT_API["MODEL_NAME"],
-    temperature=CHAT_API["TEMPERATURE"],
-    max_tokens=CHAT_API["MAX_TOKENS"],
-)
+# Initialize the LLM Model of the configured backend (settings.LLM_BACKEND)
+LLM_MODEL = create_chat_model(CHAT_API)
 
 def parse_response(response):
     json_data = response
-    print("\n json_data", json_data)
+    log_payload(logger, "LLM reply: %s", response)
 
     # Extract JSON code block if present
     if "```json" in response:
@@ -62,6 +84,6 @@ def parse_response(response):
         if type(response) is str:
             json_data = json.loads(response.strip())
     except json.JSONDecodeError:
-        print("Response is not valid JSON.")
+        logger.debug("Response is not valid JSON.")
 
     return json_data
\ No newline at end of file
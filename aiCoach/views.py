@@ -1,14 +1,32 @@
 # views.py
-from rest_framework.decorators import api_view
+import json
+import logging
+
+from rest_framework.decorators import api_view, renderer_classes
 from rest_framework.response import Response
 from rest_framework import status
+from rest_framework.exceptions import APIException
+from django.core.handlers.asgi import ASGIRequest
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET, require_POST
 
 from aiCoach.models import COACHING_PROMPT_TYPES, CoachingPrompt, User, UserConversationHistory
 from aiCoach.services import (create_category, create_category_level,
   create_category_level_example, create_user_call_statements, create_user_performance_data, create_user_goal,
   get_all_categories, get_all_category_level_examples, get_all_category_levels, get_conversation, get_or_update_user, user_call_statements,
-  get_user_performance_data, get_user_goal, chat_with_coach)
+  get_user_performance_data, get_user_goal, achat_with_coach, astream_chat_with_coach, chat_with_coach,
+  stream_chat_with_coach)
+from aiCoach.context import aload_coaching_context, load_coaching_context
+from aiCoach.db_router import REFERENCE_DATA, read_from_replica
+from aiCoach.metrics import render_metrics
+from aiCoach.streaming import EventStreamRenderer, format_sse_event
+from aiCoach.log import log_payload
+from aiCoach.pagination import KeysetPagination
+from aiCoach.prompts import COACHING_PROMPT_CACHE
+from aiCoach.reference_data import REFERENCE_DATA_CACHE, cache_versioned_response
+from aiCoach.timing import TimedJSONRenderer, observe_timing
 
 from aiCoach.serializers import (
     CategorySerializer,
@@ -22,6 +40,8 @@ from aiCoach.serializers import (
     UserSerializer
 )
 
+logger = logging.getLogger(__name__)
+
 
 @api_view(['POST'])
 def login_signup(request):
@@ -42,7 +62,6 @@ def login_signup(request):
 def get_user(request):
     # Extract email from the request
     email = request.data.get('email')   
-    print('\n email:-------', email)
 
     # Check if email is provided
     if not email:
@@ -59,34 +78,46 @@ def get_user(request):
 
 
 @api_view(['GET'])
+@read_from_replica(chat='chat_id')
 def get_chat(request, chat_id):
-    print('\n chat_id -------', chat_id)
-    chat_history = UserConversationHistorySerializer(get_conversation(chat_id),  many=True).data
+    with observe_timing("serialize"):  # Includes the queries run by the serializer, also counted under "db"
+        chat_history = UserConversationHistorySerializer(get_conversation(chat_id).prefetch_related('conversation_messages'),  many=True).data
     response = {}
     if(chat_history):
         response = chat_history[0]
-    print("\n chat_history-", chat_history)
     return Response(response, status=status.HTTP_200_OK)
 
 
 @api_view(['GET'])
+@read_from_replica(user='user_id')
 def get_user_chat_history(request, user_id):
-    print('\n get_user_chat_history user_id -----', user_id)
     # Ensure the user exists or return 404
     user = get_object_or_404(User, id=user_id)
-    
-    print('\n user', user)
 
-    # Fetch all chat history for the user, ordered by created_at in descending order
-    chat_history = UserConversationHistory.objects.filter(user=user, is_active=True).order_by('-created_at').values('chat_id', 'chat_label', 'created_at')
-    print('\n user_chat_history------', chat_history)
+    # Fetch a page of the user's chat history, newest first (evaluated here, while the view's reads go to the replica)
+    paginator = KeysetPagination()
+    chat_history = paginator.paginate_queryset(
+        UserConversationHistory.objects.filter(user=user, is_active=True).values('id', 'chat_id', 'chat_label', 'created_at'),
+        request,
+    )
 
     # Check if any chat history exists
-    if not chat_history.exists():
+    if not chat_history:
         return Response({"detail": "No chat history found for this user."}, status=status.HTTP_404_NOT_FOUND)
 
-    # Return the chat_id and chat_label fields
-    return Response(chat_history, status=status.HTTP_200_OK)
+    # Return the chat_id and chat_label fields (the id is only needed for the cursor)
+    return paginator.get_paginated_response([
+        {"chat_id": chat["chat_id"], "chat_label": chat["chat_label"], "created_at": chat["created_at"]}
+        for chat in chat_history
+    ])
+
+
+def get_user_id_param(request):
+    """
+    The `?user_id=` filter of the user-scoped list views, or None if it is missing or invalid.
+    """
+    user_id = request.query_params.get('user_id', '')
+    return int(user_id) if user_id.isdigit() else None
 
 
 # Category Views
@@ -98,10 +129,13 @@ def create_category_view(request):
 
 
 @api_view(['GET'])
+@cache_versioned_response(REFERENCE_DATA_CACHE)
+@read_from_replica(REFERENCE_DATA)
 def get_categories_view(request):
-    categories = get_all_categories()
+    paginator = KeysetPagination(descending=False)
+    categories = paginator.paginate_queryset(get_all_categories(), request)
     serializer = CategorySerializer(categories, many=True)
-    return Response(serializer.data, status=status.HTTP_200_OK)
+    return paginator.get_paginated_response(serializer.data)
 
 
 # Category Level Views
@@ -113,10 +147,13 @@ def create_category_level_view(request):
 
 
 @api_view(['GET'])
+@cache_versioned_response(REFERENCE_DATA_CACHE)
+@read_from_replica(REFERENCE_DATA)
 def get_category_levels_view(request):
-    category_levels = get_all_category_levels()
+    paginator = KeysetPagination(descending=False)
+    category_levels = paginator.paginate_queryset(get_all_category_levels(), request)
     serializer = CategoryLevelSerializer(category_levels, many=True)
-    return Response(serializer.data, status=status.HTTP_200_OK)
+    return paginator.get_paginated_response(serializer.data)
 
 
 # Category Level Example Views
@@ -128,10 +165,13 @@ def create_category_level_example_view(request):
 
 
 @api_view(['GET'])
+@cache_versioned_response(REFERENCE_DATA_CACHE)
+@read_from_replica(REFERENCE_DATA)
 def get_category_level_examples_view(request):
-    examples = get_all_category_level_examples()
+    paginator = KeysetPagination(descending=False)
+    examples = paginator.paginate_queryset(get_all_category_level_examples(), request)
     serializer = CategoryLevelExampleSerializer(examples, many=True)
-    return Response(serializer.data, status=status.HTTP_200_OK)
+    return paginator.get_paginated_response(serializer.data)
 
 
 # Last Call Views
@@ -143,10 +183,16 @@ def create_user_call_statements_view(request):
 
 
 @api_view(['GET'])
+@read_from_replica(user='user_id')
 def get_last_calls_view(request):
-    last_calls = user_call_statements()
+    user_id = get_user_id_param(request)
+    if user_id is None:
+        return Response({"error": "user_id is required"}, status=status.HTTP_400_BAD_REQUEST)
+
+    paginator = KeysetPagination()
+    last_calls = paginator.paginate_queryset(user_call_statements(user_id), request)
     serializer = UserCallStatementsWithLevelSerializer(last_calls, many=True)
-    return Response(serializer.data, status=status.HTTP_200_OK)
+    return paginator.get_paginated_response(serializer.data)
 
 
 # User Goal Views
@@ -158,10 +204,13 @@ def create_user_goal_view(request):
 
 
 @api_view(['GET'])
+@read_from_replica(user='user_id')
 def get_user_goals_view(request, user_id):
-    user_goals = get_user_goal(user_id)
-    serializer = UserGoalSerializer(user_goals, many=True)
-    return Response(serializer.data[0], status=status.HTTP_200_OK)
+    user_goal = get_user_goal(user_id)
+    if user_goal is None:
+        return Response({"detail": "No goal found for this user."}, status=status.HTTP_404_NOT_FOUND)
+    serializer = UserGoalSerializer(user_goal)
+    return Response(serializer.data, status=status.HTTP_200_OK)
 
 
 # Performance Data Views
@@ -173,21 +222,30 @@ def create_user_performance_data_view(request):
 
 
 @api_view(['GET'])
+@read_from_replica(user='user_id')
 def get_performance_data_view(request):
-    performance_data = get_user_performance_data()
+    user_id = get_user_id_param(request)
+    if user_id is None:
+        return Response({"error": "user_id is required"}, status=status.HTTP_400_BAD_REQUEST)
+
+    paginator = KeysetPagination()
+    performance_data = paginator.paginate_queryset(get_user_performance_data(user_id), request)
     serializer = UserPerformanceDataSerializer(performance_data, many=True)
-    return Response(serializer.data, status=status.HTTP_200_OK)
+    return paginator.get_paginated_response(serializer.data)
 
 @api_view(['GET'])
+@cache_versioned_response(COACHING_PROMPT_CACHE)
+@read_from_replica(REFERENCE_DATA)
 def get_coaching_prompts_view(request):
-    coaching_prompt_data = CoachingPrompt.objects.filter(is_active=True)
+    paginator = KeysetPagination(descending=False)
+    coaching_prompt_data = paginator.paginate_queryset(CoachingPrompt.objects.filter(is_active=True), request)
     serializer = CoachingPromptSerializer(coaching_prompt_data, many=True)
-    return Response(serializer.data, status=status.HTTP_200_OK)
+    return paginator.get_paginated_response(serializer.data)
 
 @api_view(['POST'])
 def create_coaching_prompts_view(request):
     data = request.data
-    print("\n create_coaching_prompts data", data)
+    log_payload(logger, "Coaching prompt update: %s", data)
 
     category = data.get('category')
     prompt = data.get('prompt')
@@ -220,26 +278,112 @@ def create_coaching_prompts_view(request):
 @api_view(['POST'])
 def coach_chat(request):
     data = request.data
-    print("data",data)
     user_message = data.get('text', '')  # Get the user's latest message
     user_id = int(data.get('user_id'))  # Get the user_id
     chat_id = data.get('chat_id')
-    
-    # Ensure the user exists or return 404
-    user = get_object_or_404(User, id=user_id)
-    
-    # Serialize user data
-    user_data = UserSerializer(user).data  # No need to pass `data=user` since `user` is an instance
-    
-    print("\n user--", user_data)
-
-    # Access user data correctly
-    response = chat_with_coach(
-        user_name=f"{user_data['first_name']} {user_data['last_name']}",
-        user_id=user_data['id'],
-        chat_id= chat_id,
-        user_message= user_message,
-    )
+
+    # Load the user, goal, performance data and conversation in one round trip (404 if the user doesn't exist)
+    context = load_coaching_context(user_id, chat_id)
+
+    response = chat_with_coach(context, user_message=user_message)
 
     return Response( response, status=status.HTTP_200_OK)
 
+
+@api_view(['POST'])
+@renderer_classes([TimedJSONRenderer, EventStreamRenderer])
+def coach_chat_stream(request):
+    """
+    Same as `coach_chat`, but streams the coach's message to the client as
+    Server-Sent Events: `token` events while the LLM generates the reply and a
+    final `done` event carrying the full result with the GROW step flags.
+    """
+    data = request.data
+    user_message = data.get('text', '')  # Get the user's latest message
+    user_id = int(data.get('user_id'))  # Get the user_id
+    chat_id = data.get('chat_id')
+
+    # Load the coaching context up front so a missing user is still a plain 404
+    context = load_coaching_context(user_id, chat_id)
+    if isinstance(request._request, ASGIRequest):
+        # Django reads a sync stream under ASGI with sync_to_async(list), which would buffer the whole reply
+        stream = aevent_stream(astream_chat_with_coach(context, user_message=user_message))
+    else:
+        stream = event_stream(stream_chat_with_coach(context, user_message=user_message))
+
+    response = StreamingHttpResponse(stream, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # Disable proxy buffering (nginx) so tokens are flushed immediately
+    return response
+
+
+def event_stream(events):
+    """
+    Formats `(event, data)` tuples as Server-Sent Events.
+    """
+    try:
+        for event, event_data in events:
+            yield format_sse_event(event, event_data)
+    except Exception as error:
+        # Headers are already sent, so report failures in-band
+        logger.exception("coach_chat_stream error")
+        yield format_sse_event('error', {"detail": str(error)})
+
+
+async def aevent_stream(events):
+    """
+    Async variant of `event_stream`.
+    """
+    try:
+        async for event, event_data in events:
+            yield format_sse_event(event, event_data)
+    except Exception as error:
+        logger.exception("coach_chat_stream error")
+        yield format_sse_event('error', {"detail": str(error)})
+
+
+# DRF's api_view does not support async handlers, so the async chat endpoint is
+# a plain Django view. It is csrf-exempt like the DRF endpoints.
+@csrf_exempt
+@require_POST
+async def coach_chat_async(request):
+    """
+    Async variant of `coach_chat`. Under ASGI a turn that is waiting on the LLM
+    does not hold a worker thread, so one worker can serve many concurrent turns.
+    """
+    try:
+        data = json.loads(request.body or b"{}")
+    except json.JSONDecodeError:
+        data = None
+    if not isinstance(data, dict):
+        return JsonResponse({"error": "Invalid JSON body"}, status=status.HTTP_400_BAD_REQUEST)
+
+    user_message = data.get('text', '')  # Get the user's latest message
+    try:
+        user_id = int(data.get('user_id'))  # Get the user_id
+    except (TypeError, ValueError):
+        return JsonResponse({"error": "user_id must be an integer"}, status=status.HTTP_400_BAD_REQUEST)
+    chat_id = data.get('chat_id')
+
+    try:
+        context = await aload_coaching_context(user_id, chat_id)
+    except Http404 as error:
+        return JsonResponse({"detail": str(error)}, status=status.HTTP_404_NOT_FOUND)
+
+    try:
+        response = await achat_with_coach(context, user_message=user_message)
+    except APIException as error:
+        # E.g. an unreadable LLM reply or no LLM quota; DRF views get these from the DRF exception handler
+        return JsonResponse({"detail": str(error.detail)}, status=error.status_code)
+
+    return JsonResponse(response, status=status.HTTP_200_OK)
+
+
+@require_GET
+def metrics_view(request):
+    """
+    Prometheus scrape endpoint: LLM latency, token usage and parse failures per
+    operation and GROW step, response cache lookups and chat turn phases.
+    """
+    body, content_type = render_metrics()
+    return HttpResponse(body, content_type=content_type)